@@ -0,0 +1,422 @@
+"""Офлайн-бенчмарк обработчиков bot.py.
+
+Собирает настоящее Application (build_application из bot.py) поверх
+локальной заглушки Bot API и StatePersistence на временной SQLite и прогоняет
+синтетические потоки обновлений через update_queue, как от polling/webhook.
+Сеть и Telegram не нужны.
+
+    python bench.py                          # все сценарии
+    python bench.py contact export --orders 50000
+    python bench.py --latency send=0.05 --latency get_chat_member=0.2
+    python bench.py --tracemalloc --json bench.json
+
+Для каждого сценария печатает обновления/с, p50/p99 задержки обработки
+(от постановки в очередь до конца обработки), время сохранений в базу
+и пиковую память, чтобы ловить регрессии до деплоя.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+os.environ.setdefault('PROFILE_HANDLERS', '0')
+os.environ.setdefault('LOG_FILE', '')  # Лог только в stdout, без bot.log в текущем каталоге
+os.environ.setdefault('OUTBOX_RATE_PER_MINUTE', '1000000')  # Лимит канала Telegram растянул бы слив очереди на минуты
+
+import bot  # noqa: E402
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+ADMIN_ID = bot.ADMIN_IDS[0]
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+OUTBOX_DRAIN_TIMEOUT = 60
+
+# === ЗАГЛУШКА BOT API ===
+
+class FakeBotAPI(BaseRequest):
+    """Отвечает на запросы Bot API из памяти с заданной задержкой на метод.
+
+    latency: {'get_chat_member': 0.1, 'send': 0.03} - ключ сравнивается с началом
+    имени метода в snake_case, так что 'send' покрывает все send_*.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = latency or {}
+        self.calls = {}
+        self._message_id = 0
+
+    async def initialize(self): pass
+
+    async def shutdown(self): pass
+
+    def _delay(self, method):
+        for prefix, seconds in self.latency.items():
+            if method.startswith(prefix): return seconds
+        return 0
+
+    def _message(self, params):
+        self._message_id += 1
+        chat_id = params.get('chat_id', 0)
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'channel' if int(chat_id) < 0 else 'private'},
+            'text': params.get('text', ''),
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        name = bot.api_method_name(url.rsplit('/', 1)[-1])
+        params = request_data.parameters if request_data else {}
+        self.calls[name] = self.calls.get(name, 0) + 1
+        delay = self._delay(name)
+        if delay: await asyncio.sleep(delay)
+
+        if name == 'get_me':
+            result = BOT_USER
+        elif name == 'get_chat_member':
+            result = {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'U'}}
+        elif name == 'send_media_group':
+            result = [self._message(params) for _ in params.get('media') or ()]
+        elif name.startswith('send') or name in ('edit_message_text', 'copy_message', 'forward_message'):
+            result = self._message(params)
+            if name == 'send_document':
+                result['document'] = {'file_id': f"doc-{result['message_id']}", 'file_unique_id': f"udoc-{result['message_id']}"}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+# === СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ===
+
+class Updates:
+    """Фабрика обновлений в формате Bot API"""
+
+    def __init__(self, app_bot):
+        self.bot = app_bot
+        self.update_id = 0
+        self.message_id = 0
+
+    def _update(self, **payload):
+        self.update_id += 1
+        return Update.de_json({'update_id': self.update_id, **payload}, self.bot)
+
+    def message(self, user_id, **fields):
+        self.message_id += 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+        msg = {
+            'message_id': self.message_id, 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': user, **fields,
+        }
+        return self._update(message=msg)
+
+    def command(self, user_id, text):
+        return self.message(user_id, text=text, entities=[
+            {'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}
+        ])
+
+    def callback(self, user_id, data):
+        self.message_id += 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+        return self._update(callback_query={
+            'id': str(self.update_id), 'from': user, 'chat_instance': '1', 'data': data,
+            'message': {'message_id': self.message_id, 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': '...'},
+        })
+
+    def webapp(self, user_id, order):
+        return self.message(user_id, web_app_data={'data': json.dumps(order), 'button_text': 'Конструктор'})
+
+    def photo(self, user_id, n, media_group_id=None):
+        uid = f'{user_id}-{n}'
+        fields = {'photo': [{'file_id': f'file-{uid}', 'file_unique_id': f'u-{uid}', 'width': 1280, 'height': 960}]}
+        if media_group_id: fields['media_group_id'] = media_group_id
+        return self.message(user_id, **fields)
+
+    def contact(self, user_id):
+        return self.message(user_id, contact={'phone_number': f'+7927{user_id % 10000000:07d}', 'first_name': 'U', 'user_id': user_id})
+
+def random_order(oid):
+    return {
+        'id': oid, 'type': random.choice(list(bot.ROOF_TYPES)), 'material': random.choice(list(bot.MATERIALS)),
+        'paint': random.choice(list(bot.PAINTS)), 'length': random.randint(3, 12), 'width': random.randint(3, 8),
+        'height': 2.5, 'height_peak': 3.4, 'slope': 20, 'pillar': '80x80', 'area_floor': 36.0, 'area_roof': 41.5,
+        'color_frame': 'RAL8017', 'color_roof': 'RAL3005', 'opts': {'gutters': True, 'install': True},
+        'price': random.randint(50_000, 900_000),
+    }
+
+def fill_orders(bot_data, count):
+    """Заполняет базу заказами, как будто они пришли через handle_contact"""
+    start = datetime.now() - timedelta(days=365)
+    for i in range(count):
+        oid = f'BEN-{i:07d}'
+        user_id = 1_000_000 + i % max(count // 3, 1)
+        ts = (start + timedelta(minutes=i)).isoformat()
+        bot.put_order(bot_data, oid, {
+            'data': random_order(oid),
+            'user': {'name': f'User{user_id}', 'phone': f'+7927{user_id:07d}', 'username': None, 'user_id': user_id},
+            'status': random.choice(list(bot.STATUS_MAP)), 'comment': 'Нет пожеланий',
+            'timestamp': ts, 'photos_count': 0,
+        })
+        bot.put_customer(bot_data, user_id, {
+            'user_id': user_id, 'name': f'User{user_id}', 'username': None, 'phone': f'+7927{user_id:07d}',
+            'first_order_at': ts, 'last_order_at': ts,
+        })
+
+# === СЦЕНАРИИ ===
+# Сценарий получает фабрику и параметры и возвращает список шагов; шаг - список обновлений,
+# которые отправляются вместе (обновления одного шага разных пользователей идут параллельно).
+
+def scenario_webapp(updates, args):
+    users = range(2_000_000, 2_000_000 + args.users)
+    return [[updates.webapp(uid, random_order(f'WEB-{uid}-{n}')) for uid in users] for n in range(args.rounds)]
+
+def scenario_album(updates, args):
+    users = range(3_000_000, 3_000_000 + args.users)
+    steps = [[updates.message(uid, text="✏️ Добавить пожелания/фото") for uid in users]]
+    for n in range(args.album_size):
+        steps.append([updates.photo(uid, n, media_group_id=f'album-{uid}') for uid in users])
+    return steps
+
+def scenario_contact(updates, args):
+    users = range(4_000_000, 4_000_000 + args.users)
+    return [
+        [updates.webapp(uid, random_order(f'CNT-{uid}')) for uid in users],
+        [updates.contact(uid) for uid in users],
+    ]
+
+def scenario_order(updates, args):
+    pages = [f'orders:{status}:{offset}' for status in range(4) for offset in range(0, 200, bot.ORDER_PAGE_SIZE)]
+    oids = random.sample(list(updates.bot_data['orders']), min(args.rounds * 10, len(updates.bot_data['orders'])))
+    steps = [[updates.command(ADMIN_ID, '/order')] for _ in range(args.rounds)]
+    steps += [[updates.callback(ADMIN_ID, data)] for data in pages]
+    steps += [[updates.command(ADMIN_ID, f'/order {oid}')] for oid in oids]
+    steps += [[updates.command(ADMIN_ID, '/buyer')] for _ in range(args.rounds)]
+    return steps
+
+def scenario_export(updates, args):
+    variants = ['/export', '/export jsonl', '/export gz', '/export status=2', f'/export from={datetime.now().year}-01-01']
+    return [[updates.command(ADMIN_ID, text)] for text in variants]
+
+def scenario_find(updates, args):
+    oids = random.sample(list(updates.bot_data['orders']), min(args.rounds * 10, len(updates.bot_data['orders'])))
+    queries = []
+    for oid in oids:
+        user = updates.bot_data['orders'][oid]['user']
+        queries += [oid[:-2], user['phone'][-4:], user['phone'], user['name'].lower()[:-1]]
+    steps = [[updates.command(ADMIN_ID, f'/find {query}')] for query in queries]
+    steps += [[updates.callback(ADMIN_ID, f'find:{offset}')] for offset in range(0, 50, bot.FIND_PAGE_SIZE)]
+    return steps
+
+def scenario_broadcast(updates, args):
+    # Заявки клиентов идут, пока по всей базе клиентов разлетается рассылка
+    steps = [[updates.command(ADMIN_ID, '/broadcast Акция: <b>скидка 10%</b>')], [updates.command(ADMIN_ID, '/broadcast go')]]
+    return steps + scenario_webapp(updates, args)
+
+SCENARIOS = {
+    'webapp': (scenario_webapp, False),
+    'album': (scenario_album, False),
+    'contact': (scenario_contact, True),
+    'order': (scenario_order, True),   # True - нужна заполненная база заказов
+    'export': (scenario_export, True),
+    'find': (scenario_find, True),
+    'broadcast': (scenario_broadcast, True),
+}
+
+# === ПРОВЕРКА СОХРАНЕНИЯ ===
+
+async def check_flush(args):
+    """Сохранение после правки одного заказа сравнивает и пишет одну строку заказов, а не всю базу.
+    Возвращает (сравнено, записано) для таблицы orders"""
+    persistence = bot.StatePersistence(bot.SQLiteStateBackend(os.path.join(tempfile.mkdtemp(), 'check.db')))
+    seen = {}
+    diff = persistence._diff
+
+    def counting_diff(table, mapping, columns=None, keys=None):
+        rows, deleted = diff(table, mapping, columns, keys)
+        if table == 'orders': seen.update(compared=len(mapping if keys is None else keys), written=len(rows) + len(deleted))
+        return rows, deleted
+
+    persistence._diff = counting_diff
+    try:
+        bot_data = await persistence.get_bot_data()
+        fill_orders(bot_data, min(args.orders, 1000))
+        await persistence.update_bot_data(copy.deepcopy(bot_data))  # Как Application.update_persistence
+        oid = next(iter(bot_data['orders']))
+        bot.set_order_status(bot_data, oid, bot_data['orders'][oid]['status'] % 4 + 1)
+        await persistence.update_bot_data(copy.deepcopy(bot_data))
+        return seen['compared'], seen['written']
+    finally:
+        await persistence.flush()
+
+# === ПРОГОН ===
+
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def timed_flushes(persistence):
+    """Подменяет update_bot_data persistence замером; возвращает список длительностей сохранений"""
+    flushes = []
+    update_bot_data = persistence.update_bot_data
+
+    async def timed(data):
+        started = time.perf_counter()
+        await update_bot_data(data)
+        flushes.append(time.perf_counter() - started)
+
+    persistence.update_bot_data = timed
+    return flushes
+
+async def run_scenario(name, args, fake):
+    build, needs_orders = SCENARIOS[name]
+    app_bot = bot.AppBot(bot.BOT_TOKEN, request=fake, get_updates_request=fake)
+    db_path = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'state.db')
+    persistence = bot.StatePersistence(bot.SQLiteStateBackend(db_path), update_interval=args.flush_interval)
+    application = bot.build_application(bot=app_bot, persistence=persistence)
+    # Каждый сценарий начинает с холодного кэша подписок и чистого учёта обновлений
+    bot.subscription_cache = bot.SubscriptionCache(bot.SUB_CACHE_TTL, bot.SUB_CACHE_NEGATIVE_TTL)
+    bot.update_offsets = bot.UpdateOffsets()
+    await application.initialize()
+    bot.update_offsets.attach(application.bot_data)
+    if needs_orders:
+        fill_orders(application.bot_data, args.orders)
+        await application.update_persistence()  # База уже в хранилище, как у работающего бота
+    flushes = timed_flushes(persistence)
+    await application.start()  # Запускает и выборку из update_queue, и периодическое сохранение
+    bot.outbox.start(application)
+
+    try:
+        updates = Updates(app_bot)
+        updates.bot_data = application.bot_data
+        steps = build(updates, args)
+        fake.calls.clear()
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        latencies = []
+        queued_at = {}  # update_id -> момент постановки в очередь
+        processor = application.update_processor
+        process = processor.do_process_update
+
+        async def timed_process(update, coroutine):
+            try:
+                await process(update, coroutine)
+            finally:
+                queued = queued_at.pop(getattr(update, 'update_id', None), None)
+                if queued is not None: latencies.append(time.perf_counter() - queued)
+
+        processor.do_process_update = timed_process
+
+        started = time.perf_counter()
+        for step in steps:
+            for update in step:
+                queued_at[update.update_id] = time.perf_counter()
+                application.update_queue.put_nowait(update)
+            await application.update_queue.join()
+        elapsed = time.perf_counter() - started
+
+        # Уведомления в админ-канал уходят фоном - меряем, за сколько очередь сливается после шагов
+        drain_started = time.perf_counter()
+        while application.bot_data.get('outbox') and time.perf_counter() - drain_started < OUTBOX_DRAIN_TIMEOUT:
+            await asyncio.sleep(0.01)
+        outbox_drain = time.perf_counter() - drain_started
+        if application.bot_data.get('outbox'):
+            print(f"⚠️ {name}: в очереди уведомлений осталось {len(application.bot_data['outbox'])}", file=sys.stderr)
+
+        peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        if args.tracemalloc: tracemalloc.stop()
+
+        # Альбомы подтверждаются отложенной задачей - дожидаемся, чтобы не оборвать её на stop()
+        if name == 'album': await asyncio.sleep(bot.MEDIA_GROUP_DEBOUNCE * 2)
+    finally:
+        await bot.outbox.stop()
+        await bot.broadcaster.stop()
+        await application.stop()
+        await application.shutdown()
+
+    return {
+        'scenario': name,
+        'updates': len(latencies),
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'outbox_drain_s': round(outbox_drain, 3),
+        'flushes': len(flushes),
+        'flush_max_ms': round(max(flushes, default=0) * 1000, 1),
+        'peak_traced_mb': round(peak / 1024 / 1024, 1) if peak is not None else None,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'api_calls': dict(sorted(fake.calls.items())),
+    }
+
+async def run_all(names, args, latency):
+    # Один event loop на все сценарии: модульные синглтоны bot.py создают примитивы asyncio лениво
+    # Свежая заглушка на сценарий - счётчики вызовов не смешиваются
+    return [await run_scenario(name, args, FakeBotAPI(latency)) for name in names]
+
+def parse_latency(values):
+    latency = {}
+    for item in values:
+        method, _, seconds = item.partition('=')
+        latency[method] = float(seconds)
+    return latency
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    parser.add_argument('scenarios', nargs='*', help=f"какие сценарии гонять: {', '.join(SCENARIOS)} (по умолчанию все)")
+    parser.add_argument('--users', type=int, default=200, help="параллельных пользователей в клиентских сценариях")
+    parser.add_argument('--rounds', type=int, default=5, help="повторов в сценариях webapp и order")
+    parser.add_argument('--album-size', type=int, default=10, help="фото в альбоме")
+    parser.add_argument('--orders', type=int, default=20000, help="размер базы для order и export")
+    parser.add_argument('--latency', action='append', default=[], metavar='METHOD=SEC',
+                        help="задержка заглушки, напр. send=0.03 get_chat_member=0.1")
+    parser.add_argument('--flush-interval', type=float, default=1.0, help="период сохранения bot_data в базу, с")
+    parser.add_argument('--tracemalloc', action='store_true', help="точный пик памяти (медленнее)")
+    parser.add_argument('--json', metavar='FILE', help="сохранить результаты в JSON")
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown: parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.MEDIA_GROUP_DEBOUNCE = 0.2  # Иначе сценарий album большую часть времени ждёт таймер
+    latency = {'get_chat_member': 0.05, 'send': 0.02, 'edit_message_text': 0.02, 'answer_callback_query': 0.01}
+    latency.update(parse_latency(args.latency))
+
+    compared, written = asyncio.run(check_flush(args))
+    if (compared, written) != (1, 1):
+        print(f"❌ Сохранение после правки одного заказа: сравнено {compared}, записано {written} строк (ждали 1 и 1)", file=sys.stderr)
+        return 1
+
+    results = asyncio.run(run_all(args.scenarios or list(SCENARIOS), args, latency))
+    for result in results:
+        name = result['scenario']
+        peak = f"{result['peak_traced_mb']} МБ" if result['peak_traced_mb'] is not None else "-"
+        print(
+            f"{name:<8} {result['updates']:>6} upd {result['seconds']:>8.2f} s "
+            f"{result['updates_per_sec']:>9.1f} upd/s  p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  "
+            f"пик {peak}  rss {result['max_rss_mb']} МБ  очередь {result['outbox_drain_s']:.2f} s  "
+            f"сохранений {result['flushes']}, макс {result['flush_max_ms']:.1f} ms"
+        )
+        print(f"         API: {', '.join(f'{m}={n}' for m, n in result['api_calls'].items())}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'latency': latency, 'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
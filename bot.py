@@ -1,27 +1,152 @@
 import os
 import logging
+import logging.handlers
+import atexit
+import queue
 import json
 import io
 import csv
+import re
+import html
 import asyncio
+import pickle
+import sqlite3
+import socket
+import contextlib
+import threading
+import bisect
+import collections
+import functools
+import contextvars
+import cProfile
+import heapq
+import random
+import hmac
+import hashlib
+import tempfile
+import traceback
+import zlib
+from urllib.parse import urlencode
 import signal
 import sys
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from aiohttp import web
 
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PicklePersistence
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ChatMemberHandler, TypeHandler, BasePersistence, BaseUpdateProcessor, ExtBot
 
 # === НАСТРОЙКА ЛОГИРОВАНИЯ ===
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(sys.stdout),  # Для Render логов
-        logging.FileHandler('bot.log', encoding='utf-8')  # Для локальной отладки
-    ]
-)
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')  # Пустое значение - только stdout
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text или json (одна JSON-строка на запись)
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')  # Например midnight или H: ротация по времени вместо размера
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_REPEAT_INTERVAL = float(os.getenv('LOG_REPEAT_INTERVAL', 60))  # Одинаковые предупреждения и ошибки - не чаще раза за интервал
+
+# Обновление, которое сейчас обрабатывается: попадает в каждую запись лога
+log_context = contextvars.ContextVar('log_context', default={})
+
+class UpdateContextFilter(logging.Filter):
+    """Добавляет к записи update_id, user_id и имя обработчика текущего обновления"""
+
+    def filter(self, record):
+        ctx = log_context.get()
+        record.update_id = ctx.get('update_id')
+        record.user_id = ctx.get('user_id')
+        record.handler = ctx.get('handler')
+        return True
+
+class RepeatFilter(logging.Filter):
+    """Одинаковые предупреждения и ошибки пропускает не чаще раза в interval секунд.
+
+    Одинаковые - тот же логгер, тот же текст после подстановки аргументов и тот же тип исключения:
+    разные сбои с одной строки кода (например, все исключения обработчиков идут через одну строку PTB)
+    не глушат друг друга. Сколько повторов отброшено, сообщается отдельной записью в конце интервала"""
+
+    MAX_KEYS = 1000  # Тексты с ID уникальны - старые ключи чистим, чтобы словарь не рос
+
+    def __init__(self, interval, exclude=()):
+        super().__init__()
+        self.interval = interval
+        self.exclude = set(exclude)
+        self._lock = threading.Lock()
+        self._seen = {}  # (логгер, текст, тип исключения) -> [время первой записи в интервале, отброшено]
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.interval <= 0 or record.name in self.exclude: return True
+        key = (record.name, record.getMessage(), record.exc_info[0] if record.exc_info else None)
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen and now - seen[0] < self.interval:
+                if not seen[1]:
+                    # Первый отброшенный повтор: в конце интервала сообщим, сколько их набралось
+                    timer = threading.Timer(seen[0] + self.interval - now, self._report, (key, record.levelno))
+                    timer.daemon = True
+                    timer.start()
+                seen[1] += 1
+                return False
+            if len(self._seen) >= self.MAX_KEYS:
+                self._seen = {k: v for k, v in self._seen.items() if v[1] or now - v[0] < self.interval}
+            self._seen[key] = [now, 0]
+        return True
+
+    def _report(self, key, level):
+        with self._lock:
+            seen = self._seen.get(key)
+            suppressed = seen[1] if seen else 0
+            if seen: seen[1] = 0
+        if suppressed:
+            name, message, _ = key
+            logging.getLogger(name).log(level, f"🔁 Повторилось ещё {suppressed} раз за {self.interval:.0f} с: {message[:500]}")
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('update_id', 'user_id', 'handler'):
+            if getattr(record, key, None) is not None: entry[key] = getattr(record, key)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging():
+    """Логи пишет отдельный поток: обработчики в event loop только кладут запись в очередь"""
+    if LOG_FORMAT == 'json':
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    handlers = [logging.StreamHandler(sys.stdout)]  # Для Render логов
+    if LOG_FILE:  # Для локальной отладки
+        if LOG_ROTATE_WHEN:
+            handlers.append(logging.handlers.TimedRotatingFileHandler(
+                LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+            ))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+            ))
+    for handler in handlers: handler.setFormatter(formatter)
+
+    # Фильтры висят на QueueHandler: они должны видеть contextvars потока, который пишет в лог
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Иначе basicConfig навесит свой формат поверх нашего
+    queue_handler.addFilter(UpdateContextFilter())
+    queue_handler.addFilter(RepeatFilter(LOG_REPEAT_INTERVAL, exclude=['bot.slow_updates']))  # Там каждая запись - отдельное обновление
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Дописывает очередь при выходе
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # === КОНФИГУРАЦИЯ ===
@@ -31,11 +156,79 @@ ADMIN_CHANNEL_ID = -1003250531931
 INFO_CHANNEL_ID = -1003461235309
 INFO_CHANNEL_LINK = "https://t.me/taranov_public"
 ADMIN_IDS = [7746957973, 5216818742] 
+SUB_CACHE_TTL = int(os.getenv('SUB_CACHE_TTL', 600))  # Сколько секунд доверяем положительной проверке подписки
+SUB_CACHE_NEGATIVE_TTL = int(os.getenv('SUB_CACHE_NEGATIVE_TTL', 30))  # Отрицательный результат перепроверяем чаще
+SUB_CACHE_MAX = int(os.getenv('SUB_CACHE_MAX', 10000))  # Больше записей - вытесняем давно не спрашивавших
+PERSISTENCE_DB = os.getenv('PERSISTENCE_DB', 'bot_data.sqlite3')
+LEGACY_PICKLE = os.getenv('LEGACY_PICKLE', 'bot_data.pickle')  # Переносится в SQLite при первом запуске
+PERSISTENCE_INTERVAL = int(os.getenv('PERSISTENCE_INTERVAL', 60))
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling | webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес сервиса, например https://kovka007bot.onrender.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 16))  # Сколько обработчиков работает одновременно
+UPDATE_BACKLOG = int(os.getenv('UPDATE_BACKLOG', 256))  # Сколько обновлений может ждать освобождения своего чата
+SLOW_QUEUE_WAIT = float(os.getenv('SLOW_QUEUE_WAIT', 2.0))  # Ожидание в очереди дольше этого попадает в лог
+PUBLIC_URL = os.getenv('PUBLIC_URL', WEBHOOK_URL)  # Для ссылок на HTTP-выгрузку
+EXPORT_TOKEN = os.getenv('EXPORT_TOKEN')  # Без токена HTTP-выгрузка отключена
+EXPORT_LINK_TTL = int(os.getenv('EXPORT_LINK_TTL', 3600))
+EXPORT_DOCUMENT_LIMIT = 50 * 1024 * 1024  # Ограничение Telegram на документы от бота
+EXPORT_SPOOL_BYTES = 4 * 1024 * 1024  # Больше этого выгрузка собирается во временном файле на диске
+CLEAN_TRACK_LIMIT = int(os.getenv('CLEAN_TRACK_LIMIT', 500))  # Сколько последних ID сообщений помним на чат
+CLEAN_CONCURRENCY = int(os.getenv('CLEAN_CONCURRENCY', 5))
+OUTBOX_RATE_PER_MINUTE = int(os.getenv('OUTBOX_RATE_PER_MINUTE', 20))  # Лимит Telegram для одной группы/канала
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', 5))
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', 600))
+MEDIA_GROUP_DEBOUNCE = float(os.getenv('MEDIA_GROUP_DEBOUNCE', 1.5))  # Пауза, после которой альбом считается полученным
+MAX_ORDER_PHOTOS = int(os.getenv('MAX_ORDER_PHOTOS', 20))
+CARD_EDIT_DEBOUNCE = float(os.getenv('CARD_EDIT_DEBOUNCE', 3))  # Смены статуса за это время уходят в канал одной правкой карточки
+BROADCAST_RATE = int(os.getenv('BROADCAST_RATE', 20))  # Сообщений рассылки в секунду; Telegram пропускает ~30, остальное - обычным ответам
+BROADCAST_CHAT_INTERVAL = 1.0  # Не чаще одного сообщения в секунду в один чат
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 4))  # Сколько клиентам рассылка отправляет одновременно
+BROADCAST_MAX_ATTEMPTS = 3  # Попыток на клиента при сетевых ошибках
+BROADCAST_STATUS_INTERVAL = float(os.getenv('BROADCAST_STATUS_INTERVAL', 5))  # Как часто править сообщение с прогрессом
+API_CONNECTIONS = int(os.getenv('API_CONNECTIONS', CONCURRENT_UPDATES + BROADCAST_CONCURRENCY))  # Соединений с Bot API: ответы не ждут рассылку
+PROFILE_HANDLERS = os.getenv('PROFILE_HANDLERS', '0') == '1'  # Лог медленных обновлений с разбивкой времени
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', 1.0))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))  # Доля обновлений под cProfile (0 - выключено)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 10))
+SESSION_TTL = int(os.getenv('SESSION_TTL', 14 * 24 * 3600))  # Сессия без активности дольше этого удаляется
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', 3600))
+SESSION_ARCHIVE = os.getenv('SESSION_ARCHIVE', '1') == '1'  # Брошенные проекты (order_data) перед удалением сохраняются в архив
+SESSION_TOUCH_INTERVAL = 300  # Метку активности обновляем не чаще, чтобы не переписывать сессию на каждое сообщение
+PRICE_LIST = os.getenv('PRICE_LIST', 'price_list.json')  # JSON с тарифами поверх встроенных; перечитывается по /reprice
+PRICE_CHECK_TOLERANCE = float(os.getenv('PRICE_CHECK_TOLERANCE', 0))  # Расхождение с расчётом бота, при котором заявка помечается (0 - не проверять)
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 20))  # Render ждёт 30 с после SIGTERM, затем убивает процесс
+UPDATE_OFFSET_MAX_AGE = 6 * 24 * 3600  # После недели без обновлений Telegram нумерует их заново, старое смещение не годится
+VACUUM_FREE_RATIO = float(os.getenv('VACUUM_FREE_RATIO', 0.25))  # Доля свободных страниц, после которой делаем VACUUM
+BACKUP_CHAT_ID = int(os.getenv('BACKUP_CHAT_ID', 0)) or None  # Чат, куда бот шлёт резервные копии документами
+BACKUP_DIR = os.getenv('BACKUP_DIR', '')  # Или каталог для копий (лучше на постоянном диске)
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', 3600))  # Как часто сохранять изменения
+BACKUP_SNAPSHOT_INTERVAL = int(os.getenv('BACKUP_SNAPSHOT_INTERVAL', 24 * 3600))  # Как часто делать полный снимок
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))  # Сколько снимков с их изменениями хранить в BACKUP_DIR
+SHARED_STATE = os.getenv('SHARED_STATE', '0') == '1'  # Несколько процессов бота за балансировщиком с одним хранилищем (только webhook)
+WORKER_ID = os.getenv('WORKER_ID', '')  # Уникальное имя процесса: под ним хранятся его очередь уведомлений и смещение
+SHARED_REFRESH_INTERVAL = float(os.getenv('SHARED_REFRESH_INTERVAL', 1.0))  # Как часто подтягивать изменения других процессов
+STATE_LOCK_TTL = 120  # Блокировку упавшего процесса можно перехватить через столько секунд
+STATE_LOCK_TIMEOUT = float(os.getenv('STATE_LOCK_TIMEOUT', 10))
+STATE_BUSY_TIMEOUT = 30  # Сколько SQLite ждёт, пока другой процесс допишет транзакцию
+WATCHDOG_INTERVAL = float(os.getenv('WATCHDOG_INTERVAL', 0.5))  # Как часто сторож проверяет event loop
+WATCHDOG_STACK_LAG = float(os.getenv('WATCHDOG_STACK_LAG', 2.0))  # Loop занят дольше этого - стек блокирующего кода в лог
+READY_MAX_LAG = float(os.getenv('READY_MAX_LAG', 1.0))  # Пороги /ready в секундах, 0 - проверка выключена
+READY_MAX_STALL = float(os.getenv('READY_MAX_STALL', 120))  # Есть необработанные обновления, а обработка стоит
+READY_MAX_UPDATE_AGE = float(os.getenv('READY_MAX_UPDATE_AGE', 0))  # Тишина без входящих обновлений
+READY_MAX_PERSISTENCE_AGE = float(os.getenv('READY_MAX_PERSISTENCE_AGE', PERSISTENCE_INTERVAL * 5))
+READY_MAX_API_AGE = float(os.getenv('READY_MAX_API_AGE', 300 if BOT_MODE == 'polling' else 0))  # При polling getUpdates отвечает постоянно
 
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не найден в переменных окружения!")
     sys.exit(1)
 
+# Общий секрет для всех инстансов за балансировщиком; по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+
 logger.info(f"🚀 Запуск бота на порту: {PORT}")
 
 # === СПРАВОЧНИКИ ===
@@ -44,17 +237,394 @@ MATERIALS = {'polycarbonate': 'Сотовый поликарбонат', 'metalt
 PAINTS = {'none': 'Грунт-эмаль', 'ral': 'Эмаль RAL', 'polymer': 'Полимерно-порошковая'}
 STATUS_MAP = {1: "🟡 Ожидает", 2: "🔵 В работе", 3: "🟢 Сдан"}
 
+# === МЕТРИКИ (Prometheus) ===
+
+def _label_str(names, values):
+    if not names: return ''
+    pairs = ','.join(
+        '{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for n, v in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = collections.defaultdict(float)
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_label_str(self.labels, k)} {v}" for k, v in self.values.items()]
+        return lines
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.series = {}  # метки -> [счётчики по корзинам, сумма, количество]
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        series = self.series.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets): series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_label_str(self.labels + ('le',), labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_label_str(self.labels + ('le',), labels + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, labels)} {count}")
+        return lines
+
+class Gauge:
+    """Значение снимается в момент запроса /metrics функцией fn(application)"""
+
+    def __init__(self, name, help_text, fn):
+        self.name, self.help, self.fn = name, help_text, fn
+        self.application = None
+        METRICS.append(self)
+
+    def render(self):
+        try: value = self.fn(self.application)
+        except Exception: return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+METRICS = []
+lifecycle = {}  # Длительности запуска и остановки для метрик
+
+UPDATES_TOTAL = Counter('bot_updates_total', 'Обработанные обновления по обработчикам', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Время работы обработчика', ('handler',))
+QUEUE_WAIT_SECONDS = Histogram('bot_update_queue_wait_seconds', 'Ожидание обновления в очереди своего чата')
+API_SECONDS = Histogram('bot_api_seconds', 'Время вызова Bot API', ('method',))
+API_ERRORS = Counter('bot_api_errors_total', 'Ошибки Bot API', ('method', 'error'))
+PERSISTENCE_SECONDS = Histogram('bot_persistence_flush_seconds', 'Время сохранения bot_data в SQLite')
+PERSISTENCE_ROWS = Counter('bot_persistence_rows_written_total', 'Строк записано в SQLite')
+SESSIONS_EVICTED = Counter('bot_sessions_evicted_total', 'Сессий удалено по неактивности', ('action',))
+STORAGE_RECLAIMED = Counter('bot_storage_reclaimed_bytes_total', 'Байт освобождено сжатием базы')
+LOOP_LAG_SECONDS = Histogram('bot_event_loop_lag_seconds', 'Насколько позже срока просыпается пульс event loop')
+LOOP_STALLS = Counter('bot_event_loop_stalls_total', 'Блокировок event loop дольше WATCHDOG_STACK_LAG')
+Gauge('bot_persistence_db_bytes', 'Размер файла базы вместе с WAL', lambda app: db_file_bytes(PERSISTENCE_DB))
+Gauge('bot_sessions', 'Сессий user_data в памяти', lambda app: len(app.user_data))
+Gauge('bot_startup_seconds', 'Длительность последнего запуска', lambda app: lifecycle.get('startup_seconds', 0))
+Gauge('bot_previous_shutdown_seconds', 'Длительность предыдущей остановки', lambda app: (app.bot_data.get('last_shutdown') or {}).get('seconds', 0))
+Gauge('bot_event_loop_lag_max_seconds', 'Наибольшая задержка event loop за минуту', lambda app: watchdog.lag_max())
+Gauge('bot_update_queue_depth', 'Обновлений в application.update_queue', lambda app: app.update_queue.qsize())
+Gauge('bot_orders', 'Заказов в базе', lambda app: len(app.bot_data.get('orders', {})))
+Gauge('bot_users', 'Клиентов в базе', lambda app: len(app.bot_data.get('users', {})))
+Gauge('bot_outbox_pending', 'Уведомлений в очереди', lambda app: len(app.bot_data.get('outbox', [])))
+Gauge('bot_outbox_dead', 'Недоставленных уведомлений', lambda app: len(app.bot_data.get('outbox_dead', [])))
+Gauge('bot_subscription_cache_hits', 'Попадания в кэш подписок', lambda app: subscription_cache.hits)
+Gauge('bot_subscription_cache_misses', 'Промахи кэша подписок', lambda app: subscription_cache.misses)
+
+def render_metrics(application):
+    lines = []
+    for metric in METRICS:
+        if isinstance(metric, Gauge): metric.application = application
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+def api_method_name(endpoint):
+    """sendMediaGroup -> send_media_group"""
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', endpoint).lower()
+
+def instrumented(callback):
+    """Обёртка обработчика: счётчик обновлений, время и ошибки по имени функции.
+
+    При PROFILE_HANDLERS=1 ещё и разбивка времени (Bot API / хранилище) с логом медленных обновлений."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        timings = {'api': 0.0, 'persistence': 0.0}
+        token = update_timings.set(timings)
+        log_token = log_context.set({
+            'update_id': getattr(update, 'update_id', None),
+            'user_id': update.effective_user.id if isinstance(update, Update) and update.effective_user else None,
+            'handler': name,
+        })
+        profile = slow_profiler.maybe_start() if PROFILE_HANDLERS else None
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            update_timings.reset(token)
+            log_context.reset(log_token)
+            elapsed = time.perf_counter() - started
+            UPDATES_TOTAL.inc(name)
+            HANDLER_SECONDS.observe(elapsed, name)
+            if PROFILE_HANDLERS:
+                log_slow_update(name, update, elapsed, timings)
+                if profile: slow_profiler.finish(profile, elapsed, name, getattr(update, 'update_id', None))
+    return wrapper
+
+# === ПРОФИЛИРОВАНИЕ ОБРАБОТЧИКОВ ===
+
+# Сколько времени текущее обновление провело в Bot API и в хранилище
+update_timings = contextvars.ContextVar('update_timings', default=None)
+slow_logger = logging.getLogger('bot.slow_updates')
+
+def add_update_timing(kind, seconds):
+    timings = update_timings.get()
+    if timings is not None: timings[kind] += seconds
+
+class SlowUpdateProfiler:
+    """Держит на диске cProfile-снимки PROFILE_KEEP самых медленных обновлений.
+
+    cProfile снимает весь поток, поэтому в снимок попадают и задачи, работавшие
+    параллельно с обновлением; одновременно профилируется только одно обновление."""
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self._slowest = []  # куча (секунды, путь)
+        self._active = False
+
+    def maybe_start(self):
+        if self._active or PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE: return None
+        self._active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, seconds, name, update_id):
+        profile.disable()
+        self._active = False
+        if seconds < SLOW_UPDATE_THRESHOLD: return
+        if len(self._slowest) >= self.keep and seconds <= self._slowest[0][0]: return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{datetime.now():%Y%m%d-%H%M%S-%f}_{name}_{update_id}.prof")
+        profile.dump_stats(path)
+        heapq.heappush(self._slowest, (seconds, path))
+        if len(self._slowest) > self.keep:
+            _, evicted = heapq.heappop(self._slowest)
+            try: os.remove(evicted)
+            except OSError: pass
+        logger.info(f"🔬 Профиль медленного обновления сохранён: {path}")
+
+slow_profiler = SlowUpdateProfiler(PROFILE_DIR, PROFILE_KEEP)
+
+def log_slow_update(name, update, seconds, timings):
+    if seconds < SLOW_UPDATE_THRESHOLD: return
+    entry = {
+        'handler': name,
+        'update_id': getattr(update, 'update_id', None),
+        'user_id': update.effective_user.id if isinstance(update, Update) and update.effective_user else None,
+        'chat_id': update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None,
+        'wall_ms': round(seconds * 1000, 1),
+        'api_ms': round(timings['api'] * 1000, 1),
+        'persistence_ms': round(timings['persistence'] * 1000, 1),
+        'other_ms': round((seconds - timings['api'] - timings['persistence']) * 1000, 1),
+    }
+    slow_logger.warning(json.dumps(entry, ensure_ascii=False))
+
+# === СТОРОЖ EVENT LOOP ===
+
+class Watchdog:
+    """Задержка event loop и время последних успешных действий - для /ready.
+
+    Пульс засыпает на WATCHDOG_INTERVAL и меряет, насколько позже проснулся. Фоновый поток
+    следит за пульсом: если loop не отвечает дольше WATCHDOG_STACK_LAG, в лог уходит стек
+    кода, который его держит, пока тот ещё выполняется - после разблокировки виновника уже не найти."""
+
+    LAG_WINDOW = 60  # За сколько секунд помним задержки для максимума
+
+    def __init__(self):
+        self.started = time.time()
+        self.events = {}  # update_received | update_processed | persistence_flush | api_success -> time.time()
+        self.in_flight = 0  # Принятые обновления, которые ещё не обработаны
+        self.busy_since = self.started  # Когда очередь перестала быть пустой
+        self.lag = 0.0
+        self.beat = time.monotonic()
+        self._lags = collections.deque()  # (monotonic, задержка)
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._loop_thread = None
+
+    def mark(self, event):
+        now = time.time()
+        if event == 'update_received':
+            if not self.in_flight: self.busy_since = now
+            self.in_flight += 1
+        elif event == 'update_processed':
+            self.in_flight = max(0, self.in_flight - 1)
+        self.events[event] = now
+
+    def age(self, event):
+        """Секунд с последнего события, до первого - с запуска"""
+        return time.time() - self.events.get(event, self.started)
+
+    def stall(self):
+        """Сколько секунд обработка не продвигается при непустой очереди"""
+        if not self.in_flight: return 0.0
+        return time.time() - max(self.busy_since, self.events.get('update_processed', 0))
+
+    def current_lag(self):
+        """Задержка с учётом пульса, который опаздывает прямо сейчас"""
+        return max(self.lag, time.monotonic() - self.beat - WATCHDOG_INTERVAL)
+
+    def lag_max(self):
+        return max((lag for _, lag in self._lags), default=0.0)
+
+    def start(self):
+        self.started = time.time()
+        self.busy_since = self.started
+        self.beat = time.monotonic()
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            due = time.monotonic() + WATCHDOG_INTERVAL
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            self.beat = now
+            self.lag = max(0.0, now - due)
+            LOOP_LAG_SECONDS.observe(self.lag)
+            self._lags.append((now, self.lag))
+            while self._lags[0][0] < now - self.LAG_WINDOW:
+                self._lags.popleft()
+            if READY_MAX_LAG and self.lag > READY_MAX_LAG:
+                logger.warning(f"🐢 Event loop отстал на {self.lag:.2f} с")
+
+    def _watch(self):
+        """Поток-наблюдатель: снимает стек loop, пока тот заблокирован (один раз на блокировку)"""
+        dumped = None
+        while not self._stopped.wait(WATCHDOG_INTERVAL):
+            beat = self.beat
+            stalled = time.monotonic() - beat - WATCHDOG_INTERVAL
+            if stalled < WATCHDOG_STACK_LAG or beat == dumped: continue
+            dumped = beat
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame, limit=30)) if frame else '(стек недоступен)\n'
+            logger.warning(f"🧱 Event loop заблокирован {stalled:.1f} с, сейчас выполняется:\n{stack.rstrip()}")
+
+    def status(self, application):
+        """Проверки /ready: значение, порог (None - не проверяется) и итог"""
+        checks = {'running': {'value': application.running, 'limit': None, 'ok': application.running}}
+        for name, value, limit in (
+            ('event_loop_lag', self.current_lag(), READY_MAX_LAG),
+            ('update_stall', self.stall(), READY_MAX_STALL),
+            ('update_received_age', self.age('update_received'), READY_MAX_UPDATE_AGE),
+            ('update_processed_age', self.age('update_processed'), 0),
+            ('persistence_flush_age', self.age('persistence_flush'), READY_MAX_PERSISTENCE_AGE),
+            ('api_success_age', self.age('api_success'), READY_MAX_API_AGE),
+        ):
+            checks[name] = {'value': round(value, 3), 'limit': limit or None, 'ok': not limit or value <= limit}
+        return {
+            'ready': all(check['ok'] for check in checks.values()),
+            'checks': checks,
+            'event_loop_lag_max': round(self.lag_max(), 3),
+            'updates_in_flight': self.in_flight,
+            'uptime': round(time.time() - self.started, 1),
+        }
+
+watchdog = Watchdog()
+
 # === HTTP СЕРВЕР ДЛЯ HEALTH CHECKS ===
+APPLICATION_KEY = web.AppKey('application', Application)
+
 async def handle_health_check(request):
     """Обработчик health check для Render"""
     return web.Response(text="✅ Bot is alive")
 
-async def start_http_server(port):
+async def handle_ready(request):
+    """Готовность: loop отвечает, обновления обрабатываются, сохранение и Bot API работают. 503 - что-то стоит"""
+    status = watchdog.status(request.app[APPLICATION_KEY])
+    return web.json_response(status, status=200 if status['ready'] else 503)
+
+async def handle_metrics(request):
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(text=render_metrics(request.app[APPLICATION_KEY]), content_type='text/plain')
+
+async def handle_webhook(request):
+    """Приём обновлений от Telegram в режиме webhook"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    application = request.app[APPLICATION_KEY]
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+async def handle_export_download(request):
+    """Потоковая выгрузка заказов по HTTP (Bearer EXPORT_TOKEN или подписанная ссылка из /export)"""
+    query = dict(request.query)
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        allowed = hmac.compare_digest(auth[7:].encode(), EXPORT_TOKEN.encode())
+    else:
+        allowed = (
+            hmac.compare_digest(query.get('sig', '').encode(), _export_signature(query).encode())
+            and query.get('exp', '').isdigit() and int(query['exp']) > time.time()
+        )
+    if not allowed:
+        return web.Response(status=403)
+
+    try:
+        opts = parse_export_args(f"{k}={v}" for k, v in query.items() if k not in ('sig', 'exp'))
+    except ValueError as e:
+        return web.Response(status=400, text=str(e))
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'application/gzip' if opts['gzip'] else ('text/csv' if opts['format'] == 'csv' else 'application/x-ndjson'),
+        'Content-Disposition': f'attachment; filename="{export_filename(opts)}"',
+    })
+    await response.prepare(request)
+    orders = request.app[APPLICATION_KEY].bot_data.get('orders', {})
+    for chunk in iter_export_chunks(orders, opts):
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+async def start_http_server(port, application=None):
     """Запуск HTTP сервера на указанном порту для Render"""
     app = web.Application()
     app.router.add_get('/', handle_health_check)
     app.router.add_get('/health', handle_health_check)
     app.router.add_get('/ping', handle_health_check)
+    if application:
+        app[APPLICATION_KEY] = application
+        app.router.add_get('/metrics', handle_metrics)
+        app.router.add_get('/ready', handle_ready)
+        if BOT_MODE == 'webhook':
+            app.router.add_post(WEBHOOK_PATH, handle_webhook)
+        if EXPORT_TOKEN:
+            app.router.add_get('/export', handle_export_download)
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -63,77 +633,2810 @@ async def start_http_server(port):
     logger.info(f"🌐 HTTP сервер запущен на порту {port}")
     return runner
 
-# === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
+async def start_webhook(application):
+    """Регистрирует webhook в Telegram. False - нужно откатиться на polling"""
+    if not WEBHOOK_URL:
+        logger.error("❌ BOT_MODE=webhook, но WEBHOOK_URL не задан")
+        return False
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            # Накопленное за рестарт не выбрасываем (при SHARED_STATE - и за другие процессы);
+            # повторы отсекает UpdateOffsets в TrackingUpdateQueue
+            drop_pending_updates=False
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ Не удалось установить webhook: {e}")
+        return False
+
+# === ХРАНИЛИЩЕ ===
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    status INTEGER,
+    created_at TEXT,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status);
+CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at);
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, data BLOB NOT NULL, PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS session_archive (user_id INTEGER, archived_at TEXT, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS tombstones (tbl TEXT, key, rev INTEGER NOT NULL, PRIMARY KEY (tbl, key));
+CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS seq (id INTEGER PRIMARY KEY CHECK (id = 1), rev INTEGER NOT NULL);
+INSERT OR IGNORE INTO seq (id, rev) VALUES (1, 0);
+"""
+
+# Таблицы с построчными ревизиями и их ключевые колонки
+STATE_TABLES = {'orders': 'id', 'users': 'user_id', 'user_data': 'user_id', 'chat_data': 'chat_id', 'bot_data': 'key', 'meta': 'key'}
+# Ключи bot_data, которые у каждого процесса свои (очередь уведомлений, смещение обновлений)
+LOCAL_BOT_DATA_KEYS = ('outbox', 'outbox_dead', 'update_offset', 'last_shutdown', 'backup')
+
+def _dump(value):
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+def db_file_bytes(path):
+    """Размер базы SQLite вместе с WAL"""
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+def _order_columns(record):
+    """Индексируемые колонки заказа"""
+    user = record.get('user') or {}
+    return {'user_id': user.get('user_id'), 'status': record.get('status'), 'created_at': record.get('timestamp')}
+
+class StateBackend:
+    """Хранилище состояния, общее для всех процессов бота.
+
+    Значения приходят уже сериализованными (bytes). Каждая запись получает сквозную ревизию,
+    по которой процессы забирают чужие изменения. Сетевое хранилище (Redis, Postgres)
+    реализует эти же методы.
+    """
+
+    async def is_new(self):
+        """Хранилище только что создано и пусто"""
+        raise NotImplementedError
+
+    async def load(self, table, since=0):
+        """Строки, изменённые после ревизии since: ({ключ: (blob, ревизия)}, {удалённый ключ: ревизия}, макс. ревизия)"""
+        raise NotImplementedError
+
+    async def load_row(self, table, key):
+        """(blob, ревизия) одной строки или (None, 0)"""
+        raise NotImplementedError
+
+    async def write(self, table, rows, deleted=(), expected=None):
+        """Записывает {ключ: (blob, индексируемые колонки)} и удаляет ключи deleted одной транзакцией.
+
+        expected - {ключ: ревизия}: такие строки пишутся, только если их ревизия в хранилище не изменилась.
+        Возвращает (ревизия записи, ключи, пропущенные из-за чужих изменений)."""
+        raise NotImplementedError
+
+    async def append(self, table, **values):
+        """Добавляет строку в журнальную таблицу (архив сессий)"""
+        raise NotImplementedError
+
+    async def load_conversations(self, name):
+        raise NotImplementedError
+
+    async def write_conversation(self, name, key, blob):
+        raise NotImplementedError
+
+    def lock(self, name, ttl=None):
+        """Асинхронный контекстный менеджер: блокировка ключа, общая для всех процессов"""
+        raise NotImplementedError
+
+    async def compact(self):
+        """Сжимает хранилище, возвращает освобождённые байты"""
+        return 0
+
+    async def close(self):
+        pass
+
+class SQLiteStateBackend(StateBackend):
+    """StateBackend в одном файле SQLite (WAL) - для процессов на одной машине"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.created = False
+        self._conn = None
+        self._lock = threading.Lock()
+
+    # --- соединение ---
+
+    def _connect(self):
+        # Файл открываем только при первом обращении
+        if self._conn is None:
+            self.created = not os.path.exists(self.filepath)
+            # Другие процессы держат запись недолго - ждём, а не падаем с database is locked
+            conn = sqlite3.connect(self.filepath, check_same_thread=False, timeout=STATE_BUSY_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SQLITE_SCHEMA)
+            for table in STATE_TABLES:
+                if 'rev' not in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN rev INTEGER NOT NULL DEFAULT 0')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_rev ON {table} (rev)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        def call():
+            with self._lock:
+                return fn(self._connect(), *args)
+        started = time.perf_counter()
+        try:
+            return await asyncio.to_thread(call)
+        finally:
+            add_update_timing('persistence', time.perf_counter() - started)
+
+    # --- данные ---
+
+    async def is_new(self):
+        await self._run(lambda conn: None)
+        return self.created
+
+    async def load(self, table, since=0):
+        keycol = STATE_TABLES[table]
+        def load(conn):
+            # Строки из базы до появления ревизий имеют rev 0 - полная загрузка берёт всё
+            query = f'SELECT {keycol}, data, rev FROM {table}' + (' WHERE rev > ?' if since else '')
+            rows = {key: (blob, rev) for key, blob, rev in conn.execute(query, (since,) if since else ())}
+            deleted = dict(conn.execute('SELECT key, rev FROM tombstones WHERE tbl = ? AND rev > ?', (table, since))) if since else {}
+            revs = [rev for _, rev in rows.values()] + list(deleted.values())
+            return rows, deleted, max(revs, default=since)
+        return await self._run(load)
+
+    async def load_row(self, table, key):
+        def load(conn):
+            row = conn.execute(f'SELECT data, rev FROM {table} WHERE {STATE_TABLES[table]} = ?', (key,)).fetchone()
+            return tuple(row) if row else (None, 0)
+        return await self._run(load)
+
+    async def write(self, table, rows, deleted=(), expected=None):
+        keycol = STATE_TABLES[table]
+        def write(conn):
+            with conn:
+                # Увеличение счётчика берёт блокировку записи: ревизии идут строго по порядку транзакций
+                conn.execute('UPDATE seq SET rev = rev + 1 WHERE id = 1')
+                rev = conn.execute('SELECT rev FROM seq WHERE id = 1').fetchone()[0]
+                conflicts = set()
+                if expected:
+                    for key, known in expected.items():
+                        current = conn.execute(f'SELECT rev FROM {table} WHERE {keycol} = ?', (key,)).fetchone()
+                        tomb = conn.execute('SELECT rev FROM tombstones WHERE tbl = ? AND key = ?', (table, key)).fetchone()
+                        if max(current[0] if current else 0, tomb[0] if tomb else 0) > known: conflicts.add(key)
+                for key, (blob, columns) in rows.items():
+                    if key in conflicts: continue
+                    names = ', '.join([keycol, 'data', 'rev', *columns])
+                    marks = ', '.join('?' * (len(columns) + 3))
+                    conn.execute(f'INSERT OR REPLACE INTO {table} ({names}) VALUES ({marks})', (key, blob, rev, *columns.values()))
+                    conn.execute('DELETE FROM tombstones WHERE tbl = ? AND key = ?', (table, key))
+                for key in deleted:
+                    if key in conflicts: continue
+                    conn.execute(f'DELETE FROM {table} WHERE {keycol} = ?', (key,))
+                    conn.execute('INSERT OR REPLACE INTO tombstones (tbl, key, rev) VALUES (?, ?, ?)', (table, key, rev))
+            return rev, conflicts
+        return await self._run(write)
+
+    async def append(self, table, **values):
+        def append(conn):
+            with conn:
+                conn.execute(
+                    f'INSERT INTO {table} ({", ".join(values)}) VALUES ({", ".join("?" * len(values))})',
+                    tuple(values.values())
+                )
+        await self._run(append)
+
+    async def load_conversations(self, name):
+        def load(conn):
+            rows = conn.execute('SELECT key, data FROM conversations WHERE name = ?', (name,))
+            return {tuple(json.loads(key)): blob for key, blob in rows}
+        return await self._run(load)
+
+    async def write_conversation(self, name, key, blob):
+        def write(conn):
+            with conn:
+                if blob is None:
+                    conn.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, json.dumps(key)))
+                else:
+                    conn.execute('INSERT OR REPLACE INTO conversations (name, key, data) VALUES (?, ?, ?)', (name, json.dumps(key), blob))
+        await self._run(write)
+
+    # --- блокировки ---
+
+    @contextlib.asynccontextmanager
+    async def lock(self, name, ttl=None):
+        """Аренда ключа в таблице locks. Истёкшую аренду (процесс упал) можно перехватить"""
+        ttl = ttl or STATE_LOCK_TTL
+        token = f"{self.owner}:{os.urandom(4).hex()}"
+
+        def acquire(conn):
+            now = time.time()
+            with conn:
+                conn.execute('DELETE FROM locks WHERE name = ? AND expires_at < ?', (name, now))
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)', (name, token, now + ttl)
+                )
+            return cursor.rowcount == 1
+
+        def release(conn):
+            with conn:
+                conn.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, token))
+
+        deadline = time.monotonic() + STATE_LOCK_TIMEOUT
+        delay = 0.01
+        while not await self._run(acquire):
+            if time.monotonic() > deadline: raise TimeoutError(f"Блокировка {name} занята дольше {STATE_LOCK_TIMEOUT} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            yield
+        finally:
+            await self._run(release)
+
+    # --- обслуживание ---
+
+    async def compact(self):
+        """Сбрасывает WAL в основной файл и делает VACUUM, если свободных страниц много"""
+        def compact(conn):
+            before = db_file_bytes(self.filepath)
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            pages = conn.execute('PRAGMA page_count').fetchone()[0]
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if pages and free / pages >= VACUUM_FREE_RATIO:
+                conn.execute('VACUUM')
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')  # VACUUM в режиме WAL пишет через журнал
+            return before - db_file_bytes(self.filepath)
+        return await self._run(compact)
+
+    async def close(self):
+        def close(conn):
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.close()
+            self._conn = None
+        await self._run(close)
+
+class StatePersistence(BasePersistence):
+    """Персистентность PTB поверх StateBackend.
+
+    Заказы, клиенты и сессии лежат построчно, и при каждом сохранении
+    пишутся только записи, чей сериализованный вид изменился.
+
+    С shared=True несколько процессов работают с одним хранилищем: перед обработкой
+    обновления подтягиваются чужие изменения (refresh_*), строка не перезаписывается,
+    если её успел изменить другой процесс, а критичные изменения идут через shared_rows().
+    """
+
+    def __init__(self, backend, legacy_pickle=None, update_interval=60, shared=False, worker_id=''):
+        super().__init__(update_interval=update_interval)
+        self.backend = backend
+        self.legacy_pickle = legacy_pickle
+        self.shared = shared
+        self.worker_id = worker_id
+        self._written = {}  # таблица -> {ключ: последний известный blob}
+        self._revs = {}  # таблица -> {ключ: ревизия этого blob}
+        self._synced = {}  # таблица -> ревизия, до которой подхвачены чужие изменения
+        self._refreshed_at = 0.0
+
+    # --- ключи ---
+
+    def _storage_key(self, key):
+        """Ключ bot_data в хранилище: у локальных ключей суффикс процесса"""
+        return f"{key}@{self.worker_id}" if self.worker_id and key in LOCAL_BOT_DATA_KEYS else key
+
+    def _local_key(self, storage_key):
+        """Обратно к ключу bot_data; None - локальный ключ другого процесса"""
+        key, sep, worker = str(storage_key).rpartition('@')
+        if not sep or key not in LOCAL_BOT_DATA_KEYS: return storage_key
+        return key if worker == self.worker_id else None
+
+    def _foreign(self, table, key):
+        return table == 'bot_data' and self._local_key(key) is None
+
+    def _remember(self, table, key, blob, rev):
+        if blob is None:
+            self._written.setdefault(table, {}).pop(key, None)
+            self._revs.setdefault(table, {}).pop(key, None)
+        else:
+            self._written.setdefault(table, {})[key] = blob
+            self._revs.setdefault(table, {})[key] = rev
+
+    # --- перенос из pickle ---
+
+    async def _migrate_from_pickle(self, path):
+        """Однократный перенос данных из файла PicklePersistence"""
+        with open(path, 'rb') as f:
+            legacy = pickle.load(f)
+        await self._write_bot_data(legacy.get('bot_data') or {}, tracked=False)
+        for user_id, data in (legacy.get('user_data') or {}).items():
+            await self._write_session('user_data', user_id, data)
+        for chat_id, data in (legacy.get('chat_data') or {}).items():
+            await self._write_session('chat_data', chat_id, data)
+        for name, states in (legacy.get('conversations') or {}).items():
+            for key, state in states.items():
+                await self.backend.write_conversation(name, key, _dump(state))
+        if legacy.get('callback_data') is not None:
+            await self._write_session('meta', 'callback_data', legacy['callback_data'])
+        await self._write_session('meta', 'migrated_from', path)
+        logger.info(f"📦 Данные перенесены из {path} в хранилище")
+
+    # --- чтение ---
+
+    async def _load_table(self, table):
+        rows, _, rev = await self.backend.load(table)
+        self._synced[table] = rev
+        # Чужие локальные ключи не запоминаем, иначе сохранение примет их за удалённые
+        rows = {key: row for key, row in rows.items() if not self._foreign(table, key)}
+        for key, (blob, row_rev) in rows.items(): self._remember(table, key, blob, row_rev)
+        return {key: pickle.loads(blob) for key, (blob, _) in rows.items()}
+
+    async def get_bot_data(self):
+        if await self.backend.is_new() and self.legacy_pickle and os.path.exists(self.legacy_pickle):
+            # Процессы стартуют одновременно - переносит тот, кто первым взял блокировку
+            async with self.backend.lock('migrate'):
+                meta, _, _ = await self.backend.load('meta')
+                if 'migrated_from' not in meta: await self._migrate_from_pickle(self.legacy_pickle)
+            self._written.clear()
+            self._revs.clear()
+        data = {self._local_key(key): value for key, value in (await self._load_table('bot_data')).items()}
+        data['orders'] = await self._load_table('orders')
+        data['users'] = await self._load_table('users')
+        # Загруженные заказы совпадают с записанными - первое сохранение не пересериализует всю базу.
+        # Клиентов не отмечаем: get_users ещё переведёт записи старого формата
+        order_changes.ensure(data['orders']).take()
+        logger.info(f"📦 Загружено заказов: {len(data['orders'])}, клиентов: {len(data['users'])}")
+        return data
+
+    async def get_user_data(self):
+        return await self._load_table('user_data')
+
+    async def get_chat_data(self):
+        return await self._load_table('chat_data')
+
+    async def get_callback_data(self):
+        rows = await self._load_table('meta')
+        return rows.get('callback_data')
+
+    async def get_conversations(self, name):
+        rows = await self.backend.load_conversations(name)
+        return {key: pickle.loads(blob) for key, blob in rows.items()}
+
+    # --- запись ---
+
+    def _diff(self, table, mapping, columns=None, keys=None):
+        """Строки mapping, отличающиеся от известных, и исчезнувшие ключи.
+
+        keys - ключи, изменённые с прошлого сохранения (None - сравнить всё). Сериализация идёт
+        в event loop: обработчики меняют эти словари, и обходить их из потока нельзя"""
+        written = self._written.get(table, {})
+        name = str if table == 'orders' else (lambda key: key)  # ID заказов в хранилище - строки
+        rows, deleted = {}, []
+        for key in (mapping if keys is None else keys):
+            value = mapping.get(key)
+            if value is None:
+                if name(key) in written: deleted.append(name(key))
+                continue
+            blob = _dump(value)
+            if written.get(name(key)) != blob: rows[name(key)] = (blob, columns(value) if columns else {})
+        if keys is None:
+            present = {name(key) for key in mapping}
+            deleted = [key for key in written if key not in present]
+        return rows, deleted
+
+    async def _write(self, table, rows, deleted=()):
+        if not rows and not deleted: return 0
+        known = self._revs.get(table, {})
+        expected = {key: known.get(key, 0) for key in [*rows, *deleted]} if self.shared else None
+        rev, conflicts = await self.backend.write(table, rows, deleted, expected)
+        for key, (blob, _) in rows.items():
+            if key not in conflicts: self._remember(table, key, blob, rev)
+        for key in deleted:
+            if key not in conflicts: self._remember(table, key, None, rev)
+        if conflicts:
+            logger.warning(f"🔀 {table}: {len(conflicts)} строк уже изменены другим процессом, оставлена их версия")
+        return len(rows) + len(deleted) - len(conflicts)
+
+    async def _write_bot_data(self, data, tracked=True):
+        """tracked=False - data не из приложения (перенос из pickle), сравнивается целиком"""
+        # Все blob'ы готовятся до первого await: в поток уходят только байты
+        diffs, taken = [], []
+        for table, view, columns in (('orders', order_changes, _order_columns), ('users', customer_changes, None)):
+            live, keys, full = view.take() if tracked else (None, None, True)
+            if tracked: taken.append((view, keys, full))
+            # Заказы и клиентов берём из живого bot_data: копия PTB снята раньше и могла отстать от ключей
+            mapping = live if live is not None else data.get(table) or {}
+            diffs.append((table, self._diff(table, mapping, columns, None if full or live is None else keys)))
+        other = {self._storage_key(k): v for k, v in data.items() if k not in ('orders', 'users')}
+        diffs.append(('bot_data', self._diff('bot_data', other)))
+        changed = 0
+        try:
+            for table, (rows, deleted) in diffs:
+                changed += await self._write(table, rows, deleted)
+        except Exception:
+            # Запись не прошла - ключи вернутся в следующее сохранение
+            for view, keys, full in taken:
+                view.keys |= keys
+                view.full = view.full or full
+            raise
+        if changed:
+            logger.debug(f"📦 bot_data: записано строк {changed}")
+        return changed
+
+    async def _write_session(self, table, key, data):
+        # Пустые сессии не храним, чтобы хранилище росло только с активными пользователями
+        if data:
+            blob = _dump(data)
+            if self._written.get(table, {}).get(key) != blob: await self._write(table, {key: (blob, {})})
+        elif key in self._written.get(table, {}):
+            await self._write(table, {}, [key])
+
+    async def update_bot_data(self, data):
+        started = time.perf_counter()
+        # Состояние UpdateOffsets собирается к сохранению: в копии PTB оно могло устареть
+        offsets = update_offsets.snapshot()
+        if offsets is not None: data['update_offset'] = offsets
+        changed = await self._write_bot_data(data)
+        watchdog.mark('persistence_flush')
+        PERSISTENCE_SECONDS.observe(time.perf_counter() - started)
+        PERSISTENCE_ROWS.inc(amount=changed)
+
+    async def update_user_data(self, user_id, data):
+        # Сессию из одной метки активности не храним - это посетитель без черновика
+        if set(data) <= {'last_seen'}: data = None
+        await self._write_session('user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._write_session('chat_data', chat_id, data)
+
+    async def update_callback_data(self, data):
+        await self._write_session('meta', 'callback_data', data)
+
+    async def update_conversation(self, name, key, new_state):
+        await self.backend.write_conversation(name, key, None if new_state is None else _dump(new_state))
+
+    async def drop_user_data(self, user_id):
+        await self._write_session('user_data', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        await self._write_session('chat_data', chat_id, None)
+
+    async def archive_user_data(self, user_id, data):
+        """Откладывает брошенную сессию в session_archive перед удалением"""
+        await self.backend.append('session_archive', user_id=user_id, archived_at=datetime.now().isoformat(), data=_dump(data))
+
+    async def compact(self):
+        return await self.backend.compact()
+
+    # --- изменения других процессов ---
+
+    def _apply(self, bot_data, table, key, value):
+        """Применяет чужую версию строки к bot_data (value None - строка удалена)"""
+        if table == 'orders':
+            if value is not None or key in get_orders(bot_data): put_order(bot_data, key, value)
+        elif table == 'users':
+            if value is not None or key in get_users(bot_data): put_customer(bot_data, key, value)
+        else:
+            key = self._local_key(key)
+            if key is None: return
+            if value is None: bot_data.pop(key, None)
+            else: bot_data[key] = value
+
+    async def refresh_bot_data(self, bot_data):
+        # PTB вызывает refresh перед каждым обработчиком - чаще раза в SHARED_REFRESH_INTERVAL не ходим
+        if not self.shared or time.monotonic() - self._refreshed_at < SHARED_REFRESH_INTERVAL: return
+        self._refreshed_at = time.monotonic()
+        for table in ('orders', 'users', 'bot_data'):
+            rows, deleted, rev = await self.backend.load(table, self._synced.get(table, 0))
+            written = self._written.setdefault(table, {})
+            for key, (blob, row_rev) in rows.items():
+                if written.get(key) == blob or self._foreign(table, key): continue  # Наша же запись или чужой локальный ключ
+                self._remember(table, key, blob, row_rev)
+                self._apply(bot_data, table, key, pickle.loads(blob))
+            for key, row_rev in deleted.items():
+                if key not in written: continue
+                self._remember(table, key, None, row_rev)
+                self._apply(bot_data, table, key, None)
+            self._synced[table] = max(self._synced.get(table, 0), rev)
+
+    async def _refresh_session(self, table, key, data):
+        if not self.shared: return
+        blob, rev = await self.backend.load_row(table, key)
+        if blob == self._written.get(table, {}).get(key): return
+        self._remember(table, key, blob, rev)
+        data.clear()
+        if blob is not None: data.update(pickle.loads(blob))
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh_session('user_data', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh_session('chat_data', chat_id, chat_data)
+
+    # --- построчные операции для shared_rows ---
+
+    async def pull(self, bot_data, table, key):
+        """Подтягивает свежую версию одной строки orders/users"""
+        key = str(key) if table == 'orders' else key  # ID заказов в хранилище - строки
+        blob, rev = await self.backend.load_row(table, key)
+        if blob == self._written.get(table, {}).get(key): return
+        self._remember(table, key, blob, rev)
+        self._apply(bot_data, table, key, None if blob is None else pickle.loads(blob))
+
+    async def push(self, bot_data, table, key):
+        """Сразу записывает одну строку orders/users или ключ bot_data, не дожидаясь периодического сохранения"""
+        if table == 'bot_data':
+            value, key = bot_data.get(key), self._storage_key(key)
+        else:
+            mapping = get_orders(bot_data) if table == 'orders' else get_users(bot_data)
+            value = mapping.get(key)
+            key = str(key) if table == 'orders' else key
+        if value is not None:
+            rows, deleted = {key: (_dump(value), _order_columns(value) if table == 'orders' else {})}, ()
+            if self._written.get(table, {}).get(key) == rows[key][0]: return
+        else:
+            rows, deleted = {}, [key] if key in self._written.get(table, {}) else []
+        await self._write(table, rows, deleted)
+
+    async def flush(self):
+        await self.backend.close()
+
+@contextlib.asynccontextmanager
+async def shared_rows(application, *rows):
+    """Согласованное изменение строк orders/users, когда процессов несколько.
+
+    Блокирует ключи во всём хранилище, подтягивает их свежие версии, а после блока
+    сразу записывает. С одним процессом просто выполняет блок."""
+    persistence = application.persistence
+    if not getattr(persistence, 'shared', False):
+        yield
+        return
+    async with contextlib.AsyncExitStack() as stack:
+        # Один порядок захвата во всех процессах - без взаимных блокировок
+        for table, key in sorted(rows, key=str):
+            await stack.enter_async_context(persistence.backend.lock(f"{table}:{key}"))
+        for table, key in rows: await persistence.pull(application.bot_data, table, key)
+        yield
+        for table, key in rows: await persistence.push(application.bot_data, table, key)
+
+async def flush_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сессия пишется сразу после обработки: следующее сообщение может попасть в другой процесс"""
+    if update.effective_user and context.user_data is not None:
+        await context.application.persistence.update_user_data(update.effective_user.id, context.user_data)
+    if update.effective_chat and context.chat_data is not None:
+        await context.application.persistence.update_chat_data(update.effective_chat.id, context.chat_data)
+
+# === ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ===
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Разные пользователи обрабатываются параллельно, обновления одного чата - строго по очереди"""
+
+    def __init__(self, max_concurrent_updates, backlog):
+        self._workers_limit = max_concurrent_updates
+        # Базовый семафор ограничивает число принятых в работу обновлений (включая ждущих свой чат),
+        # собственный - число одновременно выполняемых обработчиков
+        super().__init__(max(backlog, max_concurrent_updates))
+        self._workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}  # ключ чата -> [Lock, сколько задач его держит или ждёт]
+        self._tasks = set()  # Задачи обработки в работе - для отмены при аварийной остановке
+        self.shared_lock = None  # backend.lock, когда процессов несколько: чат занят во всех сразу
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def max_concurrent_updates(self):
+        return self._workers_limit
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update): return None
+        if update.effective_chat: return update.effective_chat.id
+        if update.effective_user: return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        cancelled = False
+        try:
+            await self._process_in_order(update, coroutine)
+        except asyncio.CancelledError:
+            # Прервано остановкой - обновление остаётся в backlog и обработается после запуска
+            cancelled = True
+            coroutine.close()
+            raise
+        finally:
+            self._tasks.discard(task)
+            if isinstance(update, Update) and not cancelled:
+                update_offsets.processed(update.update_id)
+                watchdog.mark('update_processed')
+
+    async def cancel_pending(self):
+        """Отменяет и дожидается обработчиков, не успевших завершиться"""
+        tasks = [task for task in self._tasks if not task.done()]
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _process_in_order(self, update, coroutine):
+        received = time.monotonic()
+        key = self._key(update)
+        if key is None:
+            async with self._workers:
+                self._record_wait(update, received)
+                await coroutine
+            return
+
+        slot = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            async with slot[0], self._workers:
+                self._record_wait(update, received)
+                async with self._chat_lock(key):
+                    await coroutine
+        finally:
+            slot[1] -= 1
+            if not slot[1]: self._locks.pop(key, None)
+
+    @contextlib.asynccontextmanager
+    async def _chat_lock(self, key):
+        if self.shared_lock is None:
+            yield
+            return
+        async with self.shared_lock(f"chat:{key}"):
+            yield
+
+    def _record_wait(self, update, received):
+        waited = time.monotonic() - received
+        QUEUE_WAIT_SECONDS.observe(waited)
+        self.wait_count += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        if waited > SLOW_QUEUE_WAIT:
+            logger.warning(f"⏳ Обновление {getattr(update, 'update_id', '?')} ждало в очереди {waited:.2f} с")
+
+    def wait_stats(self):
+        return {
+            'count': self.wait_count,
+            'avg': self.wait_total / self.wait_count if self.wait_count else 0.0,
+            'max': self.wait_max,
+            'active_chats': len(self._locks),
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# === СМЕЩЕНИЕ ОБНОВЛЕНИЙ ===
+
+class UpdateOffsets:
+    """Какие обновления уже обработаны, с сохранением в bot_data['update_offset'].
+
+    Telegram считает обновление доставленным, как только бот его забрал, поэтому принятые,
+    но не обработанные обновления храним сами (backlog) и после рестарта обрабатываем заново.
+    Всё до offset и из done уже обработано - такие повторы отбрасываются.
+    Снимок для хранилища собирается только при сохранении (snapshot), а не на каждое обновление."""
+
+    def __init__(self):
+        self.pending = {}  # update_id -> обновление в виде dict, пока не обработано
+        self.done = set()  # Обработаны, но выше offset (обновления разных чатов завершаются не по порядку)
+        self.max_done = 0
+        self.restored = None  # (offset, done) прошлого запуска
+        self._bot_data = None
+        self._dirty = False
+
+    def attach(self, bot_data):
+        """Подхватывает состояние прошлого запуска и возвращает backlog для повторной обработки"""
+        self._bot_data = bot_data
+        state = bot_data.get('update_offset')
+        if not state: return []
+        if time.time() - state['saved_at'] < UPDATE_OFFSET_MAX_AGE:
+            self.restored = (state['offset'], set(state['done']))
+            self.max_done = max(self.max_done, state['offset'])
+        return state['backlog']
+
+    def accept(self, update):
+        """Регистрирует принятое обновление. False - это повтор, обрабатывать не нужно"""
+        update_id = update.update_id
+        if update_id in self.pending or update_id in self.done or update_id <= self.offset(): return False
+        if self.restored and (update_id <= self.restored[0] or update_id in self.restored[1]): return False
+        self.pending[update_id] = update.to_dict()
+        self._dirty = True
+        return True
+
+    def processed(self, update_id):
+        if self.pending.pop(update_id, None) is None: return
+        self.done.add(update_id)  # Всё, что не выше offset, отсекает accept - done чистит snapshot
+        self.max_done = max(self.max_done, update_id)
+        self._dirty = True
+
+    def offset(self):
+        """Все обновления с update_id не больше этого обработаны"""
+        return min(self.pending) - 1 if self.pending else self.max_done
+
+    def snapshot(self):
+        """Кладёт текущее состояние в bot_data['update_offset'] и возвращает его (None - не подключены)"""
+        if self._bot_data is None: return None
+        if self._dirty or 'update_offset' not in self._bot_data:
+            offset = self.offset()
+            self.done = {i for i in self.done if i > offset}
+            self._bot_data['update_offset'] = {
+                'offset': offset,
+                'done': sorted(self.done),
+                'backlog': list(self.pending.values()),
+                'saved_at': time.time(),
+            }
+            self._dirty = False
+        return self._bot_data['update_offset']
+
+update_offsets = UpdateOffsets()
+
+class TrackingUpdateQueue(asyncio.Queue):
+    """update_queue приложения: регистрирует обновления от polling, webhook и backlog и отсекает повторы"""
+
+    def put_nowait(self, item):
+        if isinstance(item, Update) and not update_offsets.accept(item):
+            logger.info(f"⏭ Обновление {item.update_id} уже обработано, пропускаем")
+            return
+        super().put_nowait(item)
+        if isinstance(item, Update): watchdog.mark('update_received')
+
+# === BOT API ===
+
+class MessageTracker:
+    """Кольцевые буферы ID сообщений в админских чатах и канале, чтобы /clean удалял только реальные сообщения"""
+
+    def __init__(self, chat_ids, limit):
+        self.chat_ids = set(chat_ids)
+        self.limit = limit
+        self._ids = {}  # chat_id -> deque(message_id)
+
+    def track(self, chat_id, message_id):
+        if chat_id not in self.chat_ids: return
+        self._ids.setdefault(chat_id, collections.deque(maxlen=self.limit)).append(message_id)
+
+    def track_result(self, result):
+        """Запоминает сообщения из ответа Bot API (send_message, send_media_group, ...)"""
+        for item in result if isinstance(result, list) else [result]:
+            if isinstance(item, dict) and 'message_id' in item and 'chat' in item:
+                self.track(item['chat']['id'], item['message_id'])
+
+    def latest(self, chat_id, count):
+        if count <= 0: return []  # [-0:] - это весь буфер
+        return list(self._ids.get(chat_id, ()))[-count:]
+
+    def forget(self, chat_id, message_ids):
+        ids = self._ids.get(chat_id)
+        if not ids: return
+        drop = set(message_ids)
+        self._ids[chat_id] = collections.deque((mid for mid in ids if mid not in drop), maxlen=self.limit)
+
+message_tracker = MessageTracker([ADMIN_CHANNEL_ID, *ADMIN_IDS], CLEAN_TRACK_LIMIT)
+
+class RateLimiter:
+    """Не больше rate вызовов за period секунд (скользящее окно)"""
+
+    def __init__(self, rate, period):
+        self.rate = rate
+        self.period = period
+        self._calls = collections.deque()
+        self._lock = None  # Создаётся в работающем event loop (Python 3.9)
+
+    async def acquire(self):
+        if self._lock is None: self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and self._calls[0] <= now - self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.rate: break
+                await asyncio.sleep(self._calls[0] + self.period - now)
+            self._calls.append(time.monotonic())
+
+class ChatRateLimiter:
+    """Общий лимит rate сообщений в секунду и не чаще одного сообщения в chat_interval в один чат.
+
+    После RetryAfter pause() останавливает все отправки через лимитер: флуд-контроль Telegram общий на бота."""
+
+    def __init__(self, rate, chat_interval):
+        self.total = RateLimiter(rate, 1)
+        self.chat_interval = chat_interval
+        self._last = {}  # chat_id -> monotonic последней отправки
+        self._resume_at = 0.0
+
+    def pause(self, seconds):
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id, cost=1):
+        while True:
+            wait = max(self._resume_at, self._last.get(chat_id, 0.0) + self.chat_interval) - time.monotonic()
+            if wait <= 0: break
+            await asyncio.sleep(wait)
+        for _ in range(cost): await self.total.acquire()
+        now = time.monotonic()
+        self._last[chat_id] = now
+        if len(self._last) > 1000:
+            self._last = {cid: at for cid, at in self._last.items() if at > now - self.chat_interval}
+
+class AppBot(ExtBot):
+    """ExtBot с перехватом всех вызовов Bot API"""
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        method = api_method_name(endpoint)
+        started = time.perf_counter()
+        try:
+            result = await super()._do_post(endpoint, data, **kwargs)
+        except TelegramError as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            API_SECONDS.observe(elapsed, method)
+            add_update_timing('api', elapsed)
+        watchdog.mark('api_success')
+        if endpoint.startswith('send') or endpoint in ('copyMessage', 'forwardMessage'):
+            message_tracker.track_result(result)
+        return result
+
+async def track_incoming_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запоминает входящие сообщения админских чатов и канала (группа -1, до основных обработчиков)"""
+    msg = update.effective_message
+    if msg and msg.chat:
+        message_tracker.track(msg.chat.id, msg.message_id)
+        remember_admin_album(msg)
+
+# === БРОШЕННЫЕ СЕССИИ ===
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Метка последней активности пользователя в user_data (группа -2)"""
+    if not update.effective_user: return
+    now = int(time.time())
+    if now - context.user_data.get('last_seen', 0) >= SESSION_TOUCH_INTERVAL:
+        context.user_data['last_seen'] = now
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет сессии, неактивные дольше SESSION_TTL; брошенные проекты уходят в архив.
+    После удаления сжимает базу, чтобы её размер зависел от активных пользователей, а не от всех посетителей"""
+    application = context.application
+    persistence = application.persistence
+    now = time.time()
+    counts = collections.Counter()
+
+    for user_id, data in list(application.user_data.items()):
+        if data and 'last_seen' not in data:
+            # Сессия из старой версии бота: отсчёт неактивности начинаем с этого прохода
+            data['last_seen'] = int(now)
+            continue
+        # Пустые сессии остаются от каждого посетителя и в базу не пишутся - держим их недолго
+        empty = not set(data) - {'last_seen'}
+        if now - data.get('last_seen', 0) < (SESSION_SWEEP_INTERVAL if empty else SESSION_TTL): continue
+
+        if empty:
+            counts['empty'] += 1
+        elif SESSION_ARCHIVE and data.get('order_data') and hasattr(persistence, 'archive_user_data'):
+            await persistence.archive_user_data(user_id, dict(data))
+            counts['archived'] += 1
+        else:
+            counts['dropped'] += 1
+        application.drop_user_data(user_id)
+
+    for action, count in counts.items(): SESSIONS_EVICTED.inc(action, amount=count)
+    if not counts['dropped'] and not counts['archived']: return
+
+    reclaimed = 0
+    if hasattr(persistence, 'compact'):
+        await application.update_persistence()  # drop_user_data удаляет строки из базы только при сохранении
+        reclaimed = await persistence.compact()
+        STORAGE_RECLAIMED.inc(amount=max(reclaimed, 0))
+    logger.info(
+        f"🧹 Сессии: удалено {counts['dropped']}, в архив {counts['archived']}, пустых {counts['empty']}, "
+        f"осталось {len(application.user_data)}, база сжата на {reclaimed / 1024:.0f} КБ"
+    )
+
+# === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
+
+async def get_main_keyboard():
+    web_app_url = "https://kovka007.vercel.app"
+    return ReplyKeyboardMarkup([
+        [KeyboardButton("🏗 Открыть конструктор", web_app=WebAppInfo(url=web_app_url))],
+        [KeyboardButton("📄 Мой заказ"), KeyboardButton("✏️ Добавить пожелания/фото")],
+        [KeyboardButton("📚 Как пользоваться"), KeyboardButton("📞 Отправить телефон и оформить", request_contact=True)]
+    ], resize_keyboard=True)
+
+class SubscriptionCache:
+    """Кэш проверок подписки на INFO_CHANNEL_ID с раздельным TTL для да/нет.
+
+    Истёкшая запись удаляется при обращении, а сверх max_size вытесняются давно не спрашивавшие (LRU)"""
+
+    def __init__(self, ttl, negative_ttl, max_size=SUB_CACHE_MAX):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # user_id -> (подписан, истекает_в), от давних к недавним
+        self._inflight = {}  # user_id -> Task с запросом get_chat_member
+        self._generations = {}  # user_id -> сколько раз invalidate сбросил запрос в полёте
+
+    async def is_subscribed(self, bot, user_id):
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+        if entry: del self._entries[user_id]
+
+        # Параллельные проверки одного пользователя ждут один и тот же запрос
+        task = self._inflight.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(bot, user_id, self._generations.get(user_id, 0)))
+            self._inflight[user_id] = task
+            task.add_done_callback(functools.partial(self._fetched, user_id))
+        else:
+            self.hits += 1
+        return await asyncio.shield(task)
+
+    def _fetched(self, user_id, task):
+        if self._inflight.get(user_id) is task: del self._inflight[user_id]
+        if user_id not in self._inflight: self._generations.pop(user_id, None)
+
+    async def _fetch(self, bot, user_id, generation):
+        member = await bot.get_chat_member(chat_id=INFO_CHANNEL_ID, user_id=user_id)
+        subscribed = member.status not in ['left', 'kicked', 'restricted']
+        # Пока шёл запрос, пришёл chat_member - ответ мог устареть, в кэш его не кладём
+        if self._generations.get(user_id, 0) != generation: return subscribed
+        ttl = self.ttl if subscribed else self.negative_ttl
+        self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size: self._entries.popitem(last=False)
+        return subscribed
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+        if user_id in self._inflight:
+            # Следующая проверка спросит Telegram заново, а не дождётся устаревшего запроса
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            del self._inflight[user_id]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._entries),
+        }
+
+subscription_cache = SubscriptionCache(SUB_CACHE_TTL, SUB_CACHE_NEGATIVE_TTL)
+
+def is_admin(update):
+    """Команду дал администратор: админ из ADMIN_IDS или пост в админ-канале.
+
+    У постов каналов нет effective_user, поэтому без автора пропускаем только ADMIN_CHANNEL_ID -
+    бота могут добавить в любой чужой канал."""
+    if update.effective_user: return update.effective_user.id in ADMIN_IDS
+    return bool(update.channel_post and update.effective_chat and update.effective_chat.id == ADMIN_CHANNEL_ID)
+
+async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user: return True
+    if update.effective_user.id in ADMIN_IDS: return True
+    try:
+        return await subscription_cache.is_subscribed(context.bot, update.effective_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка проверки подписки: {e}")
+        return True
+
+async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сбрасывает кэш подписки, как только пользователь вступил в канал или покинул его"""
+    cmu = update.chat_member
+    if cmu.chat.id != INFO_CHANNEL_ID: return
+    subscription_cache.invalidate(cmu.new_chat_member.user.id)
+
+async def ask_subscription(update: Update):
+    kb = [[InlineKeyboardButton("📢 Подписаться", url=INFO_CHANNEL_LINK)], [InlineKeyboardButton("✅ Я подписался", callback_data="check_sub")]]
+    await update.message.reply_text("🚫 <b>Доступ ограничен!</b>\nПодпишитесь на канал.", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+
+def format_order_message(order, user_name, user_link, phone, comment, status_code=1, for_admin=True):
+    rtype = ROOF_TYPES.get(order.get('type'), order.get('type'))
+    mat = MATERIALS.get(order.get('material'), order.get('material'))
+    paint = PAINTS.get(order.get('paint'), order.get('paint'))
+
+    opts = order.get('opts', {})
+    opt_list = []
+    if opts.get('trusses'): opt_list.append("✅ Усил. фермы")
+    if opts.get('gutters'): opt_list.append("✅ Водостоки")
+    if opts.get('walls'): opt_list.append("✅ Зашивка")
+    if opts.get('found'): opt_list.append("✅ Фундамент")
+    if opts.get('install'): opt_list.append("✅ Монтаж")
+    opt_str = "\n".join(opt_list) if opt_list else "Базовая"
+
+    header = f"🚨 <b>НОВАЯ ЗАЯВКА!</b>\nСтатус: {STATUS_MAP.get(status_code, '?')}" if for_admin else "📋 <b>ВАШ ЗАКАЗ:</b>"
+
+    user_info = (
+        f"👤 <b>Клиент:</b> {user_name}\n"
+        f"🔗 <b>Link:</b> {user_link}\n"
+        f"📞 <b>Phone:</b> <code>{phone}</code>\n"
+        f"💬 <b>Пожелания:</b> {comment}\n"
+    ) if for_admin else ""
+
+    return (
+        f"{header}\n"
+        f"➖➖➖➖➖➖➖➖➖➖\n"
+        f"{user_info if for_admin else ''}"
+        f"🆔 <b>ID:</b> <code>{order.get('id')}</code>\n"
+        f"🏗 <b>Тип:</b> {rtype}\n"
+        f"📏 <b>Длина:</b> {order.get('length')} м\n"
+        f"📏 <b>Ширина:</b> {order.get('width')} м\n"
+        f"↕️ <b>Высота (столб):</b> {order.get('height')} м\n"
+        f"🏔 <b>Высота (общ):</b> ~{order.get('height_peak')} м\n"
+        f"📐 <b>Уклон:</b> {order.get('slope')}°\n"
+        f"🧱 <b>Сечение:</b> {order.get('pillar')}\n"
+        f"➖➖➖➖➖➖➖➖➖➖\n"
+        f"🔲 <b>S пола:</b> {order.get('area_floor')} м²\n"
+        f"🏠 <b>S кровли:</b> {order.get('area_roof')} м²\n"
+        f"🏠 <b>Материал:</b> {mat}\n"
+        f"🎨 <b>Покраска:</b> {paint}\n"
+        f"🖌 <b>Цвет:</b> {order.get('color_frame')} / {order.get('color_roof')}\n"
+        f"➖➖➖➖➖➖➖➖➖➖\n"
+        f"🛠 <b>Опции:</b>\n{opt_str}\n"
+        f"➖➖➖➖➖➖➖➖➖➖\n"
+        f"💰 <b>ИТОГО: {order.get('price', 0):,} руб.</b>"
+    )
+
+# === ИНДЕКСЫ ЗАКАЗОВ ===
+
+ORDER_PAGE_SIZE = 10
+
+class DerivedView:
+    """Производная структура над словарём из bot_data (заказы, клиенты), которая обновляется вместе с ним.
+
+    Если словарь подменили целиком (/order clean, загрузка из хранилища),
+    представление перестраивается при следующем обращении."""
+
+    def __init__(self):
+        self._source = None
+        self.reset()
+
+    def ensure(self, source):
+        if self._source is not source:
+            self.reset()
+            for key, info in source.items(): self.add(key, info)
+            self._source = source
+        return self
+
+    def reset(self):
+        raise NotImplementedError
+
+    def add(self, key, info):
+        raise NotImplementedError
+
+    def remove(self, key, info):
+        raise NotImplementedError
+
+def _discard_sorted(items, key):
+    i = bisect.bisect_left(items, key)
+    if i < len(items) and items[i] == key: del items[i]
+
+class OrderIndex(DerivedView):
+    """Вторичные индексы заказов: по времени, по статусу и по клиенту"""
+
+    def reset(self):
+        self.by_time = []  # [(timestamp, oid)] по возрастанию
+        self.by_status = {}  # статус -> [(timestamp, oid)]
+        self.by_user = {}  # user_id -> {oid}
+
+    @staticmethod
+    def _key(oid, info):
+        return (info.get('timestamp') or '', oid)
+
+    def add(self, oid, info):
+        key = self._key(oid, info)
+        bisect.insort(self.by_time, key)
+        bisect.insort(self.by_status.setdefault(info.get('status', 1), []), key)
+        user_id = (info.get('user') or {}).get('user_id')
+        if user_id is not None: self.by_user.setdefault(user_id, set()).add(oid)
+
+    def remove(self, oid, info):
+        key = self._key(oid, info)
+        _discard_sorted(self.by_time, key)
+        _discard_sorted(self.by_status.get(info.get('status', 1), []), key)
+        user_id = (info.get('user') or {}).get('user_id')
+        if user_id in self.by_user:
+            self.by_user[user_id].discard(oid)
+            if not self.by_user[user_id]: del self.by_user[user_id]
+
+    def page(self, status=None, offset=0, limit=ORDER_PAGE_SIZE):
+        """ID заказов от новых к старым и общее число заказов под фильтром"""
+        keys = self.by_time if status is None else self.by_status.get(status, [])
+        end = max(len(keys) - offset, 0)
+        return [oid for _, oid in reversed(keys[max(end - limit, 0):end])], len(keys)
+
+    def count_for_user(self, user_id):
+        return len(self.by_user.get(user_id, ()))
+
+class ChangedKeys(DerivedView):
+    """Ключи, изменённые через put_order/put_customer с последнего сохранения в хранилище.
+
+    Привязан к живому bot_data приложения: PTB отдаёт persistence глубокую копию,
+    у которой каждый раз новая identity"""
+
+    def reset(self):
+        self.keys = set()
+        self.full = True  # Словарь подменён целиком - сохранение сравнит его со всем записанным
+
+    def add(self, key, info):
+        self.keys.add(key)
+
+    def remove(self, key, info):
+        self.keys.add(key)
+
+    def take(self):
+        """Забирает накопленные ключи: (живой словарь или None, ключи, нужно ли сравнить его целиком)"""
+        keys, full = self.keys, self.full
+        self.keys, self.full = set(), False
+        return self._source, keys, full
+
+order_index = OrderIndex()
+order_changes = ChangedKeys()
+ORDER_VIEWS = [order_index, order_changes]
+
+def get_orders(bot_data):
+    """bot_data['orders'] с актуальными индексами"""
+    orders = bot_data.setdefault('orders', {})
+    for view in ORDER_VIEWS: view.ensure(orders)
+    return orders
+
+def put_order(bot_data, oid, info):
+    """Единая точка записи заказа: словарь и все индексы меняются вместе (info None - удаление)"""
+    orders = get_orders(bot_data)
+    mark_backup_dirty(bot_data, 'orders', oid)
+    old = orders.pop(oid, None) if info is None else orders.get(oid)
+    if old is not None:
+        for view in ORDER_VIEWS: view.remove(oid, old)
+    if info is None: return
+    orders[oid] = info
+    for view in ORDER_VIEWS: view.add(oid, info)
+
+def set_order_status(bot_data, oid, status):
+    put_order(bot_data, oid, {**get_orders(bot_data)[oid], 'status': status})
+
+# === КЛИЕНТЫ ===
+
+CUSTOMER_PAGE_SIZE = 15
+LEGACY_CUSTOMER_RE = re.compile(r'^(?P<name>.*) \(@(?P<username>.*)\) - (?P<phone>.*)$')
+
+class CustomerIndex(DerivedView):
+    """Клиенты, отсортированные по времени последнего заказа"""
+
+    def reset(self):
+        self.by_last_order = []  # [(last_order_at, user_id)] по возрастанию
+
+    @staticmethod
+    def _key(user_id, info):
+        return (info.get('last_order_at') or '', user_id)
+
+    def add(self, user_id, info):
+        bisect.insort(self.by_last_order, self._key(user_id, info))
+
+    def remove(self, user_id, info):
+        _discard_sorted(self.by_last_order, self._key(user_id, info))
+
+    def page(self, cursor=None, direction='older', limit=CUSTOMER_PAGE_SIZE):
+        """Страница от новых к старым относительно курсора (last_order_at, user_id).
+
+        Возвращает (ключи страницы, есть ли старее, есть ли новее)."""
+        keys = self.by_last_order
+        if direction == 'newer':
+            start = bisect.bisect_right(keys, cursor)
+            end = min(start + limit, len(keys))
+            start = max(end - limit, 0)
+        else:
+            end = bisect.bisect_left(keys, cursor) if cursor else len(keys)
+            start = max(end - limit, 0)
+        return list(reversed(keys[start:end])), start > 0, end < len(keys)
+
+customer_index = CustomerIndex()
+customer_changes = ChangedKeys()
+CUSTOMER_VIEWS = [customer_index, customer_changes]
+
+def _legacy_customer(user_id, line, bot_data):
+    """Строка старого формата 'Имя (@username) - телефон' -> запись клиента"""
+    match = LEGACY_CUSTOMER_RE.match(line)
+    fields = match.groupdict() if match else {'name': line, 'username': None, 'phone': ''}
+    if fields['username'] == 'None': fields['username'] = None
+    orders = get_orders(bot_data)
+    stamps = sorted(orders[oid].get('timestamp') or '' for oid in order_index.by_user.get(user_id, ()))
+    return {
+        'user_id': user_id,
+        **fields,
+        'first_order_at': stamps[0] if stamps else None,
+        'last_order_at': stamps[-1] if stamps else None,
+    }
+
+def get_users(bot_data):
+    """bot_data['users'] со структурированными записями и актуальным индексом"""
+    get_orders(bot_data)  # Счётчики заказов клиента берутся из order_index
+    users = bot_data.setdefault('users', {})
+    if customer_index._source is not users:
+        for user_id, info in list(users.items()):
+            if isinstance(info, str): users[user_id] = _legacy_customer(user_id, info, bot_data)
+    for view in CUSTOMER_VIEWS: view.ensure(users)
+    return users
+
+def put_customer(bot_data, user_id, info):
+    users = get_users(bot_data)
+    mark_backup_dirty(bot_data, 'users', user_id)
+    old = users.pop(user_id, None) if info is None else users.get(user_id)
+    if old is not None:
+        for view in CUSTOMER_VIEWS: view.remove(user_id, old)
+    if info is None: return
+    users[user_id] = info
+    for view in CUSTOMER_VIEWS: view.add(user_id, info)
+
+def render_customer_page(bot_data, cursor=None, direction='older'):
+    """Страница клиентов с листанием по курсору (callback buyers:<o|n>:<last_order_at>:<user_id>)"""
+    users = get_users(bot_data)
+    keys, has_older, has_newer = customer_index.page(cursor, direction)
+    text = f"👥 <b>КЛИЕНТЫ</b> ({len(users)}):\n"
+    for _, user_id in keys:
+        text += format_customer_line(users[user_id]) + "\n"
+    if not keys: text += "📭 Пусто."
+
+    nav_row = []
+    if has_older:
+        ts, uid = keys[-1]
+        nav_row.append(InlineKeyboardButton("◀️ Раньше", callback_data=f"buyers:o:{ts}:{uid}"))
+    if has_newer:
+        ts, uid = keys[0]
+        nav_row.append(InlineKeyboardButton("Позже ▶️", callback_data=f"buyers:n:{ts}:{uid}"))
+    return text, InlineKeyboardMarkup([nav_row]) if nav_row else None
+
+def format_customer_line(info):
+    username = f" (@{info['username']})" if info.get('username') else ""
+    last = (info.get('last_order_at') or '—')[:10]
+    orders_count = order_index.count_for_user(info['user_id'])
+    return f"👤 {html.escape(info.get('name') or '')}{username} — <code>{info.get('phone')}</code> | 📦 {orders_count} | {last}"
+
+# === ПОИСК ===
+
+FIND_PAGE_SIZE = 10
+SEARCH_WORD_RE = re.compile(r'[\w@-]+')
+PHONE_QUERY_RE = re.compile(r'[\d\s+()-]{4,}')
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+
+def normalize_phone(value):
+    """Цифры телефона; российский номер с 8 в начале приводится к 7"""
+    digits = re.sub(r'\D', '', str(value or ''))
+    return '7' + digits[1:] if len(digits) == 11 and digits[0] == '8' else digits
+
+def _trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+def _prefix_range(items, prefix):
+    """Элементы (строка, ключ) отсортированного списка, у которых строка начинается с prefix"""
+    start = bisect.bisect_left(items, (prefix,))
+    end = bisect.bisect_left(items, (prefix + '\uffff',))
+    return items[start:end]
+
+class SearchIndex(DerivedView):
+    """Полнотекстовый индекс для /find и /buyer.
+
+    fields(key, info) -> (телефон, имена, прочий текст). По ID ищется префикс, по телефону - префикс
+    или окончание номера, по словам имён - слово целиком или его начало, по тексту (пожелания) -
+    слово или начало слова. Слово, которое так не нашлось, ищется по триграммам имён (опечатки)."""
+
+    TRIGRAM_MIN_SHARE = 0.6  # Доля общих триграмм, при которой имя считается похожим
+
+    def __init__(self, fields):
+        self.fields = fields
+        super().__init__()
+
+    def reset(self):
+        self.sorted = {
+            'ids': [],  # [(ID в нижнем регистре, ключ)]
+            'phones': [],  # [(цифры, ключ)]
+            'phones_reversed': [],  # [(цифры задом наперёд, ключ)] - поиск по последним цифрам
+            'tokens': [],  # [(слово,)] - поиск по началу слова
+        }
+        self.tokens = {}  # слово -> {ключ: вес}
+        self.trigrams = {}  # триграмма -> {ключ}
+        self._bulk = False
+
+    def ensure(self, source):
+        # Полная перестройка: списки заполняются без insort и сортируются один раз
+        if self._source is not source:
+            self._bulk = True
+            try:
+                super().ensure(source)
+            finally:
+                self._bulk = False
+                for items in self.sorted.values(): items.sort()
+        return self
+
+    def _entry(self, key, info):
+        phone, names, text = self.fields(key, info)
+        phone = normalize_phone(phone)
+        name_tokens = set(SEARCH_TOKEN_RE.findall(' '.join(filter(None, names)).lower()))
+        text_tokens = set(SEARCH_TOKEN_RE.findall((text or '').lower())) - name_tokens
+        return str(key).lower(), phone, name_tokens, text_tokens
+
+    def _insert(self, name, item):
+        if self._bulk: self.sorted[name].append(item)
+        else: bisect.insort(self.sorted[name], item)
+
+    def add(self, key, info):
+        id_key, phone, name_tokens, text_tokens = self._entry(key, info)
+        self._insert('ids', (id_key, key))
+        if phone:
+            self._insert('phones', (phone, key))
+            self._insert('phones_reversed', (phone[::-1], key))
+        for token, weight in [(t, 2) for t in name_tokens] + [(t, 1) for t in text_tokens]:
+            postings = self.tokens.get(token)
+            if postings is None:
+                postings = self.tokens[token] = {}
+                self._insert('tokens', (token,))
+            postings[key] = weight
+        for token in name_tokens:
+            for gram in _trigrams(token): self.trigrams.setdefault(gram, set()).add(key)
+
+    def remove(self, key, info):
+        # info - прежняя версия записи, по ней восстанавливаем, что было проиндексировано
+        id_key, phone, name_tokens, text_tokens = self._entry(key, info)
+        _discard_sorted(self.sorted['ids'], (id_key, key))
+        if phone:
+            _discard_sorted(self.sorted['phones'], (phone, key))
+            _discard_sorted(self.sorted['phones_reversed'], (phone[::-1], key))
+        for token in name_tokens | text_tokens:
+            postings = self.tokens.get(token)
+            if postings is None: continue
+            postings.pop(key, None)
+            if not postings:
+                del self.tokens[token]
+                _discard_sorted(self.sorted['tokens'], (token,))
+        for token in name_tokens:
+            for gram in _trigrams(token):
+                keys = self.trigrams.get(gram)
+                if keys is None: continue
+                keys.discard(key)
+                if not keys: del self.trigrams[gram]
+
+    def _match_word(self, word):
+        """{ключ: очки} для одного слова запроса"""
+        scores = collections.defaultdict(float)
+        for id_key, key in _prefix_range(self.sorted['ids'], word):
+            scores[key] = max(scores[key], 100 if id_key == word else 80)
+
+        if word.isdigit() and len(word) >= 4:
+            digits = normalize_phone(word)
+            # Номер без кода страны: 927... ищем и как 7927...
+            for prefix in {digits, '7' + digits} if len(digits) <= 10 else {digits}:
+                for phone, key in _prefix_range(self.sorted['phones'], prefix):
+                    scores[key] = max(scores[key], 90 if phone == prefix else 70)
+            for _, key in _prefix_range(self.sorted['phones_reversed'], digits[::-1]):
+                scores[key] = max(scores[key], 60)
+
+        word = word.lstrip('@')
+        for key, weight in self.tokens.get(word, {}).items():
+            scores[key] = max(scores[key], 25 * weight)
+        if len(word) >= 2:
+            for (token,) in _prefix_range(self.sorted['tokens'], word):
+                if token == word: continue
+                for key, weight in self.tokens[token].items(): scores[key] = max(scores[key], 12 * weight)
+
+        # Опечатки в имени: только если слово не нашлось точнее
+        grams = _trigrams(word)
+        if not scores and len(grams) >= 2:
+            hits = collections.Counter()
+            for gram in grams: hits.update(self.trigrams.get(gram, ()))
+            for key, count in hits.items():
+                share = count / len(grams)
+                if share >= self.TRIGRAM_MIN_SHARE: scores[key] = 10 * share
+        return scores
+
+    def search(self, query):
+        """{ключ: очки}; каждое слово запроса должно найтись"""
+        query = query.lower().strip()
+        # Телефон с пробелами и скобками - одно слово
+        words = [re.sub(r'\D', '', query)] if PHONE_QUERY_RE.fullmatch(query) else SEARCH_WORD_RE.findall(query)
+        total = {}
+        for i, word in enumerate(words):
+            scores = self._match_word(word)
+            total = dict(scores) if i == 0 else {key: score + scores[key] for key, score in total.items() if key in scores}
+            if not total: break
+        return total
+
+def _order_search_fields(oid, info):
+    user = info.get('user') or {}
+    return user.get('phone'), (user.get('name'), user.get('username')), info.get('comment')
+
+def _customer_search_fields(user_id, info):
+    return info.get('phone'), (info.get('name'), info.get('username')), None
+
+order_search = SearchIndex(_order_search_fields)
+ORDER_VIEWS.append(order_search)
+customer_search = SearchIndex(_customer_search_fields)
+CUSTOMER_VIEWS.append(customer_search)
+
+def search_orders(bot_data, query):
+    """ID заказов по запросу: сначала лучшие совпадения, при равных очках - новые"""
+    orders = get_orders(bot_data)
+    scores = order_search.search(query)
+    # Сортировка устойчива: сначала по времени, затем по очкам
+    found = sorted(scores, key=lambda oid: orders[oid].get('timestamp') or '', reverse=True)
+    found.sort(key=lambda oid: -scores[oid])
+    return found
+
+def search_customers(bot_data, query):
+    users = get_users(bot_data)
+    scores = customer_search.search(query)
+    found = sorted(scores, key=lambda uid: users[uid].get('last_order_at') or '', reverse=True)
+    found.sort(key=lambda uid: -scores[uid])
+    return found
+
+def render_find_page(bot_data, query, offset=0):
+    """Результаты /find: клиенты и заказы с листанием (callback find:<сдвиг>, запрос в chat_data)"""
+    orders = get_orders(bot_data)
+    started = time.perf_counter()
+    oids = search_orders(bot_data, query)
+    user_ids = search_customers(bot_data, query) if not offset else []
+    elapsed = time.perf_counter() - started
+
+    text = f"🔎 <b>ПОИСК</b> «{html.escape(query)}»: заказов {len(oids)} ({elapsed * 1000:.0f} мс)\n"
+    if user_ids:
+        users = get_users(bot_data)
+        text += "\n" + "\n".join(format_customer_line(users[uid]) for uid in user_ids[:5]) + "\n\n"
+    for oid in oids[offset:offset + FIND_PAGE_SIZE]:
+        info = orders[oid]
+        user = info.get('user') or {}
+        icon = STATUS_MAP.get(info.get('status', 1), '?').split()[0]
+        text += (
+            f"{icon} <code>{oid}</code> | {(info.get('data') or {}).get('price', 0):,} | {(info.get('timestamp') or '')[:10]}"
+            f" | {html.escape(user.get('name') or '')} <code>{user.get('phone') or ''}</code>\n"
+        )
+    if not oids and not user_ids: text += "📭 Не найдено."
+
+    nav_row = []
+    if offset + FIND_PAGE_SIZE < len(oids):
+        nav_row.append(InlineKeyboardButton("◀️ Дальше", callback_data=f"find:{offset + FIND_PAGE_SIZE}"))
+    if offset > 0:
+        nav_row.append(InlineKeyboardButton("Назад ▶️", callback_data=f"find:{max(offset - FIND_PAGE_SIZE, 0)}"))
+    return text, InlineKeyboardMarkup([nav_row]) if nav_row else None
+
+# === СТАТИСТИКА ПРОДАЖ ===
+
+STATS_PERIODS = {'7d': 7, '30d': 30, '90d': 90, '365d': 365, 'week': 7, 'month': 30, 'year': 365, 'all': None}
+STATS_SPARK = "▁▂▃▄▅▆▇█"
+
+class StatsBucket:
+    """Суммы по группе заказов. apply(info, -1) вычитает заказ обратно"""
+
+    __slots__ = ('count', 'revenue', 'area', 'area_count', 'by_status', 'by_type', 'by_material', 'type_revenue', 'material_revenue')
+
+    def __init__(self):
+        self.count = 0
+        self.revenue = 0.0
+        self.area = 0.0
+        self.area_count = 0
+        self.by_status = collections.Counter()
+        self.by_type = collections.Counter()
+        self.by_material = collections.Counter()
+        self.type_revenue = collections.Counter()
+        self.material_revenue = collections.Counter()
+
+    def apply(self, info, sign=1):
+        data = info.get('data') or {}
+        price = _num(data.get('price'))
+        area = _num(data.get('area_floor'))
+        self.count += sign
+        self.revenue += sign * price
+        if area:
+            self.area += sign * area
+            self.area_count += sign
+        self.by_status[info.get('status', 1)] += sign
+        self.by_type[data.get('type')] += sign
+        self.by_material[data.get('material')] += sign
+        self.type_revenue[data.get('type')] += sign * price
+        self.material_revenue[data.get('material')] += sign * price
+
+    def merge(self, other):
+        self.count += other.count
+        self.revenue += other.revenue
+        self.area += other.area
+        self.area_count += other.area_count
+        for name in ('by_status', 'by_type', 'by_material', 'type_revenue', 'material_revenue'):
+            getattr(self, name).update(getattr(other, name))
+        return self
+
+class OrderStats(DerivedView):
+    """Текущие итоги по заказам: всего и по дням. Отчёт за период складывает дни, а не перебирает заказы"""
+
+    def reset(self):
+        self.total = StatsBucket()
+        self.days = {}  # 'YYYY-MM-DD' -> StatsBucket
+        self.day_list = []  # отсортированные ключи days
+
+    @staticmethod
+    def _day(info):
+        return (info.get('timestamp') or '')[:10] or '—'
+
+    def _bucket(self, day):
+        bucket = self.days.get(day)
+        if bucket is None:
+            bucket = self.days[day] = StatsBucket()
+            bisect.insort(self.day_list, day)
+        return bucket
+
+    def add(self, oid, info):
+        self.total.apply(info)
+        self._bucket(self._day(info)).apply(info)
+
+    def remove(self, oid, info):
+        self.total.apply(info, -1)
+        day = self._day(info)
+        bucket = self._bucket(day)
+        bucket.apply(info, -1)
+        if not bucket.count:
+            del self.days[day]
+            _discard_sorted(self.day_list, day)
+
+    def period(self, days=None, today=None):
+        """(итоги, [(день, итоги дня)]) за последние days дней, days=None - за всё время"""
+        if days is None:
+            dated = [day for day in self.day_list if day != '—']
+            return self.total, [(day, self.days[day]) for day in dated]
+        today = today or datetime.now().date()
+        since = (today - timedelta(days=days - 1)).isoformat()
+        series = [(day, self.days[day]) for day in self.day_list[bisect.bisect_left(self.day_list, since):] if day != '—']
+        summary = StatsBucket()
+        for _, bucket in series: summary.merge(bucket)
+        return summary, series
+
+order_stats = OrderStats()
+ORDER_VIEWS.append(order_stats)
+
+def stats_series(series, days, today=None):
+    """Точки графика без пропусков: по дням, если период до двух месяцев, иначе по неделям (с понедельника)"""
+    weekly = days is None or days > 62
+    today = today or datetime.now().date()
+
+    def point_date(date):
+        return date - timedelta(days=date.weekday()) if weekly else date
+
+    points = {}
+    for day, bucket in series:
+        try: date = point_date(datetime.strptime(day, '%Y-%m-%d').date())
+        except ValueError: continue  # Битая дата в импортированном заказе
+        point = points.setdefault(date, [0, 0.0])
+        point[0] += bucket.count
+        point[1] += bucket.revenue
+    if not points: return [], weekly
+
+    start = point_date(today - timedelta(days=days - 1)) if days else min(points)
+    end = max(point_date(today), max(points))
+    step = timedelta(days=7 if weekly else 1)
+    result = []
+    while start <= end:
+        result.append((start.isoformat(), points.get(start, [0, 0.0])))
+        start += step
+    return result, weekly
+
+def parse_stats_args(args):
+    """/stats [7d|30d|week|month|year|all|Nd] [chart] -> (дней или None, нужен ли график)"""
+    days, chart = 30, False
+    for arg in args:
+        arg = arg.lower()
+        if arg in ('chart', 'график'):
+            chart = True
+        elif arg in STATS_PERIODS:
+            days = STATS_PERIODS[arg]
+        elif arg.endswith('d') and arg[:-1].isdigit() and int(arg[:-1]) > 0:
+            days = int(arg[:-1])
+        else:
+            raise ValueError(f"непонятный аргумент: {arg}")
+    return days, chart
+
+def _top_lines(counts, revenue, labels):
+    lines = []
+    for key, count in counts.most_common():
+        if count <= 0: continue
+        lines.append(f"  {labels.get(key, key or '—')}: {count} | {revenue[key]:,.0f} руб.")
+    return "\n".join(lines) or "  —"
+
+def format_stats(summary, points, weekly, days):
+    title = "всё время" if days is None else f"{days} дн."
+    text = f"📊 <b>СТАТИСТИКА</b> ({title})\n\n"
+    text += f"📦 Заказов: <b>{summary.count}</b>\n💰 Сумма: <b>{summary.revenue:,.0f}</b> руб.\n"
+    if summary.count:
+        text += f"🧾 Средний чек: {summary.revenue / summary.count:,.0f} руб.\n"
+    if summary.area_count:
+        text += f"🔲 Средняя площадь: {summary.area / summary.area_count:.1f} м²\n"
+    text += "\n<b>По статусам:</b>\n" + "\n".join(
+        f"  {name}: {summary.by_status.get(code, 0)}" for code, name in STATUS_MAP.items()
+    )
+    text += "\n\n<b>По типам:</b>\n" + _top_lines(summary.by_type, summary.type_revenue, ROOF_TYPES)
+    text += "\n\n<b>По материалам:</b>\n" + _top_lines(summary.by_material, summary.material_revenue, MATERIALS)
+    if points:
+        peak = max(count for _, (count, _) in points) or 1
+        spark = "".join(STATS_SPARK[min(count * len(STATS_SPARK) // (peak + 1), len(STATS_SPARK) - 1)] for _, (count, _) in points[-40:])
+        text += f"\n\n📈 {'По неделям' if weekly else 'По дням'} (макс. {peak}):\n<code>{spark}</code>"
+    return text
+
+def render_stats_chart(points, weekly):
+    """PNG с заказами и суммой по дням/неделям. Вызывается в потоке: pyplot не используется"""
+    from matplotlib.figure import Figure  # Необязательная зависимость, нужна только для графика
+
+    labels = [day[5:] for day, _ in points]
+    figure = Figure(figsize=(10, 5), dpi=100)
+    orders_ax = figure.add_subplot(111)
+    orders_ax.bar(range(len(points)), [count for _, (count, _) in points], color='#4a90d9')
+    orders_ax.set_ylabel('Заказы')
+    revenue_ax = orders_ax.twinx()
+    revenue_ax.plot(range(len(points)), [revenue for _, (_, revenue) in points], color='#d9534f', marker='.')
+    revenue_ax.set_ylabel('Сумма, руб.')
+    step = max(len(points) // 15, 1)
+    orders_ax.set_xticks(range(0, len(points), step))
+    orders_ax.set_xticklabels(labels[::step], rotation=45, fontsize=8)
+    orders_ax.set_title('Заказы по неделям' if weekly else 'Заказы по дням')
+    figure.tight_layout()
+    output = io.BytesIO()
+    figure.savefig(output, format='png')
+    return output.getvalue()
+
+# === ОЧЕРЕДЬ УВЕДОМЛЕНИЙ В АДМИН-КАНАЛ ===
+
+MEDIA_GROUP_LIMIT = 10  # Ограничение Telegram на альбом
+
+class Outbox:
+    """Фоновая доставка уведомлений с повторами.
+
+    Задания лежат в bot_data['outbox'] и переживают перезапуск вместе с persistence;
+    исчерпавшие попытки переезжают в bot_data['outbox_dead']."""
+
+    def __init__(self):
+        self.limiter = RateLimiter(OUTBOX_RATE_PER_MINUTE, 60)
+        self._wakeup = None
+        self._task = None
+
+    def start(self, application):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(application))
+
+    async def stop(self):
+        if not self._task: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None
+
+    def enqueue(self, bot_data, chat_id, text, photos=(), order_id=None):
+        job = {
+            'id': os.urandom(4).hex(),
+            'chat_id': chat_id,
+            'text': text,
+            'photos': list(photos),
+            'order_id': order_id,
+            'step': 0,  # Сколько частей (альбомы, текст) уже доставлено
+            'attempts': 0,
+            'next_at': time.time(),
+            'created': datetime.now().isoformat(),
+            'error': None,
+        }
+        bot_data.setdefault('outbox', []).append(job)
+        self.wake()
+        return job
+
+    def retry_dead(self, bot_data, job_id=None):
+        """Возвращает задания из dead-letter в очередь. Возвращает их число"""
+        dead = bot_data.setdefault('outbox_dead', [])
+        revived = [job for job in dead if job_id in (None, job['id'])]
+        for job in revived:
+            dead.remove(job)
+            job.update(attempts=0, next_at=time.time(), error=None)
+            bot_data.setdefault('outbox', []).append(job)
+        if revived: self.wake()
+        return len(revived)
+
+    def wake(self):
+        if self._wakeup: self._wakeup.set()
+
+    async def _run(self, application):
+        while True:
+            queue = application.bot_data.setdefault('outbox', [])
+            for job in [job for job in queue if job['next_at'] <= time.time()]:
+                try:
+                    await self._deliver(application, job)
+                except Exception as e:
+                    # Не ошибка Telegram (сбой разметки, битое задание) - тот же бэкофф,
+                    # иначе задание остаётся к сроку и цикл крутится вхолостую
+                    logger.exception(f"Ошибка очереди уведомлений на задании {job.get('id')}")
+                    self._fail(application, job, e)
+
+            next_at = min((job['next_at'] for job in queue), default=None)
+            timeout = max(next_at - time.time(), 0) if next_at is not None else None
+            self._wakeup.clear()
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError: pass
+
+    @staticmethod
+    def _steps(job):
+        photos = job['photos']
+        albums = [photos[i:i + MEDIA_GROUP_LIMIT] for i in range(0, len(photos), MEDIA_GROUP_LIMIT)]
+        return [('album', album) for album in albums] + [('text', job['text'])]
+
+    async def _deliver(self, application, job):
+        bot = application.bot
+        steps = self._steps(job)
+        card = None
+        try:
+            while job['step'] < len(steps):
+                kind, payload = steps[job['step']]
+                await self.limiter.acquire()
+                if kind == 'text':
+                    # Уведомление о заказе - его карточка с кнопками статуса
+                    markup = order_card_markup(application.bot_data, job['order_id']) if job['order_id'] else None
+                    card = await bot.send_message(chat_id=job['chat_id'], text=payload, reply_markup=markup, parse_mode=ParseMode.HTML)
+                elif len(payload) == 1:
+                    # sendMediaGroup принимает только от 2 до 10 элементов
+                    await bot.send_photo(chat_id=job['chat_id'], photo=payload[0])
+                else:
+                    await bot.send_media_group(chat_id=job['chat_id'], media=[InputMediaPhoto(media=pid) for pid in payload])
+                job['step'] += 1
+        except RetryAfter as e:
+            job['next_at'] = time.time() + e.retry_after
+            return
+        except TelegramError as e:
+            # BadRequest не исправится повтором (битый file_id, неверная разметка)
+            self._fail(application, job, e, permanent=isinstance(e, BadRequest))
+            return
+
+        application.bot_data['outbox'].remove(job)
+        if card and job['order_id']: await remember_order_card(application, job['order_id'], card)
+
+    @staticmethod
+    def _fail(application, job, error, permanent=False):
+        """Попытка не удалась: повтор с экспоненциальной паузой, а после последней - в dead-letter"""
+        queue = application.bot_data.get('outbox', [])
+        if not any(item is job for item in queue): return  # Уже доставлено, упало после отправки
+        job['attempts'] = job.get('attempts', 0) + 1
+        job['error'] = str(error)
+        if permanent or job['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            queue.remove(job)
+            application.bot_data.setdefault('outbox_dead', []).append(job)
+            logger.error(f"❌ Уведомление {job.get('id')} (заказ {job.get('order_id')}) не доставлено: {error}")
+        else:
+            job['next_at'] = time.time() + min(OUTBOX_BACKOFF_BASE * 2 ** (job['attempts'] - 1), OUTBOX_BACKOFF_MAX)
+            logger.warning(f"⚠️ Уведомление {job.get('id')}: попытка {job['attempts']} не удалась: {error}")
+
+outbox = Outbox()
+
+async def cmd_outbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+
+    args = context.args or []
+    if args and args[0] == 'retry':
+        count = outbox.retry_dead(context.bot_data, args[1] if len(args) > 1 and args[1] != 'all' else None)
+        await msg.reply_text(f"🔁 Возвращено в очередь: {count}")
+        return
+
+    queue = context.bot_data.get('outbox', [])
+    dead = context.bot_data.get('outbox_dead', [])
+    text = f"📮 <b>Очередь уведомлений:</b> {len(queue)}\n☠️ <b>Не доставлено:</b> {len(dead)}\n"
+    for job in dead[-20:]:
+        text += f"\n<code>{job['id']}</code> | {job['order_id']} | попыток: {job['attempts']}\n└ {html.escape(job['error'] or '')}"
+    if dead: text += "\n\n<code>/outbox retry ID</code> или <code>/outbox retry all</code>"
+    await msg.reply_text(text, parse_mode=ParseMode.HTML)
+
+# === КАРТОЧКИ ЗАКАЗОВ В АДМИН-КАНАЛЕ ===
+
+def render_order_card(info):
+    """Текст карточки заказа для админ-канала по текущему состоянию заказа"""
+    order, user = info.get('data') or {}, info.get('user') or {}
+    user_link = f"@{user['username']}" if user.get('username') else "Нет"
+    text = format_order_message(order, user.get('name'), user_link, user.get('phone'), info.get('comment'), info.get('status', 1), for_admin=True)
+    quote = info.get('quote')
+    if PRICE_CHECK_TOLERANCE and quote and _is_number(order.get('price')):
+        deviation = price_deviation(order['price'], quote)
+        if abs(deviation) > PRICE_CHECK_TOLERANCE:
+            text += f"\n⚠️ <b>Расчёт бота:</b> {quote:,} руб. (в заявке {deviation:+.0%})"
+    return text
+
+def order_status_keyboard(oid, status):
+    """Кнопки смены статуса (callback st:<статус>:<ID заказа>), текущий отмечен точкой"""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(("• " if code == status else "") + name, callback_data=f"st:{code}:{oid}")
+        for code, name in STATUS_MAP.items()
+    ]])
+
+def order_card_markup(bot_data, oid):
+    info = get_orders(bot_data).get(oid)
+    return order_status_keyboard(oid, info.get('status', 1)) if info else None
+
+async def remember_order_card(application, oid, message):
+    """Запоминает, каким сообщением в канале опубликован заказ (вызывается очередью уведомлений)"""
+    async with shared_rows(application, ('orders', oid)):
+        info = get_orders(application.bot_data).get(oid)
+        if info is None: return
+        # Карточка уходит со статусом на момент заявки; если его уже сменили - поправим правкой
+        card = {'chat_id': message.chat_id, 'message_id': message.message_id, 'status': 1}
+        put_order(application.bot_data, oid, {**info, 'card': card})
+    if info.get('status', 1) != card['status']: schedule_card_sync(application, oid)
+
+def schedule_card_sync(application, oid):
+    """Правка карточки откладывается на CARD_EDIT_DEBOUNCE: серия нажатий сливается в один editMessageText"""
+    name = f"card:{oid}"
+    if application.job_queue.get_jobs_by_name(name): return  # Правка уже запланирована и возьмёт последний статус
+    application.job_queue.run_once(sync_order_card_job, CARD_EDIT_DEBOUNCE, name=name, data=oid)
+
+async def sync_order_card_job(context: ContextTypes.DEFAULT_TYPE):
+    oid = context.job.data
+    # Правки в канал делят лимит Telegram с очередью уведомлений; ждём его до блокировки заказа
+    await outbox.limiter.acquire()
+    async with shared_rows(context.application, ('orders', oid)):
+        info = get_orders(context.bot_data).get(oid)
+        card = (info or {}).get('card')
+        # Статус вернули обратно до правки или карточки нет (заказ старше этой функции)
+        if not card or card['status'] == info.get('status', 1): return
+        card = {**card, 'status': info.get('status', 1)}
+        try:
+            await context.bot.edit_message_text(
+                render_order_card(info), chat_id=card['chat_id'], message_id=card['message_id'],
+                reply_markup=order_status_keyboard(oid, card['status']), parse_mode=ParseMode.HTML
+            )
+        except RetryAfter as e:
+            context.job_queue.run_once(sync_order_card_job, e.retry_after, name=context.job.name, data=oid)
+            return
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning(f"⚠️ Карточка заказа {oid} не обновлена: {e}")
+                card = None  # Карточку удалили из канала - больше не правим
+        put_order(context.bot_data, oid, {**info, 'card': card})
+
+async def change_order_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка статуса под карточкой в канале или под /order ID"""
+    query = update.callback_query
+    if update.effective_user.id not in ADMIN_IDS:
+        await query.answer("Только для администраторов", show_alert=True)
+        return
+    _, code, oid = query.data.split(":", 2)
+    status = int(code)
+    async with shared_rows(context.application, ('orders', oid)):
+        info = get_orders(context.bot_data).get(oid)
+        if info and info.get('status', 1) != status: set_order_status(context.bot_data, oid, status)
+    if not info:
+        await query.answer("❌ Заказ не найден", show_alert=True)
+        return
+    await query.answer(f"✅ {STATUS_MAP[status]}")
+    schedule_card_sync(context.application, oid)
+
+    card = info.get('card') or {}
+    if query.message and (query.message.chat_id, query.message.message_id) != (card.get('chat_id'), card.get('message_id')):
+        # Сообщение /order ID в личке правим сразу: оно не упирается в лимит канала
+        text, markup = render_order_detail(oid, get_orders(context.bot_data)[oid])
+        try: await query.edit_message_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+        except BadRequest: pass  # Нажали на уже выбранный статус
+
+# === РАССЫЛКА КЛИЕНТАМ ===
+
+BROADCAST_TEXT_LIMIT = 4096
+BROADCAST_CAPTION_LIMIT = 1024
+BROADCAST_COMMAND_RE = re.compile(r'^/broadcast(@\w+)?\s*')
+ADMIN_ALBUMS_KEEP = 20
+
+admin_albums = collections.OrderedDict()  # media_group_id -> [(message_id, file_id, caption_html)] из админских чатов
+
+def remember_admin_album(msg):
+    """Фото альбомов в админских чатах: ответ /broadcast на одно фото рассылает весь альбом"""
+    if not msg.media_group_id or not msg.photo or msg.chat_id not in message_tracker.chat_ids: return
+    admin_albums.setdefault(msg.media_group_id, []).append((msg.message_id, msg.photo[-1].file_id, msg.caption_html or ''))
+    admin_albums.move_to_end(msg.media_group_id)
+    while len(admin_albums) > ADMIN_ALBUMS_KEEP: admin_albums.popitem(last=False)
+
+def broadcast_content(msg):
+    """Содержимое рассылки из команды: текст после /broadcast и/или сообщение, на которое она ответом.
+
+    {'text', 'photos'} - отправляется заново с HTML-разметкой, прочие вложения копируются: {'copy': [chat_id, message_id], 'text'}."""
+    text = BROADCAST_COMMAND_RE.sub('', msg.text_html or '', count=1).strip()
+    plain = BROADCAST_COMMAND_RE.sub('', msg.text or '', count=1).strip()
+    source = msg.reply_to_message
+    if source and source.photo:
+        album = sorted(admin_albums.get(source.media_group_id) or ())
+        photos = [file_id for _, file_id, _ in album] or [source.photo[-1].file_id]
+        caption = next((c for _, _, c in album if c), source.caption_html or '')
+        content = {'text': text or caption, 'photos': photos[:MEDIA_GROUP_LIMIT]}
+        if len(plain or source.caption or '') > BROADCAST_CAPTION_LIMIT:
+            raise ValueError(f"подпись к фото длиннее {BROADCAST_CAPTION_LIMIT} символов")
+        return content
+    if source and not source.text:
+        if len(plain) > BROADCAST_CAPTION_LIMIT: raise ValueError(f"подпись длиннее {BROADCAST_CAPTION_LIMIT} символов")
+        return {'copy': [source.chat_id, source.message_id], 'text': text}
+    if source and not text:
+        text, plain = source.text_html, source.text
+    if not text: raise ValueError("нет текста")
+    if len(plain) > BROADCAST_TEXT_LIMIT: raise ValueError(f"текст длиннее {BROADCAST_TEXT_LIMIT} символов")
+    return {'text': text, 'photos': []}
+
+async def send_broadcast_content(bot, chat_id, content):
+    photos, text = content.get('photos') or [], content.get('text') or None
+    if content.get('copy'):
+        from_chat_id, message_id = content['copy']
+        # Текст из команды заменяет подпись, без него копия остаётся как есть
+        await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, caption=text, parse_mode=ParseMode.HTML if text else None)
+    elif len(photos) > 1:
+        media = [InputMediaPhoto(media=pid, caption=text if i == 0 else None, parse_mode=ParseMode.HTML) for i, pid in enumerate(photos)]
+        await bot.send_media_group(chat_id=chat_id, media=media)
+    elif photos:
+        await bot.send_photo(chat_id=chat_id, photo=photos[0], caption=text, parse_mode=ParseMode.HTML)
+    else:
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+
+def _broadcast_done(state):
+    return state['sent'] + state['blocked'] + state['failed']
+
+def render_broadcast_status(state, rate=None):
+    """Прогресс рассылки для сообщения-статуса; rate - клиентов в секунду в текущем запуске (для ETA)"""
+    done, total = _broadcast_done(state), state['total']
+    title = {
+        'draft': "📝 Черновик рассылки", 'running': "📣 Рассылка идёт",
+        'stopped': "⏸ Рассылка остановлена", 'done': "✅ Рассылка завершена",
+    }[state['state']]
+    text = (
+        f"{title}\n\n"
+        f"Обработано: {done} из {total} ({done / total if total else 1:.0%})\n"
+        f"✉️ Доставлено: {state['sent']}\n"
+        f"⛔️ Заблокировали бота: {state['blocked']}\n"
+        f"❌ Ошибки: {state['failed']}"
+    )
+    if state['state'] == 'running' and rate:
+        text += f"\n⏱ Осталось ~{format_duration(max(total - done, 0) / rate)}"
+    if state['state'] == 'stopped':
+        text += "\n\n<code>/broadcast go</code> - продолжить с места остановки"
+    return text
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60: return f"{seconds} с"
+    if seconds < 3600: return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+async def save_broadcast(application):
+    """Состояние рассылки пишется сразу: после перезапуска она продолжится без повторов"""
+    if application.persistence: await application.persistence.push(application.bot_data, 'bot_data', 'broadcast')
+
+class Broadcaster:
+    """Фоновая рассылка всем клиентам из bot_data['users'].
+
+    Клиенты обходятся по возрастанию user_id; в bot_data['broadcast'] хранится содержимое,
+    курсор (последний обработанный user_id) и счётчики. Рассылка не занимает слоты обработки
+    обновлений и оставляет часть лимита Telegram обычным ответам."""
+
+    def __init__(self):
+        self.limiter = ChatRateLimiter(BROADCAST_RATE, BROADCAST_CHAT_INTERVAL)
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, application):
+        """Запускает рассылку из bot_data, если она идёт и принадлежит этому процессу (и после рестарта)"""
+        state = application.bot_data.get('broadcast')
+        if self.running or not state or state['state'] != 'running' or state.get('worker', '') != WORKER_ID: return False
+        self._task = asyncio.create_task(self._run(application, state['id']))
+        return True
+
+    async def stop(self):
+        if not self._task: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None
+
+    async def _run(self, application, broadcast_id):
+        bot_data = application.bot_data
+        state = bot_data['broadcast']
+        ahead = set(state.get('ahead') or ())
+        recipients = sorted(uid for uid in get_users(bot_data) if isinstance(uid, int) and uid > state['cursor'] and uid not in ahead)
+        done_before = _broadcast_done(state)
+        state['total'] = done_before + len(recipients)  # С учётом клиентов, появившихся после черновика
+        logger.info(f"📣 Рассылка {broadcast_id}: осталось клиентов {len(recipients)}")
+        started = status_at = time.monotonic()  # Первая правка статуса - когда скорость уже можно оценить
+        saved_at = 0.0
+        try:
+            for i in range(0, len(recipients), BROADCAST_CONCURRENCY):
+                # Остановлена командой (в том числе в другом процессе) или заменена новой
+                state = bot_data.get('broadcast')
+                if not state or state['id'] != broadcast_id: return
+                if state['state'] != 'running':
+                    await self._update_status(application.bot, state)
+                    return
+                # Все слоты обработки заняты - сначала ответы клиентам
+                while watchdog.in_flight >= CONCURRENT_UPDATES: await asyncio.sleep(0.2)
+                await self._send_batch(application.bot, state, recipients[i:i + BROADCAST_CONCURRENCY])
+                now = time.monotonic()
+                if now - saved_at >= 1:
+                    await save_broadcast(application)
+                    saved_at = now
+                if now - status_at >= BROADCAST_STATUS_INTERVAL:
+                    await self._update_status(application.bot, state, (_broadcast_done(state) - done_before) / (now - started))
+                    status_at = now
+        except Exception as e:
+            # Курсор сохранён - /broadcast go продолжит с того же клиента
+            logger.error(f"❌ Рассылка {broadcast_id} прервана: {e}")
+            state['state'] = 'stopped'
+            await save_broadcast(application)
+            await self._update_status(application.bot, state)
+            return
+
+        state.update(state='done', finished=datetime.now().isoformat())
+        await save_broadcast(application)
+        await self._update_status(application.bot, state)
+        logger.info(f"📣 Рассылка {broadcast_id} завершена: доставлено {state['sent']}, заблокировали {state['blocked']}, ошибок {state['failed']}")
+
+    async def _send_batch(self, bot, state, batch):
+        done = set()
+
+        async def send(chat_id):
+            result = await self._deliver(bot, chat_id, state['content'])
+            state[result] += 1
+            done.add(chat_id)
+
+        try:
+            await asyncio.gather(*(send(chat_id) for chat_id in batch))
+        finally:
+            # Курсор - до первого необработанного; кому из прерванной пачки уже отправили, запоминаем отдельно,
+            # чтобы после рестарта никому не прислать дважды
+            for chat_id in batch:
+                if chat_id not in done: break
+                state['cursor'] = chat_id
+            # Прежние ahead тоже храним: их ещё не обошёл курсор, а прерваться могли не в первый раз
+            ahead = set(state.get('ahead') or ()) | done
+            state['ahead'] = sorted(chat_id for chat_id in ahead if chat_id > state['cursor'])
+
+    async def _deliver(self, bot, chat_id, content):
+        """Отправка одному клиенту: 'sent', 'blocked' или 'failed'"""
+        attempts = 0
+        cost = len(content.get('photos') or ()) or 1  # Альбом - по сообщению на фото
+        while True:
+            await self.limiter.acquire(chat_id, cost)
+            try:
+                await send_broadcast_content(bot, chat_id, content)
+                return 'sent'
+            except RetryAfter as e:
+                # Флуд-контроль общий на бота: ждёт вся рассылка, клиенту - повтор
+                self.limiter.pause(e.retry_after)
+                logger.warning(f"📣 Рассылка: Telegram просит паузу {e.retry_after} с")
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                logger.info(f"📣 Рассылка: {chat_id} пропущен: {e}")
+                return 'failed'
+            except TelegramError as e:
+                attempts += 1
+                if attempts >= BROADCAST_MAX_ATTEMPTS:
+                    logger.warning(f"📣 Рассылка: {chat_id} не доставлено: {e}")
+                    return 'failed'
+                await asyncio.sleep(OUTBOX_BACKOFF_BASE * attempts)
+
+    @staticmethod
+    async def _update_status(bot, state, rate=None):
+        chat_id, message_id = state.get('status') or (None, None)
+        if not chat_id: return
+        try:
+            await bot.edit_message_text(render_broadcast_status(state, rate), chat_id=chat_id, message_id=message_id, parse_mode=ParseMode.HTML)
+        except RetryAfter:
+            pass  # Прогресс покажем следующей правкой
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning(f"⚠️ Статус рассылки не обновлён: {e}")
+                state['status'] = None  # Сообщение удалили - дальше без статуса
+
+broadcaster = Broadcaster()
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+    args = context.args or []
+    application = context.application
+    state = context.bot_data.get('broadcast')
+    action = args[0] if len(args) == 1 and not msg.reply_to_message else None
+
+    if action == 'stop':
+        if not state or state['state'] != 'running':
+            await msg.reply_text("Рассылка не идёт.")
+            return
+        state['state'] = 'stopped'
+        await save_broadcast(application)
+        await msg.reply_text(render_broadcast_status(state), parse_mode=ParseMode.HTML)
+        return
+
+    if action == 'go':
+        if not state or state['state'] not in ('draft', 'stopped'):
+            await msg.reply_text("Нет черновика: сначала <code>/broadcast текст</code> или ответ на сообщение.", parse_mode=ParseMode.HTML)
+            return
+        status = await msg.reply_text(render_broadcast_status({**state, 'state': 'running'}), parse_mode=ParseMode.HTML)
+        state.update(state='running', worker=WORKER_ID, status=[status.chat_id, status.message_id])
+        state.setdefault('started', datetime.now().isoformat())
+        await save_broadcast(application)
+        broadcaster.start(application)
+        return
+
+    if not args and not msg.reply_to_message:
+        text = render_broadcast_status(state) + "\n\n" if state else ""
+        await msg.reply_text(
+            text + "<code>/broadcast текст</code> или ответ <code>/broadcast</code> на сообщение/фото/альбом - черновик и предпросмотр\n"
+            "<code>/broadcast go</code> - начать, <code>/broadcast stop</code> - остановить",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    if state and state['state'] == 'running':
+        await msg.reply_text("⏳ Рассылка уже идёт: <code>/broadcast stop</code>, чтобы остановить.", parse_mode=ParseMode.HTML)
+        return
+    try:
+        content = broadcast_content(msg)
+    except ValueError as e:
+        await msg.reply_text(f"❌ {e}")
+        return
+    # Предпросмотр уходит в этот же чат: заодно проверяется разметка и file_id
+    try:
+        await send_broadcast_content(context.bot, msg.chat_id, content)
+    except TelegramError as e:
+        await msg.reply_text(f"❌ Сообщение не отправляется: {e}")
+        return
+    context.bot_data['broadcast'] = {
+        'id': os.urandom(4).hex(), 'content': content, 'state': 'draft', 'cursor': 0,
+        'total': len(get_users(context.bot_data)), 'sent': 0, 'blocked': 0, 'failed': 0,
+        'created': datetime.now().isoformat(), 'worker': WORKER_ID, 'status': None,
+    }
+    await save_broadcast(application)
+    await msg.reply_text(
+        f"👆 Так сообщение увидят клиенты: {context.bot_data['broadcast']['total']}.\n"
+        "<code>/broadcast go</code> - начать рассылку",
+        parse_mode=ParseMode.HTML
+    )
+
+# === РАСЧЁТ СТОИМОСТИ ===
+
+# Встроенные тарифы; реальные цены задаются в PRICE_LIST (достаточно указать отличающиеся ключи)
+DEFAULT_PRICE_LIST = {
+    'frame': {'single': 3200, 'gable': 3900, 'arched': 4300, 'triangular': 4100, 'semiarched': 4000},  # Каркас, руб/м² пола
+    'roof': {'polycarbonate': 900, 'metaltile': 1300, 'decking': 1100},  # Кровля, руб/м² кровли
+    'paint': {'none': 1.0, 'ral': 1.08, 'polymer': 1.18},  # Множитель к каркасу
+    'roof_factor': {'single': 1.05, 'gable': 1.15, 'arched': 1.25, 'triangular': 1.2, 'semiarched': 1.15},  # м² кровли на м² пола
+    'slopes': {'single': 1, 'gable': 2, 'arched': 2, 'triangular': 2, 'semiarched': 1},  # Скатов под водостоки
+    'height_base': 2.5,
+    'height_step': 0.06,  # +6% к каркасу за каждый метр выше height_base
+    'trusses': 0.12,  # Доля от каркаса
+    'gutters': 850,  # руб/м по длине ската
+    'walls': 1500,  # руб/м² зашивки одной длинной стороны
+    'found': 1200,  # руб/м² пола
+    'install': 0.15,  # Доля от суммы
+    'min_price': 30000,
+    'round_to': 100,
+}
+PRICE_OPTIONS = {'trusses': "Усил. фермы", 'gutters': "Водостоки", 'walls': "Зашивка", 'found': "Фундамент", 'install': "Монтаж"}
+
+def _num(value, default=0.0):
+    """Число из поля конструктора: старые заявки присылали размеры строками, иногда с запятой"""
+    try: return float(str(value).replace(',', '.'))
+    except (TypeError, ValueError): return default
+
+class PriceList:
+    """Тарифы с заранее посчитанной таблицей ставок по (тип, материал, покраска).
+
+    Расчёт идёт по столбцам сразу для списка заказов: одиночная котировка - это пакет из одного заказа."""
+
+    def __init__(self, data, custom=False):
+        self.data = data
+        self.custom = custom  # Тарифы из PRICE_LIST, а не только встроенные заглушки
+        self.version = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:8]
+        # (тип, материал, покраска) -> (каркас руб/м² пола с покраской, кровля руб/м², м² кровли на м² пола, скатов)
+        self.rates = {
+            (rtype, material, paint): (
+                frame * data['paint'][paint], data['roof'][material],
+                data['roof_factor'].get(rtype, 1.0), data['slopes'].get(rtype, 1)
+            )
+            for rtype, frame in data['frame'].items() for material in data['roof'] for paint in data['paint']
+        }
+
+    @classmethod
+    def load(cls, path=None):
+        data = json.loads(json.dumps(DEFAULT_PRICE_LIST))  # Копия, чтобы не портить встроенные тарифы
+        custom = bool(path and os.path.exists(path))
+        if custom:
+            with open(path, encoding='utf-8') as f:
+                loaded = json.load(f)
+            if not isinstance(loaded, dict): raise ValueError("ожидается JSON-объект")
+            for key, value in loaded.items():
+                if isinstance(value, dict): data.setdefault(key, {}).update(value)
+                else: data[key] = value
+        # Битый тариф должен всплыть при загрузке, а не на первом расчёте
+        for key, default in DEFAULT_PRICE_LIST.items():
+            value = data[key]
+            values = value.values() if isinstance(value, dict) else [value]
+            if isinstance(value, dict) != isinstance(default, dict) or not all(type(v) in (int, float) for v in values):
+                raise ValueError(f"{key}: ожидается {'словарь чисел' if isinstance(default, dict) else 'число'}")
+        return cls(data, custom)
+
+    def columns(self, orders):
+        """Составляющие цены по столбцам для списка заказов конструктора.
+        None - тип, материал или покраска не из справочника"""
+        d = self.data
+        rates = [self.rates.get((o.get('type'), o.get('material'), o.get('paint') or 'none')) for o in orders]
+        length = [_num(o.get('length')) for o in orders]
+        width = [_num(o.get('width')) for o in orders]
+        height = [_num(o.get('height'), d['height_base']) for o in orders]
+        floor = [_num(o.get('area_floor')) or ln * w for o, ln, w in zip(orders, length, width)]
+        roof_area = [_num(o.get('area_roof')) or (r[2] * f if r else 0) for o, r, f in zip(orders, rates, floor)]
+        flags = {name: [bool((o.get('opts') or {}).get(name)) for o in orders] for name in PRICE_OPTIONS}
+
+        frame = [
+            r[0] * f * (1 + d['height_step'] * max(h - d['height_base'], 0)) if r else None
+            for r, f, h in zip(rates, floor, height)
+        ]
+        roof = [r[1] * a if r else None for r, a in zip(rates, roof_area)]
+        cols = {
+            'frame': frame,
+            'roof': roof,
+            'trusses': [fr * d['trusses'] if on and fr is not None else 0 for on, fr in zip(flags['trusses'], frame)],
+            'gutters': [d['gutters'] * ln * r[3] if on and r else 0 for on, ln, r in zip(flags['gutters'], length, rates)],
+            'walls': [d['walls'] * ln * h if on else 0 for on, ln, h in zip(flags['walls'], length, height)],
+            'found': [d['found'] * f if on else 0 for on, f in zip(flags['found'], floor)],
+        }
+        subtotal = [
+            None if fr is None else fr + rf + tr + gu + wa + fo
+            for fr, rf, tr, gu, wa, fo in zip(frame, roof, cols['trusses'], cols['gutters'], cols['walls'], cols['found'])
+        ]
+        cols['install'] = [s * d['install'] if on and s is not None else 0 for on, s in zip(flags['install'], subtotal)]
+        step = d['round_to']
+        cols['total'] = [
+            None if s is None else int(max(round((s + i) / step) * step, d['min_price']))
+            for s, i in zip(subtotal, cols['install'])
+        ]
+        return cols
+
+    def quote(self, order):
+        """Разбивка цены одного заказа"""
+        return {name: values[0] for name, values in self.columns([order]).items()}
+
+try:
+    price_list = PriceList.load(PRICE_LIST)
+except (OSError, ValueError) as e:
+    # Битый PRICE_LIST не должен мешать запуску: работаем на встроенных тарифах, /reprice перечитает файл
+    logger.error(f"❌ Не удалось прочитать {PRICE_LIST}: {e}. Используются встроенные тарифы")
+    price_list = PriceList.load()
+
+def price_deviation(stored, computed):
+    """Относительное расхождение сохранённой цены с расчётом"""
+    return (stored - computed) / computed if computed else 0.0
+
+def reprice_orders(orders):
+    """Пересчёт всех заказов текущими тарифами одним пакетом.
+    Возвращает строки (ID, сохранённая цена, расчёт, расхождение) и сводку"""
+    oids = list(orders)
+    totals = price_list.columns([orders[oid].get('data') or {} for oid in oids])['total']
+    rows, skipped = [], 0
+    for oid, total in zip(oids, totals):
+        stored = (orders[oid].get('data') or {}).get('price')
+        if total is None or not _is_number(stored):
+            skipped += 1
+            continue
+        rows.append((oid, stored, total, price_deviation(stored, total)))
+    rows.sort(key=lambda row: -abs(row[3]))
+    buckets = collections.Counter(
+        '≤1%' if abs(dev) <= 0.01 else '≤5%' if abs(dev) <= 0.05 else '≤20%' if abs(dev) <= 0.2 else '>20%'
+        for _, _, _, dev in rows
+    )
+    return rows, {
+        'count': len(rows),
+        'skipped': skipped,
+        'buckets': buckets,
+        'mean_abs': sum(abs(row[3]) for row in rows) / len(rows) if rows else 0.0,
+        'stored_sum': sum(row[1] for row in rows),
+        'computed_sum': sum(row[2] for row in rows),
+    }
+
+def format_reprice_summary(summary):
+    buckets = ", ".join(f"{name}: {summary['buckets'].get(name, 0)}" for name in ('≤1%', '≤5%', '≤20%', '>20%'))
+    return (
+        f"💱 <b>Пересчёт по тарифам {price_list.version}</b>\n"
+        f"Заказов: {summary['count']}, без расчёта: {summary['skipped']}\n"
+        f"Расхождение цен: {buckets}\n"
+        f"Среднее расхождение: {summary['mean_abs']:.1%}\n"
+        f"Сумма в заказах: {summary['stored_sum']:,} руб., по расчёту: {summary['computed_sum']:,} руб."
+    )
+
+def notify_price_list_change(application):
+    """После смены тарифов отправляет в админ-канал сводку пересчёта всех заказов.
+
+    Только для PRICE_LIST от оператора: сравнивать заказы со встроенными заглушками бессмысленно.
+    Первый запуск с файлом лишь запоминает версию - меняться ещё было нечему"""
+    bot_data = application.bot_data
+    if not price_list.custom: return
+    previous = bot_data.get('price_list_version')
+    if previous == price_list.version: return
+    bot_data['price_list_version'] = price_list.version
+    orders = get_orders(bot_data)
+    if not previous or not orders: return
+    _, summary = reprice_orders(orders)
+    outbox.enqueue(bot_data, ADMIN_CHANNEL_ID, format_reprice_summary(summary) + "\n\nПодробно: /reprice")
+
+# === ЭКСПОРТ ЗАКАЗОВ ===
+
+EXPORT_COLUMNS = ['ID', 'Дата', 'Статус', 'Имя', 'Телефон', 'Тип', 'Ширина', 'Длина', 'Цена', 'Комментарий']
+EXPORT_USAGE = (
+    "Формат: <code>/export [csv|jsonl] [gz] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [status=1] [type=gable]</code>"
+)
+
+def _parse_export_date(value):
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try: return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError: pass
+    raise ValueError(f"неверная дата: {value}")
+
+def parse_export_args(args):
+    """Разбирает аргументы /export (и параметры HTTP-выгрузки) в словарь фильтров"""
+    opts = {'format': 'csv', 'gzip': False, 'from': None, 'to': None, 'status': None, 'type': None}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        key = key.lower()
+        if not sep and key in ('csv', 'jsonl'): opts['format'] = key
+        elif not sep and key in ('gz', 'gzip'): opts['gzip'] = True
+        elif key == 'format' and value in ('csv', 'jsonl'): opts['format'] = value
+        elif key in ('gz', 'gzip'): opts['gzip'] = value not in ('', '0', 'false')
+        elif key in ('from', 'to'): opts[key] = _parse_export_date(value)
+        elif key == 'status':
+            if not value.isdigit() or int(value) not in STATUS_MAP: raise ValueError(f"неизвестный статус: {value}")
+            opts['status'] = int(value)
+        elif key == 'type':
+            if value not in ROOF_TYPES: raise ValueError(f"неизвестный тип навеса: {value}")
+            opts['type'] = value
+        else:
+            raise ValueError(f"непонятный аргумент: {arg}")
+    return opts
+
+def export_filename(opts):
+    name = f"orders_{datetime.now().strftime('%d-%m')}.{opts['format']}"
+    return name + '.gz' if opts['gzip'] else name
+
+def iter_export_orders(orders, opts):
+    """Генератор заказов, прошедших фильтры. Ключи копируются, сами записи - нет"""
+    for oid in list(orders):
+        info = orders.get(oid)
+        if info is None: continue
+        day = (info.get('timestamp') or '')[:10]
+        if opts['from'] and day < opts['from']: continue
+        if opts['to'] and day > opts['to']: continue
+        if opts['status'] and info.get('status', 1) != opts['status']: continue
+        if opts['type'] and info.get('data', {}).get('type') != opts['type']: continue
+        yield oid, info
+
+def _export_csv_row(oid, info):
+    data = info.get('data', {})
+    user = info.get('user', {})
+    return [
+        oid, (info.get('timestamp') or '')[:10], STATUS_MAP.get(info.get('status', 1)),
+        user.get('name', ''), user.get('phone', ''),
+        ROOF_TYPES.get(data.get('type')), data.get('width'), data.get('length'),
+        data.get('price'), info.get('comment', '')
+    ]
+
+def iter_export_chunks(orders, opts, stats=None, chunk_rows=500):
+    """Выгрузка кусками байтов: CSV или JSON Lines, при необходимости сжатая gzip"""
+    stats = stats if stats is not None else {}
+    stats['rows'] = 0
+    packer = zlib.compressobj(6, zlib.DEFLATED, 31) if opts['gzip'] else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if opts['format'] == 'csv':
+        buffer.write('\ufeff')  # BOM, чтобы Excel понял UTF-8
+        writer.writerow(EXPORT_COLUMNS)
+
+    def drain():
+        chunk = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return packer.compress(chunk) if packer else chunk
+
+    for oid, info in iter_export_orders(orders, opts):
+        if opts['format'] == 'csv':
+            writer.writerow(_export_csv_row(oid, info))
+        else:
+            buffer.write(json.dumps({'id': oid, **info}, ensure_ascii=False, default=str) + '\n')
+        stats['rows'] += 1
+        if stats['rows'] % chunk_rows == 0:
+            chunk = drain()
+            if chunk: yield chunk
+
+    chunk = drain()
+    if packer: chunk += packer.flush()
+    if chunk: yield chunk
+
+def sign_export_query(opts, ttl=EXPORT_LINK_TTL):
+    """Параметры ссылки на HTTP-выгрузку с подписью EXPORT_TOKEN и сроком действия"""
+    params = {'format': opts['format'], 'gz': '1' if opts['gzip'] else '0'}
+    for key in ('from', 'to', 'status', 'type'):
+        if opts[key]: params[key] = str(opts[key])
+    params['exp'] = str(int(time.time()) + ttl)
+    params['sig'] = _export_signature(params)
+    return params
+
+def _export_signature(params):
+    payload = '&'.join(f"{k}={params[k]}" for k in sorted(params) if k != 'sig')
+    return hmac.new(EXPORT_TOKEN.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+# === ИМПОРТ ЗАКАЗОВ ===
+
+class _JSONStream:
+    """Минимальный потоковый разбор JSON поверх текстового файла"""
+
+    def __init__(self, fp, chunk_size=64 * 1024):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        more = self.fp.read(self.chunk_size)
+        if not more:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + more
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if not self._fill(): return ''
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch not in chars: raise ValueError(f"ожидался один из символов {chars!r}, получено {ch!r}")
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # Число на границе буфера может быть обрезано - дочитываем
+                if end < len(self.buf) or self.eof or not self._fill():
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError as e:
+                # Обрезанная на границе буфера запись - ошибка в самом конце (или незакрытая строка);
+                # ошибка раньше - битый файл, дочитывать его целиком в память незачем
+                truncated = e.pos >= len(self.buf) or e.msg.startswith('Unterminated string')
+                if not truncated or not self._fill(): raise
+
+def iter_json_records(fp):
+    """Записи из JSON-массива, словаря {id: заказ} (старый формат) или JSON Lines.
+
+    Отдаёт пары (ключ или None, запись или исключение разбора)."""
+    stream = _JSONStream(fp)
+    first = stream.peek()
+    if first == '[':
+        stream.expect('[')
+        if stream.peek() == ']': return
+        while True:
+            yield None, stream.value()
+            if stream.expect(',]') == ']': return
+
+    if first == '{':
+        stream.expect('{')
+        if stream.peek() == '}': return
+        key = stream.value()
+        stream.expect(':')
+        value = stream.value()
+        if isinstance(value, dict) and 'data' in value:
+            # Старый формат /import_db: один объект {id: заказ}
+            while True:
+                yield key, value
+                if stream.expect(',}') == '}': return
+                key = stream.value()
+                stream.expect(':')
+                value = stream.value()
+
+    # JSON Lines: битая строка не мешает остальным
+    fp.seek(0)
+    for line in fp:
+        line = line.strip()
+        if not line: continue
+        try: yield None, json.loads(line)
+        except ValueError as e: yield None, e
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate_order_record(key, record):
+    """Проверяет запись импорта и приводит её к виду, который пишет handle_contact"""
+    if not isinstance(record, dict): raise ValueError("запись не является объектом")
+    data = record.get('data')
+    if not isinstance(data, dict): raise ValueError("нет блока data")
+    oid = record.get('id') or key or data.get('id')
+    if not isinstance(oid, str) or not oid: raise ValueError("нет ID заказа")
+    if data.get('id') not in (None, oid): raise ValueError(f"{oid}: ID в data не совпадает")
+    if data.get('type') not in ROOF_TYPES: raise ValueError(f"{oid}: неизвестный тип {data.get('type')!r}")
+    if not _is_number(data.get('price')) or data['price'] < 0: raise ValueError(f"{oid}: неверная цена")
+    for dim in ('width', 'length', 'height'):
+        if dim in data and not _is_number(data[dim]): raise ValueError(f"{oid}: неверный размер {dim}")
+
+    user = record.get('user')
+    if not isinstance(user, dict) or not user.get('phone'): raise ValueError(f"{oid}: нет телефона клиента")
+    if user.get('user_id') is not None and not isinstance(user['user_id'], int): raise ValueError(f"{oid}: неверный user_id")
+    status = record.get('status', 1)
+    if status not in STATUS_MAP: raise ValueError(f"{oid}: неизвестный статус {status!r}")
+    timestamp = record.get('timestamp') or ''
+    try: datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError): raise ValueError(f"{oid}: неверная дата {timestamp!r}")
+
+    normalized = {k: v for k, v in record.items() if k != 'id'}
+    normalized.update({
+        'data': {**data, 'id': oid},
+        'user': {
+            'name': user.get('name', ''),
+            'phone': str(user['phone']),
+            'username': user.get('username'),
+            'user_id': user.get('user_id'),
+        },
+        'status': status,
+        'comment': str(record.get('comment', 'Нет пожеланий')),
+        'timestamp': timestamp,
+        'photos_count': int(record.get('photos_count') or 0),
+    })
+    return oid, normalized
+
+async def import_orders(fp, bot_data, dry_run=False):
+    """Сливает заказы из файла в bot_data['orders'] по ID. Ничего не удаляет.
+
+    Сначала файл проверяется целиком, записывает второй проход - и только если разбор дошёл
+    до конца: битый файл не оставляет базу импортированной наполовину"""
+    report = await _import_pass(fp, bot_data, apply=False)
+    if dry_run or report['fatal']: return report
+    fp.seek(0)
+    return await _import_pass(fp, bot_data, apply=True)
+
+async def _import_pass(fp, bot_data, apply):
+    orders = get_orders(bot_data)
+    report = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0, 'errors': [], 'fatal': None}
+    try:
+        for n, (key, record) in enumerate(iter_json_records(fp), 1):
+            if n % 500 == 0: await asyncio.sleep(0)  # Отдаём event loop другим пользователям
+            try:
+                if isinstance(record, Exception): raise ValueError(f"строка не JSON: {record}")
+                oid, record = validate_order_record(key, record)
+            except ValueError as e:
+                report['rejected'] += 1
+                if len(report['errors']) < 5: report['errors'].append(f"#{n}: {e}")
+                continue
+
+            existing = orders.get(oid)
+            if existing == record:
+                report['unchanged'] += 1
+                continue
+            report['updated' if existing else 'inserted'] += 1
+            if apply: put_order(bot_data, oid, record)
+    except ValueError as e:
+        report['fatal'] = str(e)
+    return report
+
+# === РЕЗЕРВНЫЕ КОПИИ ===
+
+BACKUP_TABLES = ('orders', 'users')
+BACKUP_CAPTION_TAG = '#backup'  # Начало подписи к файлу копии; по ней пересланный боту файл узнаётся как копия
+
+def backup_state(bot_data):
+    """bot_data['backup']: номер последней копии, её снимок и ключи, изменённые с тех пор"""
+    return bot_data.setdefault('backup', {
+        'seq': 0, 'base': None, 'snapshot_at': 0.0, 'full': True,
+        'dirty': {table: set() for table in BACKUP_TABLES}, 'files': [],
+    })
+
+def mark_backup_dirty(bot_data, table, key):
+    """Вызывается put_order/put_customer: ключ попадёт в следующую разностную копию"""
+    state = bot_data.get('backup')
+    if state is not None: state['dirty'][table].add(key)
+
+def request_full_backup(bot_data):
+    """Следующая копия будет полным снимком (база заменена целиком)"""
+    state = bot_data.get('backup')
+    if state is not None: state['full'] = True
 
-async def get_main_keyboard():
-    web_app_url = "https://kovka007.vercel.app"
-    return ReplyKeyboardMarkup([
-        [KeyboardButton("🏗 Открыть конструктор", web_app=WebAppInfo(url=web_app_url))],
-        [KeyboardButton("📄 Мой заказ"), KeyboardButton("✏️ Добавить пожелания/фото")],
-        [KeyboardButton("📚 Как пользоваться"), KeyboardButton("📞 Отправить телефон и оформить", request_contact=True)]
-    ], resize_keyboard=True)
+def build_backup_file(rows):
+    """JSON Lines, сжатые gzip: {"t": таблица, "k": ключ, "v": запись или null (удалена)}.
+    Возвращает (байты, sha256). Вызывается в потоке"""
+    packer = zlib.compressobj(6, zlib.DEFLATED, 31)
+    chunks = []
+    buffer = io.StringIO()
+    for n, (table, key, value) in enumerate(rows, 1):
+        buffer.write(json.dumps({'t': table, 'k': key, 'v': value}, ensure_ascii=False, default=str) + '\n')
+        if n % 1000 == 0:
+            chunks.append(packer.compress(buffer.getvalue().encode('utf-8')))
+            buffer.seek(0)
+            buffer.truncate()
+    chunks.append(packer.compress(buffer.getvalue().encode('utf-8')))
+    chunks.append(packer.flush())
+    payload = b''.join(chunks)
+    return payload, hashlib.sha256(payload).hexdigest()
 
-async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.effective_user: return True
-    if update.effective_user.id in ADMIN_IDS: return True
+def read_backup_file(payload, sha256):
+    """Строки копии после проверки контрольной суммы. Вызывается в потоке"""
+    if hashlib.sha256(payload).hexdigest() != sha256: raise ValueError("контрольная сумма не совпадает")
+    text = zlib.decompress(payload, 31).decode('utf-8')
+    return [json.loads(line) for line in text.splitlines() if line]
+
+async def run_backup(application, force_snapshot=False):
+    """Делает снимок или разностную копию и отправляет её. Возвращает запись манифеста или None"""
+    bot_data = application.bot_data
+    state = backup_state(bot_data)
+    snapshot = force_snapshot or state['full'] or state['base'] is None or time.time() - state['snapshot_at'] >= BACKUP_SNAPSHOT_INTERVAL
+    dirty = state['dirty']
+    if not snapshot and not any(dirty.values()): return None
+
+    # Ключи забираем сразу: изменения во время отправки попадут уже в следующую копию
+    state['dirty'] = {table: set() for table in BACKUP_TABLES}
+    sources = {'orders': get_orders(bot_data), 'users': get_users(bot_data)}
+    if snapshot:
+        rows = [(table, key, value) for table in BACKUP_TABLES for key, value in list(sources[table].items())]
+    else:
+        rows = [(table, key, sources[table].get(key)) for table in BACKUP_TABLES for key in dirty[table]]
+
+    seq = state['seq'] + 1
+    entry = {
+        'seq': seq, 'kind': 'snapshot' if snapshot else 'delta', 'base': seq if snapshot else state['base'],
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'orders': sum(1 for row in rows if row[0] == 'orders'), 'users': sum(1 for row in rows if row[0] == 'users'),
+    }
     try:
-        member = await context.bot.get_chat_member(chat_id=INFO_CHANNEL_ID, user_id=update.effective_user.id)
-        if member.status in ['left', 'kicked', 'restricted']: return False
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка проверки подписки: {e}")
-        return True
+        payload, entry['sha256'] = await asyncio.to_thread(build_backup_file, rows)
+        entry['file'] = f"backup-{seq:06d}-{entry['kind']}-{datetime.now():%Y%m%d-%H%M%S}.jsonl.gz"
+        entry['bytes'] = len(payload)
+        await deliver_backup(application, entry, payload)
+    except Exception:
+        # Не отправили - ключи вернутся в следующую попытку
+        for table in BACKUP_TABLES: state['dirty'][table] |= dirty[table]
+        raise
 
-async def ask_subscription(update: Update):
-    kb = [[InlineKeyboardButton("📢 Подписаться", url=INFO_CHANNEL_LINK)], [InlineKeyboardButton("✅ Я подписался", callback_data="check_sub")]]
-    await update.message.reply_text("🚫 <b>Доступ ограничен!</b>\nПодпишитесь на канал.", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+    state['seq'] = seq
+    if snapshot:
+        state.update(base=seq, snapshot_at=time.time(), full=False)
+        state['files'] = []
+    state['files'].append(entry)
+    return entry
 
-def format_order_message(order, user_name, user_link, phone, comment, status_code=1, for_admin=True):
-    rtype = ROOF_TYPES.get(order.get('type'), order.get('type'))
-    mat = MATERIALS.get(order.get('material'), order.get('material'))
-    paint = PAINTS.get(order.get('paint'), order.get('paint'))
+async def deliver_backup(application, entry, payload):
+    if BACKUP_DIR:
+        def write():
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+            with open(os.path.join(BACKUP_DIR, entry['file']), 'wb') as f: f.write(payload)
+            with open(os.path.join(BACKUP_DIR, 'manifest.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            if entry['kind'] == 'snapshot': prune_backup_dir(BACKUP_DIR, BACKUP_KEEP)
+        await asyncio.to_thread(write)
+    if BACKUP_CHAT_ID:
+        # Манифест в подписи: если база пропала вместе с диском, файлы пересылаются боту и проверяются по ней
+        message = await application.bot.send_document(
+            BACKUP_CHAT_ID, document=payload, filename=entry['file'],
+            caption=f"{BACKUP_CAPTION_TAG} " + json.dumps({k: v for k, v in entry.items() if k != 'file_id'}),
+        )
+        entry['file_id'] = message.document.file_id
 
-    opts = order.get('opts', {})
-    opt_list = []
-    if opts.get('trusses'): opt_list.append("✅ Усил. фермы")
-    if opts.get('gutters'): opt_list.append("✅ Водостоки")
-    if opts.get('walls'): opt_list.append("✅ Зашивка")
-    if opts.get('found'): opt_list.append("✅ Фундамент")
-    if opts.get('install'): opt_list.append("✅ Монтаж")
-    opt_str = "\n".join(opt_list) if opt_list else "Базовая"
+def read_backup_manifest(directory):
+    path = os.path.join(directory, 'manifest.jsonl')
+    if not os.path.exists(path): return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
 
-    header = f"🚨 <b>НОВАЯ ЗАЯВКА!</b>\nСтатус: {STATUS_MAP.get(status_code, '?')}" if for_admin else "📋 <b>ВАШ ЗАКАЗ:</b>"
+def prune_backup_dir(directory, keep):
+    """Оставляет keep последних снимков с их разностными копиями"""
+    entries = read_backup_manifest(directory)
+    bases = sorted({entry['base'] for entry in entries})
+    drop = set(bases[:-keep]) if keep and len(bases) > keep else set()
+    if not drop: return
+    for entry in entries:
+        if entry['base'] in drop:
+            try: os.remove(os.path.join(directory, entry['file']))
+            except FileNotFoundError: pass
+    with open(os.path.join(directory, 'manifest.jsonl'), 'w', encoding='utf-8') as f:
+        for entry in entries:
+            if entry['base'] not in drop: f.write(json.dumps(entry) + '\n')
 
-    user_info = (
-        f"👤 <b>Клиент:</b> {user_name}\n"
-        f"🔗 <b>Link:</b> {user_link}\n"
-        f"📞 <b>Phone:</b> <code>{phone}</code>\n"
-        f"💬 <b>Пожелания:</b> {comment}\n"
-    ) if for_admin else ""
+def backup_chain(entries, upto=None):
+    """Последний снимок (не новее upto) и идущие за ним без пропусков разностные копии"""
+    entries = sorted((e for e in entries if upto is None or e['seq'] <= upto), key=lambda e: e['seq'])
+    snapshots = [e for e in entries if e['kind'] == 'snapshot']
+    if not snapshots: return []
+    chain = [snapshots[-1]]
+    for entry in entries:
+        if entry['kind'] == 'delta' and entry['base'] == chain[0]['seq'] and entry['seq'] > chain[-1]['seq']:
+            if entry['seq'] != chain[-1]['seq'] + 1: break  # Пропуск в цепочке: дальше данные неполные
+            chain.append(entry)
+    return chain
 
-    return (
-        f"{header}\n"
-        f"➖➖➖➖➖➖➖➖➖➖\n"
-        f"{user_info if for_admin else ''}"
-        f"🆔 <b>ID:</b> <code>{order.get('id')}</code>\n"
-        f"🏗 <b>Тип:</b> {rtype}\n"
-        f"📏 <b>Длина:</b> {order.get('length')} м\n"
-        f"📏 <b>Ширина:</b> {order.get('width')} м\n"
-        f"↕️ <b>Высота (столб):</b> {order.get('height')} м\n"
-        f"🏔 <b>Высота (общ):</b> ~{order.get('height_peak')} м\n"
-        f"📐 <b>Уклон:</b> {order.get('slope')}°\n"
-        f"🧱 <b>Сечение:</b> {order.get('pillar')}\n"
-        f"➖➖➖➖➖➖➖➖➖➖\n"
-        f"🔲 <b>S пола:</b> {order.get('area_floor')} м²\n"
-        f"🏠 <b>S кровли:</b> {order.get('area_roof')} м²\n"
-        f"🏠 <b>Материал:</b> {mat}\n"
-        f"🎨 <b>Покраска:</b> {paint}\n"
-        f"🖌 <b>Цвет:</b> {order.get('color_frame')} / {order.get('color_roof')}\n"
-        f"➖➖➖➖➖➖➖➖➖➖\n"
-        f"🛠 <b>Опции:</b>\n{opt_str}\n"
-        f"➖➖➖➖➖➖➖➖➖➖\n"
-        f"💰 <b>ИТОГО: {order.get('price', 0):,} руб.</b>"
-    )
+async def apply_backup(bot_data, entry, rows):
+    """Накатывает одну копию: снимок заменяет заказы и клиентов целиком, разностная - по ключам"""
+    if entry['kind'] == 'snapshot':
+        tables = {table: {} for table in BACKUP_TABLES}
+        for row in rows:
+            if row['v'] is not None: tables[row['t']][row['k']] = row['v']
+        # Новые словари - индексы перестраиваются за один проход сразу, чтобы сохранение
+        # сравнило с хранилищем уже их, а не прежние словари
+        bot_data['orders'], bot_data['users'] = tables['orders'], tables['users']
+        get_users(bot_data)
+        return
+    for n, row in enumerate(rows, 1):
+        if n % 500 == 0: await asyncio.sleep(0)
+        if row['t'] == 'orders': put_order(bot_data, row['k'], row['v'])
+        else: put_customer(bot_data, row['k'], row['v'])
+
+async def restore_backup(application, chain, read):
+    """Проверяет и накатывает цепочку копий. read(entry) -> байты файла"""
+    started = time.perf_counter()
+    loaded = []
+    # Сначала читаем и проверяем всё: при битом файле база остаётся нетронутой
+    for entry in chain:
+        payload = await read(entry)
+        try:
+            loaded.append((entry, await asyncio.to_thread(read_backup_file, payload, entry['sha256'])))
+        except ValueError as e:
+            raise ValueError(f"{entry['file']}: {e}")
+    for entry, rows in loaded:
+        await apply_backup(application.bot_data, entry, rows)
+    get_users(application.bot_data)
+    request_full_backup(application.bot_data)
+    return time.perf_counter() - started
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        entry = await run_backup(context.application)
+    except Exception as e:
+        logger.error(f"❌ Резервная копия не создана: {e}")
+        return
+    if entry:
+        logger.info(
+            f"💾 Резервная копия #{entry['seq']} ({entry['kind']}): заказов {entry['orders']}, "
+            f"клиентов {entry['users']}, {entry['bytes'] // 1024} КБ"
+        )
+
+async def _read_backup_entry(application, entry):
+    path = os.path.join(BACKUP_DIR, entry['file']) if BACKUP_DIR else None
+    if path and os.path.exists(path):
+        def read():
+            with open(path, 'rb') as f: return f.read()
+        return await asyncio.to_thread(read)
+    # Bot API отдаёт боту файлы до 20 МБ; снимок больше - только из BACKUP_DIR или пересылкой
+    file = await application.bot.get_file(entry['file_id'])
+    return bytes(await file.download_as_bytearray())
+
+def available_backups(bot_data):
+    """Манифест копий: из BACKUP_DIR, иначе отправленные в чат файлы текущей цепочки"""
+    if BACKUP_DIR: return read_backup_manifest(BACKUP_DIR)
+    return [entry for entry in backup_state(bot_data)['files'] if entry.get('file_id')]
 
 # === КОРОТКОЕ ПРИВЕТСТВИЕ ===
 
@@ -232,6 +3535,7 @@ async def show_instruction(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message or update.channel_post
     if not msg: return
+    if not is_admin(update): return
 
     text = (
         "👮‍♂️ <b>ПАНЕЛЬ АДМИНИСТРАТОРА:</b>\n\n"
@@ -240,126 +3544,498 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🔹 <code>/order clean</code> - Очистить базу заказов\n"
         "🔹 <code>/order ID</code> - Перейти к заказу\n"
         "🔹 <code>/buyer</code> - Список клиентов\n"
-        "🔹 <code>/clean</code> - Удалить последние 50 сообщений\n\n"
+        "🔹 <code>/buyer имя|телефон</code> - Поиск клиента\n"
+        "🔹 <code>/find запрос</code> - Поиск заказов по ID, телефону, имени, пожеланиям\n"
+        "🔹 <code>/stats [7d|30d|year|all] [chart]</code> - Статистика продаж (по умолчанию 30 дней)\n"
+        "🔹 <code>/clean [N]</code> - Удалить последние N сообщений (по умолчанию 50)\n"
+        "🔹 <code>/outbox</code> - Очередь и недоставленные уведомления\n"
+        "🔹 <code>/broadcast текст</code> - Рассылка всем клиентам (или ответом на сообщение с фото)\n"
+        "🔹 <code>/quote</code> - Расчёт стоимости по тарифам бота\n"
+        "🔹 <code>/reprice</code> - Перечитать тарифы и пересчитать все заказы\n"
+        "🔹 <code>/backup [full]</code> - Резервная копия сейчас\n"
+        "🔹 <code>/restore</code> - Восстановить из резервных копий\n\n"
         "📂 <b>База данных (Экспорт):</b>\n"
-        "🔹 <code>/export</code> - Скачать базу заказов (CSV)\n\n"
+        "🔹 <code>/export</code> - Скачать базу заказов (CSV)\n"
+        "🔹 <code>/export jsonl gz from=2025-01-01 status=2 type=gable</code> - С фильтрами\n\n"
         "📥 <b>Импорт:</b>\n"
-        "Отправьте .json файл с подписью:\n"
-        "<code>/import_db</code> - Загрузить базу заказов"
+        "Отправьте .json или .jsonl файл с подписью:\n"
+        "<code>/import_db</code> - Добавить/обновить заказы (слияние по ID)\n"
+        "<code>/import_db dry</code> - Только проверить файл"
+    )
+    sub = subscription_cache.stats()
+    text += (
+        f"\n\n📈 <b>Кэш подписок:</b> {sub['hits']} попаданий / {sub['misses']} промахов "
+        f"({sub['hit_rate']:.0%}), записей: {sub['size']}"
+    )
+    queue = context.application.update_processor.wait_stats()
+    text += (
+        f"\n⏱ <b>Очередь обновлений:</b> среднее {queue['avg'] * 1000:.0f} мс, "
+        f"макс {queue['max'] * 1000:.0f} мс, активных чатов: {queue['active_chats']}"
     )
     await msg.reply_text(text, parse_mode=ParseMode.HTML)
 
 async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS: return
+    if not is_admin(update): return
     orders = context.bot_data.get('orders', {})
     if not orders:
         await update.message.reply_text("📭 База пуста.")
         return
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID', 'Дата', 'Статус', 'Имя', 'Телефон', 'Тип', 'Ширина', 'Длина', 'Цена', 'Комментарий'])
-
-    for oid, info in orders.items():
-        data = info.get('data', {})
-        user = info.get('user', {})
-        writer.writerow([
-            oid, info.get('timestamp', '')[:10], STATUS_MAP.get(info.get('status', 1)),
-            user.get('name', ''), user.get('phone', ''),
-            ROOF_TYPES.get(data.get('type')), data.get('width'), data.get('length'),
-            data.get('price'), info.get('comment', '')
-        ])
-
-    output.seek(0)
-    file_bytes = io.BytesIO(output.getvalue().encode('utf-8-sig'))
-    file_bytes.name = f"orders_{datetime.now().strftime('%d-%m')}.csv"
-    await update.message.reply_document(document=file_bytes, caption=f"📊 Заказов: {len(orders)}")
+    try:
+        opts = parse_export_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n{EXPORT_USAGE}", parse_mode=ParseMode.HTML)
+        return
+
+    stats = {}
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as output:
+        for chunk in iter_export_chunks(orders, opts, stats):
+            output.write(chunk)
+            await asyncio.sleep(0)  # Не держим event loop на больших базах
+        size = output.tell()
+
+        if not stats['rows']:
+            await update.message.reply_text("📭 Под фильтр ничего не попало.")
+            return
+
+        if size > EXPORT_DOCUMENT_LIMIT:
+            if EXPORT_TOKEN and PUBLIC_URL:
+                link = f"{PUBLIC_URL.rstrip('/')}/export?{urlencode(sign_export_query(opts))}"
+                await update.message.reply_text(
+                    f"📦 Выгрузка ({size // 1024 // 1024} МБ) больше лимита Telegram.\n"
+                    f"Скачать (ссылка действует {EXPORT_LINK_TTL // 60} мин): {link}"
+                )
+            else:
+                await update.message.reply_text("❌ Выгрузка больше лимита Telegram. Сузьте фильтр или включите gz.")
+            return
+
+        output.seek(0)
+        # Выгрузка больше EXPORT_SPOOL_BYTES уже на диске - отдаём сам файл, без копии в байтах у нас.
+        # Маленькая лежит в памяти, а у такого спула name=None, и PTB на нём падает - её отдаём байтами
+        document = output if size > EXPORT_SPOOL_BYTES else output.read()
+        await update.message.reply_document(
+            document=document, filename=export_filename(opts), caption=f"📊 Заказов: {stats['rows']}"
+        )
 
 async def handle_document_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS: return
+    if not is_admin(update): return
+
+    if (update.message.caption or '').startswith(BACKUP_CAPTION_TAG):
+        await restore_forwarded_backup(update, context)
+        return
+    caption = (update.message.caption or '').split()
+    if not caption or caption[0] != "/import_db": return
+    dry_run = any(arg in ('dry', '--dry-run') for arg in caption[1:])
+
+    file = await update.message.document.get_file()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = await file.download_to_drive(os.path.join(tmp, 'import.json'))
+        with open(path, encoding='utf-8-sig') as fp:
+            report = await import_orders(fp, context.bot_data, dry_run)
+
+    if dry_run: title = "🧪 Проверка импорта (без записи)"
+    elif report['fatal']: title = "⛔️ Импорт отменён, база не изменена. До ошибки в файле найдено"
+    else: title = "✅ Импорт завершён"
+    text = (
+        f"{title}\n"
+        f"➕ Добавлено: {report['inserted']}\n"
+        f"♻️ Обновлено: {report['updated']}\n"
+        f"▫️ Без изменений: {report['unchanged']}\n"
+        f"❌ Отклонено: {report['rejected']}"
+    )
+    if report['errors']: text += "\n\n" + "\n".join(report['errors'])
+    if report['fatal']: text += f"\n\n⛔️ Разбор остановлен: {report['fatal']}"
+    await update.message.reply_text(text)
+
+async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+    if not BACKUP_DIR and not BACKUP_CHAT_ID:
+        await msg.reply_text("❌ Резервные копии выключены: задайте BACKUP_DIR или BACKUP_CHAT_ID")
+        return
+    try:
+        entry = await run_backup(context.application, force_snapshot=bool(context.args and context.args[0] == 'full'))
+    except Exception as e:
+        await msg.reply_text(f"❌ Копия не создана: {e}")
+        return
+    if not entry:
+        await msg.reply_text("💾 С последней копии ничего не изменилось.")
+        return
+    await msg.reply_text(
+        f"💾 Копия #{entry['seq']} ({'снимок' if entry['kind'] == 'snapshot' else 'изменения'}): "
+        f"заказов {entry['orders']}, клиентов {entry['users']}, {entry['bytes'] // 1024} КБ"
+    )
+
+async def cmd_restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+    args = context.args or []
+    upto = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+    chain = backup_chain(available_backups(context.bot_data), upto)
+    if not chain:
+        await msg.reply_text(
+            "📭 Копий не найдено. Если база потеряна вместе с диском, перешлите боту файлы "
+            f"из чата копий (сначала снимок, затем изменения по порядку) - подпись {BACKUP_CAPTION_TAG} сохранится."
+        )
+        return
+
+    last = chain[-1]
+    if not args or args[0] != 'go':
+        await msg.reply_text(
+            f"💾 Снимок #{chain[0]['seq']} от {chain[0]['created']} + изменений: {len(chain) - 1}\n"
+            f"Состояние на {last['created']} (копия #{last['seq']}).\n\n"
+            "⚠️ Текущие заказы и клиенты будут заменены.\n"
+            "<code>/restore go</code> - восстановить, <code>/restore go N</code> - на копию N",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    status = await msg.reply_text(f"⏳ Восстанавливаю {len(chain)} файлов...")
+    try:
+        seconds = await restore_backup(context.application, chain, lambda entry: _read_backup_entry(context.application, entry))
+    except (ValueError, TelegramError, OSError) as e:
+        await status.edit_text(f"❌ Восстановление отменено, база не изменена: {e}")
+        return
+    orders = get_orders(context.bot_data)
+    await status.edit_text(
+        f"✅ Восстановлено на копию #{last['seq']} за {seconds:.1f} с: заказов {len(orders)}, "
+        f"клиентов {len(get_users(context.bot_data))}"
+    )
+
+async def restore_forwarded_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Файл копии, пересланный боту: снимок заменяет базу, изменения накатываются строго по порядку"""
+    try:
+        entry = json.loads(update.message.caption[len(BACKUP_CAPTION_TAG):])
+    except ValueError:
+        await update.message.reply_text("❌ Подпись копии повреждена")
+        return
+    progress = context.bot_data.get('backup_restore') or {}
+    if entry['kind'] == 'delta' and (entry['base'] != progress.get('base') or entry['seq'] != progress.get('seq', 0) + 1):
+        await update.message.reply_text(
+            f"❌ Копия #{entry['seq']} не продолжает восстановленную цепочку "
+            f"(последняя: #{progress.get('seq', '—')}). Нужен снимок #{entry['base']} и копии после него по порядку."
+        )
+        return
 
-    if update.message.caption == "/import_db":
+    async def read(_):
         file = await update.message.document.get_file()
-        content = await file.download_as_bytearray()
-        try:
-            data = json.loads(content.decode())
-            context.bot_data['orders'] = data
-            await update.message.reply_text(f"✅ База восстановлена! Записей: {len(data)}")
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка: {e}")
+        return bytes(await file.download_as_bytearray())
+
+    try:
+        await restore_backup(context.application, [entry], read)
+    except (ValueError, TelegramError) as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    context.bot_data['backup_restore'] = {'base': entry['base'], 'seq': entry['seq']}
+    await update.message.reply_text(
+        f"✅ Копия #{entry['seq']} ({'снимок' if entry['kind'] == 'snapshot' else 'изменения'}) применена: "
+        f"заказов {len(get_orders(context.bot_data))}"
+    )
 
 async def cmd_clean(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message or update.channel_post
     if not msg: return
-    await msg.reply_text("🗑 Чищу...")
-    try:
-        mid = msg.message_id
-        for i in range(50):
-            try: await context.bot.delete_message(msg.chat.id, mid - i)
-            except: pass
-    except: pass
+    if not is_admin(update): return
+    count = int(context.args[0]) if context.args and context.args[0].isdigit() else 50
+    if count < 1:
+        await msg.reply_text("❌ Сколько сообщений удалить? Например: /clean 20")
+        return
+    message_ids = message_tracker.latest(msg.chat.id, min(count, CLEAN_TRACK_LIMIT))
+    status = await msg.reply_text(f"🗑 Чищу {len(message_ids)}...")
+
+    semaphore = asyncio.Semaphore(CLEAN_CONCURRENCY)
+    resume_at = 0.0  # Общая пауза для всех воркеров после RetryAfter
+
+    async def delete(message_id):
+        nonlocal resume_at
+        async with semaphore:
+            for _ in range(3):
+                delay = resume_at - time.monotonic()
+                if delay > 0: await asyncio.sleep(delay)
+                try:
+                    await context.bot.delete_message(msg.chat.id, message_id)
+                    return True
+                except RetryAfter as e:
+                    resume_at = time.monotonic() + e.retry_after
+                except TelegramError as e:
+                    logger.debug(f"Не удалось удалить {message_id}: {e}")
+                    return False
+            return False
+
+    results = await asyncio.gather(*(delete(mid) for mid in message_ids))
+    message_tracker.forget(msg.chat.id, message_ids)
+    deleted = sum(results)
+    await status.edit_text(f"🗑 Удалено: {deleted}, не удалось: {len(results) - deleted}")
 
 async def cmd_order_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message or update.channel_post
     if not msg: return
+    if not is_admin(update): return
 
     args = context.args
     orders = context.bot_data.get('orders', {})
 
     if args and args[0] == 'clean':
         context.bot_data['orders'] = {}
+        get_orders(context.bot_data)  # Индексы и сохранение переключаются на новый словарь
+        request_full_backup(context.bot_data)
         await msg.reply_text("🗑 База очищена.")
         return
 
     if args:
         oid = args[0]
         if oid in orders:
-            if update.effective_user: context.user_data['admin_edit_order'] = oid
-            o = orders[oid]
-            status_txt = STATUS_MAP.get(o['status'], 'New')
-            text = (
-                f"📦 <b>{oid}</b>\nСтатус: {status_txt}\nКлиент: {o['user']['name']} ({o['user']['phone']})\n"
-                f"💰 {o['data']['price']:,} руб.\n\n"
-                f"👇 Отправьте цифру для смены статуса (в личке):\n1 - Ожидает, 2 - В работе, 3 - Сдан"
-            )
-            await msg.reply_text(text, parse_mode=ParseMode.HTML)
+            text, markup = render_order_detail(oid, orders[oid])
+            await msg.reply_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
         else:
             await msg.reply_text("❌ Не найдено.")
         return
 
-    text = "📂 <b>ЗАКАЗЫ:</b>\n"
-    for oid, info in list(orders.items())[-10:]:
-        icon = "🟡" if info['status']==1 else "🟢"
-        text += f"{icon} <code>{oid}</code> | {info['data']['price']:,}\n"
-    await msg.reply_text(text, parse_mode=ParseMode.HTML)
+    text, markup = render_order_page(context.bot_data)
+    await msg.reply_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+def render_order_detail(oid, o):
+    """Ответ на /order ID с кнопками смены статуса"""
+    status_txt = STATUS_MAP.get(o.get('status', 1), 'New')
+    text = (
+        f"📦 <b>{oid}</b>\nСтатус: {status_txt}\nКлиент: {o['user']['name']} ({o['user']['phone']})\n"
+        f"💰 {o['data']['price']:,} руб."
+    )
+    return text, order_status_keyboard(oid, o.get('status', 1))
+
+def render_order_page(bot_data, status=None, offset=0):
+    """Страница списка заказов с фильтрами по статусу и листанием (callback orders:<статус>:<сдвиг>)"""
+    orders = get_orders(bot_data)
+    oids, total = order_index.page(status, offset)
+    title = STATUS_MAP[status] if status else "все"
+    text = f"📂 <b>ЗАКАЗЫ</b> ({title}, {total}):\n"
+    for oid in oids:
+        info = orders[oid]
+        icon = STATUS_MAP.get(info.get('status', 1), '?').split()[0]
+        text += f"{icon} <code>{oid}</code> | {info['data'].get('price', 0):,} | {(info.get('timestamp') or '')[:10]}\n"
+    if not oids: text += "📭 Пусто."
+
+    filters_row = [
+        InlineKeyboardButton(("• " if (status or 0) == code else "") + label, callback_data=f"orders:{code}:0")
+        for code, label in [(0, "Все")] + [(code, name.split()[0]) for code, name in STATUS_MAP.items()]
+    ]
+    nav_row = []
+    if offset + ORDER_PAGE_SIZE < total:
+        nav_row.append(InlineKeyboardButton("◀️ Старее", callback_data=f"orders:{status or 0}:{offset + ORDER_PAGE_SIZE}"))
+    if offset > 0:
+        nav_row.append(InlineKeyboardButton("Новее ▶️", callback_data=f"orders:{status or 0}:{max(offset - ORDER_PAGE_SIZE, 0)}"))
+    return text, InlineKeyboardMarkup([filters_row, nav_row] if nav_row else [filters_row])
 
 async def cmd_buyers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message or update.channel_post
     if not msg: return
-    users = context.bot_data.get('users', {})
+    if not is_admin(update): return
+    users = get_users(context.bot_data)
     if not users:
         await msg.reply_text("📭 Пусто.")
         return
-    text = "👥 <b>КЛИЕНТЫ:</b>\n" + "\n".join([v for k, v in users.items()])
-    await msg.reply_text(text[:4000])
+
+    if context.args:
+        # Поиск по имени, @username или цифрам телефона, от лучших совпадений и недавних клиентов
+        query = " ".join(context.args)
+        found = [format_customer_line(users[uid]) for uid in search_customers(context.bot_data, query)[:CUSTOMER_PAGE_SIZE]]
+        text = f"🔎 <b>КЛИЕНТЫ по запросу «{html.escape(query)}»:</b>\n" + ("\n".join(found) or "📭 Не найдено.")
+        await msg.reply_text(text, parse_mode=ParseMode.HTML)
+        return
+
+    text, markup = render_customer_page(context.bot_data)
+    await msg.reply_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+async def cmd_find(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+    if not context.args:
+        await msg.reply_text(
+            "Формат: <code>/find запрос</code> - ID или его начало, телефон (можно последние цифры), "
+            "имя, @username, слова из пожеланий", parse_mode=ParseMode.HTML
+        )
+        return
+
+    # Запрос не помещается в callback_data - листание берёт его из chat_data
+    context.chat_data['find_query'] = " ".join(context.args)
+    text, markup = render_find_page(context.bot_data, context.chat_data['find_query'])
+    await msg.reply_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+    try:
+        days, chart = parse_stats_args(context.args or [])
+    except ValueError as e:
+        await msg.reply_text(f"❌ {e}\nФормат: <code>/stats [7d|30d|90d|year|all] [chart]</code>", parse_mode=ParseMode.HTML)
+        return
+
+    get_orders(context.bot_data)  # Перестраивает итоги, если базу заменили (/order clean)
+    summary, series = order_stats.period(days)
+    points, weekly = stats_series(series, days)
+    await msg.reply_text(format_stats(summary, points, weekly, days), parse_mode=ParseMode.HTML)
+    if not chart or not points: return
+    try:
+        # Отрисовка занимает сотни миллисекунд - в потоке, чтобы не держать остальных пользователей
+        png = await asyncio.to_thread(render_stats_chart, points, weekly)
+    except ImportError:
+        await msg.reply_text("📉 Для графика нужен пакет matplotlib")
+        return
+    await msg.reply_photo(photo=png)
 
 async def handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.channel_post
     if not msg or not msg.text: return
+    # Бота могут добавить и в чужой канал - команды принимаем только из админ-канала
+    if msg.chat.id != ADMIN_CHANNEL_ID: return
 
     text = msg.text.split()
     cmd = text[0]
-    update.message = update.channel_post
     context.args = text[1:]
 
     if cmd == "/admin": await cmd_help(update, context)
     elif cmd == "/clean": await cmd_clean(update, context)
     elif cmd == "/order": await cmd_order_list(update, context)
     elif cmd == "/buyer": await cmd_buyers(update, context)
+    elif cmd == "/find": await cmd_find(update, context)
+    elif cmd == "/stats": await cmd_stats(update, context)
+    elif cmd == "/backup": await cmd_backup(update, context)
+    elif cmd == "/restore": await cmd_restore(update, context)
+    elif cmd == "/outbox": await cmd_outbox(update, context)
+    elif cmd == "/broadcast": await cmd_broadcast(update, context)
+    elif cmd == "/quote": await cmd_quote(update, context)
+    elif cmd == "/reprice": await cmd_reprice(update, context)
+
+QUOTE_USAGE = (
+    "Формат: <code>/quote ID</code> или "
+    "<code>/quote тип материал покраска ДЛИНАxШИРИНА [h=2.5] [trusses gutters walls found install]</code>\n"
+    f"Типы: {', '.join(ROOF_TYPES)}\nМатериалы: {', '.join(MATERIALS)}\nПокраска: {', '.join(PAINTS)}"
+)
+
+def parse_quote_args(args):
+    """/quote gable polycarbonate ral 6x4 h=3 gutters install -> заказ в формате конструктора"""
+    if len(args) < 4: raise ValueError("не хватает параметров")
+    rtype, material, paint, size = args[:4]
+    if rtype not in ROOF_TYPES: raise ValueError(f"неизвестный тип {rtype}")
+    if material not in MATERIALS: raise ValueError(f"неизвестный материал {material}")
+    if paint not in PAINTS: raise ValueError(f"неизвестная покраска {paint}")
+    try: length, width = (float(x.replace(',', '.')) for x in size.lower().replace('х', 'x').split('x'))
+    except ValueError: raise ValueError(f"размер {size}: нужно ДЛИНАxШИРИНА")
+    order = {'type': rtype, 'material': material, 'paint': paint, 'length': length, 'width': width, 'opts': {}}
+    for arg in args[4:]:
+        if arg.startswith('h='): order['height'] = _num(arg[2:], None)
+        elif arg in PRICE_OPTIONS: order['opts'][arg] = True
+        else: raise ValueError(f"непонятный параметр {arg}")
+    return order
+
+def format_quote(quote):
+    lines = [f"🏗 Каркас: {quote['frame']:,.0f} руб.", f"🏠 Кровля: {quote['roof']:,.0f} руб."]
+    lines += [f"✅ {label}: {quote[name]:,.0f} руб." for name, label in PRICE_OPTIONS.items() if quote[name]]
+    lines.append(f"💰 <b>Итого: {quote['total']:,} руб.</b>")
+    return "\n".join(lines)
+
+async def cmd_quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+
+    args = context.args or []
+    orders = context.bot_data.get('orders', {})
+    if len(args) == 1 and args[0] in orders:
+        data = orders[args[0]]['data']
+        quote = price_list.quote(data)
+        if quote['total'] is None:
+            await msg.reply_text("❌ Тип, материал или покраска заказа не из справочника.")
+            return
+        stored = _num(data.get('price'))  # Из конструктора цена бывает строкой
+        text = (
+            f"🧮 <b>{args[0]}</b> (тарифы {price_list.version})\n{format_quote(quote)}\n"
+            f"В заказе: {stored:,.0f} руб. ({price_deviation(stored, quote['total']):+.1%})"
+        )
+        await msg.reply_text(text, parse_mode=ParseMode.HTML)
+        return
+
+    try:
+        order = parse_quote_args(args)
+    except ValueError as e:
+        await msg.reply_text(f"❌ {e}\n{QUOTE_USAGE}" if args else QUOTE_USAGE, parse_mode=ParseMode.HTML)
+        return
+    await msg.reply_text(f"🧮 <b>Расчёт</b> (тарифы {price_list.version})\n{format_quote(price_list.quote(order))}", parse_mode=ParseMode.HTML)
+
+async def cmd_reprice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перечитывает PRICE_LIST и пересчитывает все заказы; расхождения по каждому - в CSV"""
+    global price_list
+    msg = update.message or update.channel_post
+    if not msg: return
+    if not is_admin(update): return
+
+    try:
+        price_list = PriceList.load(PRICE_LIST)
+    except (OSError, ValueError, KeyError) as e:
+        await msg.reply_text(f"❌ Не удалось прочитать {PRICE_LIST}: {e}")
+        return
+    context.bot_data['price_list_version'] = price_list.version
+
+    orders = get_orders(context.bot_data)
+    if not orders:
+        await msg.reply_text("📭 База пуста.")
+        return
+    rows, summary = await asyncio.to_thread(reprice_orders, orders)
+
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=';')
+    writer.writerow(['ID', 'Цена в заказе', 'Расчёт', 'Расхождение, %'])
+    writer.writerows((oid, stored, total, f"{dev * 100:.1f}") for oid, stored, total, dev in rows)
+    await msg.reply_document(
+        document=('\ufeff' + output.getvalue()).encode('utf-8'),
+        filename=f"reprice_{price_list.version}.csv",
+        caption=format_reprice_summary(summary),
+        parse_mode=ParseMode.HTML
+    )
 
 # === ПОЛЬЗОВАТЕЛЬСКИЕ ХЕНДЛЕРЫ ===
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.data.startswith("orders:"):
+        if update.effective_user.id not in ADMIN_IDS:
+            await query.answer()
+            return
+        _, status, offset = query.data.split(":")
+        text, markup = render_order_page(context.bot_data, int(status) or None, int(offset))
+        await query.answer()
+        try: await query.edit_message_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+        except BadRequest: pass  # Повторное нажатие того же фильтра - текст не изменился
+        return
+
+    if query.data.startswith("find:"):
+        if update.effective_user.id not in ADMIN_IDS or 'find_query' not in context.chat_data:
+            await query.answer()
+            return
+        text, markup = render_find_page(context.bot_data, context.chat_data['find_query'], int(query.data.split(":")[1]))
+        await query.answer()
+        await query.edit_message_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+        return
+
+    if query.data.startswith("st:"):
+        await change_order_status(update, context)
+        return
+
+    if query.data.startswith("buyers:"):
+        if update.effective_user.id not in ADMIN_IDS:
+            await query.answer()
+            return
+        _, direction, cursor = query.data.split(":", 2)
+        ts, user_id = cursor.rsplit(":", 1)
+        text, markup = render_customer_page(context.bot_data, (ts, int(user_id)), 'newer' if direction == 'n' else 'older')
+        await query.answer()
+        await query.edit_message_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+        return
+
     if update.callback_query.data == "check_sub":
         if await check_subscription(update, context):
             await update.callback_query.message.delete()
@@ -373,14 +4049,6 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     text = update.message.text.strip()
 
-    # Обработка смены статуса для админа
-    if update.effective_user.id in ADMIN_IDS and text in ['1', '2', '3']:
-        edit_id = context.user_data.get('admin_edit_order')
-        if edit_id and edit_id in context.bot_data.get('orders', {}):
-            context.bot_data['orders'][edit_id]['status'] = int(text)
-            await update.message.reply_text(f"✅ Статус обновлен: {STATUS_MAP[int(text)]}")
-            return
-
     # Обработка JSON данных из конструктора
     if text.startswith('{') and text.endswith('}'):
         try:
@@ -444,25 +4112,54 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('wait_comment'):
-        if 'user_photos' not in context.user_data: 
-            context.user_data['user_photos'] = []
+    group_id = update.message.media_group_id
+    collecting = group_id and context.user_data.get('pending_album') == group_id
+    if not context.user_data.get('wait_comment') and not collecting: return
 
-        context.user_data['user_photos'].append(update.message.photo[-1].file_id)
+    photo = update.message.photo[-1]
+    photos = context.user_data.setdefault('user_photos', [])
+    photo_uids = context.user_data.setdefault('user_photo_uids', [])
+    # Одно и то же фото (повторная отправка, пересылка) храним один раз
+    if photo.file_unique_id not in photo_uids and len(photos) < MAX_ORDER_PHOTOS:
+        photos.append(photo.file_id)
+        photo_uids.append(photo.file_unique_id)
 
-        if update.message.caption: 
-            context.user_data['user_comment'] = update.message.caption
+    if update.message.caption:
+        context.user_data.setdefault('pending_captions', []).append(update.message.caption)
 
-        # Если это не медиагруппа или первое фото группы
-        if not update.message.media_group_id or context.user_data.get('last_media_group_id') != update.message.media_group_id:
-            context.user_data['wait_comment'] = False
-            await update.message.reply_text(
-                f"✅ Фотографии ({len(context.user_data['user_photos'])}) сохранены!\n\n"
-                "Теперь вы можете отправить заявку, нажав «📞 Отправить телефон и оформить».",
-                reply_markup=await get_main_keyboard()
-            )
+    if not group_id:
+        await finish_photo_upload(context, update.effective_chat.id)
+        return
+
+    # Альбом приходит отдельными обновлениями: подтверждаем, когда он перестал пополняться
+    context.user_data['pending_album'] = group_id
+    name = f"album:{update.effective_user.id}"
+    for job in context.job_queue.get_jobs_by_name(name): job.schedule_removal()
+    context.job_queue.run_once(
+        finish_album_job, MEDIA_GROUP_DEBOUNCE, name=name, data=group_id,
+        chat_id=update.effective_chat.id, user_id=update.effective_user.id
+    )
+
+async def finish_album_job(context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get('pending_album') != context.job.data: return  # Сессию уже закрыли или начат новый альбом
+    await finish_photo_upload(context, context.job.chat_id)
 
-        context.user_data['last_media_group_id'] = update.message.media_group_id
+async def finish_photo_upload(context: ContextTypes.DEFAULT_TYPE, chat_id):
+    user_data = context.user_data
+    user_data.pop('pending_album', None)
+    user_data.pop('last_media_group_id', None)  # Поле старой версии обработчика
+    captions = list(dict.fromkeys(user_data.pop('pending_captions', [])))
+    if captions: user_data['user_comment'] = "\n".join(captions)
+    user_data['wait_comment'] = False
+
+    count = len(user_data.get('user_photos', []))
+    limit_note = f"\n(сохраняется не больше {MAX_ORDER_PHOTOS} фото)" if count >= MAX_ORDER_PHOTOS else ""
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"✅ Фотографии ({count}) сохранены!{limit_note}\n\n"
+        "Теперь вы можете отправить заявку, нажав «📞 Отправить телефон и оформить».",
+        reply_markup=await get_main_keyboard()
+    )
 
 async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -514,50 +4211,39 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if 'orders' not in context.bot_data: 
-        context.bot_data['orders'] = {}
-    if 'users' not in context.bot_data: 
-        context.bot_data['users'] = {}
-
     oid = order.get('id')
-    context.bot_data['orders'][oid] = {
-        'data': order,
-        'user': {
-            'name': user.first_name, 
-            'phone': phone, 
-            'username': user.username,
-            'user_id': user.id
-        },
-        'status': 1,
-        'comment': comment,
-        'timestamp': datetime.now().isoformat(),
-        'photos_count': len(photos)
-    }
+    now = datetime.now().isoformat()
+    quote = price_list.quote(order)['total']
+    async with shared_rows(context.application, ('orders', oid), ('users', user.id)):
+        put_order(context.bot_data, oid, {
+            'data': order,
+            'user': {
+                'name': user.first_name, 
+                'phone': phone, 
+                'username': user.username,
+                'user_id': user.id
+            },
+            'status': 1,
+            'comment': comment,
+            'timestamp': now,
+            'photos_count': len(photos),
+            'quote': quote
+        })
 
-    context.bot_data['users'][user.id] = f"{user.first_name} (@{user.username}) - {phone}"
+        customer = get_users(context.bot_data).get(user.id) or {}
+        put_customer(context.bot_data, user.id, {
+            'user_id': user.id,
+            'name': user.first_name,
+            'username': user.username,
+            'phone': phone,
+            'first_order_at': customer.get('first_order_at') or now,
+            'last_order_at': now,
+        })
 
-    user_link = f"@{user.username}" if user.username else "Нет"
-    report = format_order_message(order, user.first_name, user_link, phone, comment, 1, for_admin=True)
+    report = render_order_card(get_orders(context.bot_data)[oid])
 
-    try:
-        if photos:
-            # Отправляем фото отдельным постом
-            media = [InputMediaPhoto(media=pid) for pid in photos]
-            await context.bot.send_media_group(chat_id=ADMIN_CHANNEL_ID, media=media)
-            # Отправляем текст заявки
-            await context.bot.send_message(
-                chat_id=ADMIN_CHANNEL_ID, 
-                text=report,
-                parse_mode=ParseMode.HTML
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=ADMIN_CHANNEL_ID, 
-                text=report,
-                parse_mode=ParseMode.HTML
-            )
-    except Exception as e: 
-        logger.error(f"Ошибка отправки в канал: {e}")
+    # Доставка в канал идёт фоном с повторами, клиент получает ответ сразу
+    outbox.enqueue(context.bot_data, ADMIN_CHANNEL_ID, report, photos, order_id=oid)
 
     # Ответ пользователю
     await update.message.reply_text(
@@ -578,32 +4264,43 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # === ГЛАВНАЯ ФУНКЦИЯ ===
 
-async def main():
-    """Основная функция запуска бота"""
-    logger.info(f"🚀 Запуск бота на порту {PORT}...")
-
-    # Настраиваем обработку сигналов
-    def signal_handler(signum, frame):
-        logger.info(f"Получен сигнал {signum}, завершение работы...")
-        sys.exit(0)
-
-    signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGINT, signal_handler)
-
-    # Инициализируем бота
-    persistence = PicklePersistence(filepath="bot_data.pickle")
-    application = Application.builder().token(BOT_TOKEN).persistence(persistence).build()
+def build_application(bot=None, persistence=None):
+    """Application со всеми обработчиками. bot и persistence подменяются в бенчмарке"""
+    builder = (
+        Application.builder()
+        .bot(bot or AppBot(BOT_TOKEN, request=HTTPXRequest(connection_pool_size=API_CONNECTIONS)))
+        .update_queue(TrackingUpdateQueue())
+        # Создаётся здесь, а не на уровне модуля: в Python 3.9 семафоры привязываются к текущему event loop
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES, UPDATE_BACKLOG))
+    )
+    if persistence: builder = builder.persistence(persistence)
+    application = builder.build()
+    if getattr(persistence, 'shared', False):
+        application.update_processor.shared_lock = persistence.backend.lock
 
     # Регистрируем обработчики
+    application.add_handler(TypeHandler(Update, track_incoming_message), group=-1)
+    application.add_handler(TypeHandler(Update, touch_session), group=-2)
+    if getattr(persistence, 'shared', False):
+        application.add_handler(TypeHandler(Update, flush_session), group=100)
     application.add_handler(CommandHandler("admin", cmd_help))
     application.add_handler(CommandHandler("clean", cmd_clean))
     application.add_handler(CommandHandler("order", cmd_order_list))
     application.add_handler(CommandHandler("buyer", cmd_buyers))
+    application.add_handler(CommandHandler("find", cmd_find))
+    application.add_handler(CommandHandler("stats", cmd_stats))
+    application.add_handler(CommandHandler("backup", cmd_backup))
+    application.add_handler(CommandHandler("restore", cmd_restore))
     application.add_handler(CommandHandler("export", cmd_export))
+    application.add_handler(CommandHandler("outbox", cmd_outbox))
+    application.add_handler(CommandHandler("broadcast", cmd_broadcast))
+    application.add_handler(CommandHandler("quote", cmd_quote))
+    application.add_handler(CommandHandler("reprice", cmd_reprice))
     application.add_handler(CommandHandler("start", start))
 
     # Обработчики канала
     application.add_handler(MessageHandler(filters.ChatType.CHANNEL, handle_channel_post))
+    application.add_handler(ChatMemberHandler(handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
 
     # Пользовательские обработчики
     application.add_handler(CallbackQueryHandler(handle_callback))
@@ -613,39 +4310,130 @@ async def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document_upload))
 
-    # Запускаем HTTP сервер для health checks на порту от Render
-    http_runner = await start_http_server(PORT)
+    # Метрики по каждому обработчику
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrumented(handler.callback)
+
+    application.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+    if BACKUP_DIR or BACKUP_CHAT_ID:
+        application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+
+    return application
+
+async def main():
+    """Основная функция запуска бота"""
+    started = time.perf_counter()
+    logger.info(f"🚀 Запуск бота на порту {PORT}...")
+
+    # Сигнал только будит main: остановка идёт в finally, с дообработкой и сохранением
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop_event.set)
+
+    # Инициализируем бота
+    persistence = StatePersistence(
+        SQLiteStateBackend(PERSISTENCE_DB), legacy_pickle=LEGACY_PICKLE, update_interval=PERSISTENCE_INTERVAL,
+        shared=SHARED_STATE, worker_id=WORKER_ID
+    )
+    if SHARED_STATE:
+        # getUpdates отдаёт обновления только одному получателю - несколько процессов работают через webhook
+        if BOT_MODE != 'webhook': logger.warning("⚠️ SHARED_STATE=1 рассчитан на BOT_MODE=webhook")
+        if not WORKER_ID: logger.warning("⚠️ SHARED_STATE=1 без WORKER_ID: процессы будут делить очередь уведомлений")
+        logger.info(f"🔗 Общее хранилище {PERSISTENCE_DB}, процесс {WORKER_ID or '-'}")
+    application = build_application(persistence=persistence)
+
+    # Запускаем HTTP сервер для health checks (и webhook) на порту от Render
+    http_runner = await start_http_server(PORT, application)
 
     try:
         # Запускаем бота
         await application.initialize()
+        backlog = update_offsets.attach(application.bot_data)
+        previous = application.bot_data.get('last_shutdown')
+        if previous:
+            logger.info(
+                f"⏱ Предыдущая остановка: {previous['seconds']:.1f} с"
+                + ("" if previous['drained'] else ", не всё успели обработать")
+            )
         await application.start()
+        watchdog.start()
+        outbox.start(application)
+        if broadcaster.start(application): logger.info("📣 Продолжаем прерванную рассылку")
+        notify_price_list_change(application)
 
-        logger.info("🤖 Бот запущен и работает в режиме polling...")
-        logger.info(f"📊 Health check доступен по адресу: http://0.0.0.0:{PORT}/health")
+        # Принятые, но не обработанные до остановки обновления - в очередь раньше новых
+        for data in backlog:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        if backlog: logger.info(f"♻️ Повторно обрабатываем обновлений: {len(backlog)}")
 
-        # Запускаем polling
-        await application.updater.start_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
-        )
+        if BOT_MODE == 'webhook' and await start_webhook(application):
+            logger.info(f"🤖 Бот запущен и работает в режиме webhook: {WEBHOOK_PATH}")
+        else:
+            logger.info("🤖 Бот запущен и работает в режиме polling...")
+            # Без drop_pending_updates: сообщения, отправленные во время рестарта, не теряются
+            # start_polling сам снимает ранее установленный webhook
+            await application.updater.start_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False
+            )
+        lifecycle['startup_seconds'] = time.perf_counter() - started
+        logger.info(f"⏱ Запуск занял {lifecycle['startup_seconds']:.1f} с")
+        logger.info(f"📊 Health check доступен по адресу: http://0.0.0.0:{PORT}/health, готовность - /ready")
 
-        # Держим бота активным
-        while True:
-            await asyncio.sleep(3600)  # Спим по часу
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки...")
 
     except asyncio.CancelledError:
         logger.info("Получен запрос на остановку...")
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
     finally:
-        # Корректное завершение
-        logger.info("Завершение работы бота...")
-        if application.updater:
-            await application.updater.stop()
-        await application.stop()
-        await application.shutdown()
-        await http_runner.cleanup()
+        await shutdown(application, http_runner)
+
+async def stop_leftovers(application):
+    """Добивает то, что прерванный по таймауту stop() оставил работать.
+
+    stop() сразу снимает флаг running, но до остановки заданий, обработчиков и периодического
+    сохранения не дошёл - они писали бы в bot_data и базу, пока shutdown() её сохраняет и закрывает"""
+    if application.job_queue: await application.job_queue.stop(wait=False)
+    await application.update_processor.cancel_pending()
+    # Периодическое сохранение PTB ждёт сигнала из stop(), которого уже не будет
+    name = f"Application:{application.bot.id}:persistence_updater"
+    tasks = [task for task in asyncio.all_tasks() if task.get_name() == name]
+    for task in tasks: task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def shutdown(application, http_runner):
+    """Корректное завершение: перестаём принимать обновления, дообрабатываем принятые
+    за SHUTDOWN_TIMEOUT секунд и сохраняем данные"""
+    started = time.perf_counter()
+    logger.info("Завершение работы бота...")
+    # В режиме webhook Telegram повторит неподтверждённые запросы уже новому инстансу (webhook ставится без drop_pending_updates)
+    await http_runner.cleanup()
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    await outbox.stop()
+    await broadcaster.stop()
+    await watchdog.stop()
+
+    drained = True
+    if application.running:
+        try:
+            await asyncio.wait_for(application.stop(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            drained = False
+            logger.warning(
+                f"⏱ За {SHUTDOWN_TIMEOUT:.0f} с не обработано обновлений: {len(update_offsets.pending)}, "
+                "они будут обработаны после запуска"
+            )
+            await stop_leftovers(application)
+
+    seconds = time.perf_counter() - started
+    application.bot_data['last_shutdown'] = {'seconds': seconds, 'drained': drained, 'at': datetime.now().isoformat()}
+    await application.shutdown()  # Последнее сохранение и закрытие базы
+    logger.info(f"⏱ Остановка заняла {time.perf_counter() - started:.1f} с")
 
 # === ТОЧКА ВХОДА ===
 if __name__ == '__main__':